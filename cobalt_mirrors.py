@@ -0,0 +1,21 @@
+"""
+Список дзеркал Cobalt — спільний для main.py і mainstable.py.
+Перевизначається змінною оточення COBALT_MIRRORS (через кому).
+"""
+
+import os
+
+DEFAULT_COBALT_MIRRORS = (
+    "https://co.wuk.sh/api/json",
+    "https://api.cobalt.tools/api/json",
+    "https://cobalt.pub/api/json",
+    "https://api.succoon.com/api/json",
+    "https://cobalt.zip/api/json",
+    "https://cobalt.xy24.eu/api/json",
+)
+
+COBALT_MIRRORS = [
+    m.strip()
+    for m in os.getenv("COBALT_MIRRORS", ",".join(DEFAULT_COBALT_MIRRORS)).split(",")
+    if m.strip()
+]
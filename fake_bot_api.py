@@ -0,0 +1,264 @@
+"""
+Локальний фейковий Telegram Bot API — щоб ганяти бота (webhook і long
+polling) без Telegram. Відповідає на виклики бота правдоподібними
+об'єктами, запам'ятовує все надіслане і вміє «писати» боту від імені
+користувачів.
+
+Запуск:
+    python fake_bot_api.py --port 8098
+
+Бот націлюємо на нього:
+    TELEGRAM_API_URL=http://127.0.0.1:8098 python main.py
+    # webhook-режим: фейк доставлятиме апдейти на WEBHOOK_URL + WEBHOOK_PATH
+    TELEGRAM_API_URL=http://127.0.0.1:8098 WEBHOOK_URL=http://127.0.0.1:20000 python main.py
+
+Керування:
+    curl -X POST "http://127.0.0.1:8098/control/message?text=https://www.tiktok.com/@a/video/1&count=20&users=5"
+    curl -X POST "http://127.0.0.1:8098/control/callback?data=vid_audio:<data_id>&message_id=7"
+    curl http://127.0.0.1:8098/control          # вебхук, черга, лічильники, останні виклики бота
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)],
+)
+
+FAKE_FILE = b"\x00\x00\x00\x18ftypmp42" + b"\x00" * 1024
+MEDIA_FIELDS = ("video", "photo", "audio", "document")
+
+
+class FakeTelegram:
+    def __init__(self, token: str):
+        self.token = token
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.updates: list = []  # для getUpdates, коли вебхука нема
+        self.new_update = asyncio.Event()
+        self.webhook: dict = {}
+        self.files: dict = {}  # file_path -> байти
+        self.calls: dict = {}
+        self.sent: list = []
+        self.deliveries = {"ok": 0, "failed": 0, "rejected": 0}
+        self.http: aiohttp.ClientSession = None
+
+    # ---------- об'єкти Bot API ----------
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    @staticmethod
+    def chat(chat_id: int) -> dict:
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup", "title": "Fake chat"}
+
+    def message(self, chat_id: int, **fields) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self.chat(chat_id),
+            **fields,
+        }
+
+    def file(self, data: bytes = FAKE_FILE) -> dict:
+        n = next(self.file_ids)
+        self.files[f"files/{n}"] = data
+        return {"file_id": f"fake-file-{n}", "file_unique_id": f"u{n}", "file_size": len(data)}
+
+    def media(self, kind: str, data: bytes) -> dict:
+        f = self.file(data)
+        if kind == "photo":
+            return {"photo": [{**f, "width": 1080, "height": 1080}]}
+        if kind == "video":
+            return {"video": {**f, "width": 720, "height": 1280, "duration": 10}}
+        if kind == "audio":
+            return {"audio": {**f, "duration": 10}}
+        return {"document": f}
+
+    # ---------- методи ----------
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method != "getUpdates":
+            self.sent.append({"method": method, **{k: v for k, v in params.items() if isinstance(v, str)}})
+            del self.sent[:-200]
+        name = method.lower()
+
+        if name == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if name == "setwebhook":
+            self.webhook = {"url": params.get("url", ""), "secret_token": params.get("secret_token", "")}
+            if params.get("drop_pending_updates") in ("true", "True", True):
+                self.updates.clear()
+            return True
+        if name == "deletewebhook":
+            self.webhook = {}
+            if params.get("drop_pending_updates") in ("true", "True", True):
+                self.updates.clear()
+            return True
+        if name == "getwebhookinfo":
+            return {"url": self.webhook.get("url", ""), "has_custom_certificate": False,
+                    "pending_update_count": len(self.updates)}
+        if name == "getupdates":
+            return await self.get_updates(params)
+        if name == "getfile":
+            path = f"files/{params['file_id'].rsplit('-', 1)[-1]}"
+            return {"file_id": params["file_id"], "file_unique_id": "u", "file_path": path}
+
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if name == "sendmessage":
+            return self.message(chat_id, text=params.get("text", ""))
+        if name == "sendmediagroup":
+            result = []
+            for item in json.loads(params.get("media", "[]")):
+                data = params.get(item["media"].removeprefix("attach://"))
+                result.append(self.message(chat_id, **self.media(item["type"], data if isinstance(data, bytes) else FAKE_FILE)))
+            return result
+        for kind in MEDIA_FIELDS:
+            if name == f"send{kind}":
+                data = params.get(kind)
+                return self.message(
+                    chat_id,
+                    caption=params.get("caption"),
+                    **self.media(kind, data if isinstance(data, bytes) else FAKE_FILE),
+                )
+        # editMessage*, deleteMessage, answerCallbackQuery, ...
+        return True
+
+    async def get_updates(self, params: dict) -> list:
+        if self.webhook:
+            raise web.HTTPConflict(text=json.dumps(
+                {"ok": False, "error_code": 409, "description": "Conflict: can't use getUpdates while webhook is active"}
+            ), content_type="application/json")
+        offset = int(params.get("offset", 0) or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), float(params.get("timeout", 0) or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit", 100) or 100)]
+
+    # ---------- апдейти від «користувачів» ----------
+
+    async def push(self, update: dict):
+        update["update_id"] = next(self.update_ids)
+        if not self.webhook:
+            self.updates.append(update)
+            self.new_update.set()
+            return
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook["secret_token"]}
+        try:
+            async with self.http.post(self.webhook["url"], json=update, headers=headers) as resp:
+                key = "ok" if resp.status == 200 else "rejected"
+                if resp.status != 200:
+                    logging.warning(f"webhook answered {resp.status} for update {update['update_id']}")
+        except aiohttp.ClientError as e:
+            key = "failed"
+            logging.warning(f"webhook delivery failed: {e}")
+        self.deliveries[key] += 1
+
+
+def build_app(api: FakeTelegram) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+
+    async def on_startup(app):
+        api.http = aiohttp.ClientSession()
+
+    async def on_cleanup(app):
+        await api.http.close()
+
+    async def method(request):
+        if request.match_info["token"] != api.token and api.token != "*":
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+        params = {}
+        for key, value in (await request.post()).items():
+            params[key] = value.file.read() if isinstance(value, web.FileField) else value
+        params.update(request.query)
+        return web.json_response({"ok": True, "result": await api.call(request.match_info["method"], params)})
+
+    async def file(request):
+        body = api.files.get(request.match_info["path"])
+        if body is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=body)
+
+    async def control(request):
+        return web.json_response(
+            {
+                "webhook": api.webhook,
+                "queued_updates": len(api.updates),
+                "deliveries": api.deliveries,
+                "calls": api.calls,
+                "sent": api.sent[-int(request.query.get("last", 20)):],
+            }
+        )
+
+    async def send_messages(request):
+        """count повідомлень text від users різних користувачів (по колу), доставка паралельна."""
+        text = request.query.get("text", "https://www.tiktok.com/@fake/video/1")
+        count = int(request.query.get("count", 1))
+        users = max(1, int(request.query.get("users", 1)))
+        chat_id = request.query.get("chat_id")
+        updates = []
+        for i in range(count):
+            user_id = 1000 + i % users
+            message = api.message(int(chat_id or user_id), text=text)
+            message["from"] = api.user(user_id)
+            updates.append({"message": message})
+        await asyncio.gather(*(api.push(u) for u in updates))
+        return web.json_response({"pushed": count, "deliveries": api.deliveries})
+
+    async def send_callback(request):
+        user_id = int(request.query.get("user_id", 1000))
+        chat_id = int(request.query.get("chat_id", user_id))
+        message = api.message(chat_id, text="Опції:")
+        message["message_id"] = int(request.query.get("message_id", message["message_id"]))
+        await api.push(
+            {
+                "callback_query": {
+                    "id": str(next(api.message_ids)),
+                    "from": api.user(user_id),
+                    "chat_instance": str(chat_id),
+                    "message": message,
+                    "data": request.query["data"],
+                }
+            }
+        )
+        return web.json_response({"deliveries": api.deliveries})
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post("/bot{token}/{method}", method)
+    app.router.add_get("/bot{token}/{method}", method)
+    app.router.add_get("/file/bot{token}/{path:.+}", file)
+    app.router.add_get("/control", control)
+    app.router.add_post("/control/message", send_messages)
+    app.router.add_post("/control/callback", send_callback)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковий Telegram Bot API для офлайн-тестів")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--token", default="*", help="приймати лише цей BOT_TOKEN ('*' — будь-який)")
+    args = parser.parse_args()
+    web.run_app(build_app(FakeTelegram(args.token)), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Локальні фейкові TikWM і Cobalt — щоб перевіряти хеджування та
+circuit breaker у main.py без мережі.
+
+Запуск:
+    python fake_providers.py --port 8099 --tikwm-delay 4 --cobalt-fail 0.3
+
+Бот націлюємо на них змінними оточення:
+    TIKWM_API_URL=http://127.0.0.1:8099/api/
+    COBALT_MIRRORS=http://127.0.0.1:8099/cobalt/1/api/json,http://127.0.0.1:8099/cobalt/2/api/json
+
+Пост з id 404 (…/video/404) «видалений»: обидва провайдери відповідають,
+що його нема, а не що вони зламались.
+
+Поведінку можна змінювати на льоту:
+    curl -X POST "http://127.0.0.1:8099/control?provider=tikwm&delay=0&fail=1"
+    curl http://127.0.0.1:8099/control      # налаштування і лічильники викликів
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import re
+import sys
+
+from aiohttp import web
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)],
+)
+
+# Маленькі «медіа», щоб бот мав що завантажити
+FAKE_MEDIA = {
+    "video.mp4": b"\x00\x00\x00\x18ftypmp42" + b"\x00" * 1024,
+    "music.mp3": b"ID3" + b"\x00" * 1024,
+    "image.jpg": b"\xff\xd8\xff\xe0" + b"\x00" * 1024,
+}
+
+MISSING_POST_ID = "404"
+
+
+class FakeProvider:
+    def __init__(self, delay: float = 0.0, fail: float = 0.0):
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    async def behave(self) -> bool:
+        """Чекає delay секунд; True — цей виклик має завершитись помилкою."""
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return random.random() < self.fail
+
+    def as_dict(self) -> dict:
+        return {"delay": self.delay, "fail": self.fail, "calls": self.calls}
+
+
+def post_info(url: str):
+    m = re.search(r"/@([^/?#]+)/(video|photo)/(\d+)", url or "")
+    if not m:
+        return "fake_user", "video", "0"
+    return m.group(1), m.group(2), m.group(3)
+
+
+def build_app(providers: dict, base_url: str) -> web.Application:
+    app = web.Application()
+
+    async def tikwm(request):
+        form = await request.post()
+        if await providers["tikwm"].behave():
+            return web.json_response({"code": -1, "msg": "Free Api Limit: 1 request/second."})
+        user, kind, post_id = post_info(form.get("url"))
+        if post_id == MISSING_POST_ID:
+            return web.json_response({"code": -1, "msg": "Url parsing is failed! Please check url."})
+        data = {
+            "id": post_id,
+            "title": f"Fake caption for post {post_id}",
+            "author": {"nickname": user.title(), "unique_id": user},
+            "music": f"{base_url}/media/music.mp3",
+            "music_info": {"author": user, "title": "Fake sound"},
+        }
+        if kind == "photo":
+            data["images"] = [f"{base_url}/media/image.jpg" for _ in range(3)]
+        else:
+            data["hdplay"] = f"{base_url}/media/video.mp4"
+        return web.json_response({"code": 0, "msg": "success", "data": data})
+
+    async def cobalt(request):
+        provider = providers.setdefault(
+            f"cobalt{request.match_info['n']}", FakeProvider()
+        )
+        payload = await request.json()
+        if await provider.behave():
+            return web.json_response({"status": "error", "text": "fake failure"}, status=503)
+        _, kind, post_id = post_info(payload.get("url"))
+        if post_id == MISSING_POST_ID:
+            return web.json_response({"status": "error", "text": "error.api.content.video.unavailable"})
+        if kind == "photo":
+            return web.json_response(
+                {
+                    "status": "picker",
+                    "audio": f"{base_url}/media/music.mp3",
+                    "picker": [
+                        {"type": "photo", "url": f"{base_url}/media/image.jpg"}
+                        for _ in range(3)
+                    ],
+                }
+            )
+        return web.json_response({"status": "redirect", "url": f"{base_url}/media/video.mp4"})
+
+    async def media(request):
+        body = FAKE_MEDIA.get(request.match_info["name"])
+        if body is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=body)
+
+    async def control(request):
+        if request.method == "POST":
+            name = request.query.get("provider", "tikwm")
+            provider = providers.setdefault(name, FakeProvider())
+            if "delay" in request.query:
+                provider.delay = float(request.query["delay"])
+            if "fail" in request.query:
+                provider.fail = float(request.query["fail"])
+        return web.json_response({name: p.as_dict() for name, p in providers.items()})
+
+    app.router.add_post("/api/", tikwm)
+    app.router.add_post("/cobalt/{n}/api/json", cobalt)
+    app.router.add_get("/media/{name}", media)
+    app.router.add_route("*", "/control", control)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейкові TikWM/Cobalt для офлайн-тестів")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--tikwm-delay", type=float, default=0.0)
+    parser.add_argument("--tikwm-fail", type=float, default=0.0)
+    parser.add_argument("--cobalt-delay", type=float, default=0.0)
+    parser.add_argument("--cobalt-fail", type=float, default=0.0)
+    args = parser.parse_args()
+
+    providers = {
+        "tikwm": FakeProvider(args.tikwm_delay, args.tikwm_fail),
+        "cobalt1": FakeProvider(args.cobalt_delay, args.cobalt_fail),
+        "cobalt2": FakeProvider(args.cobalt_delay, args.cobalt_fail),
+    }
+    base_url = f"http://{args.host}:{args.port}"
+    web.run_app(build_app(providers, base_url), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
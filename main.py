@@ -1,12 +1,27 @@
 import asyncio
+import hashlib
+import hmac
+import json
 import logging
+import logging.handlers
 import os
 import re
+import signal
+import sqlite3
 import sys
+import threading
+import tracemalloc
+import weakref
 import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 import random
-import subprocess
-from typing import List, Tuple, Optional
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, List, Tuple, Optional, Union
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart
@@ -16,17 +31,24 @@ from aiogram.types import (
     InlineKeyboardButton,
     CallbackQuery,
 )
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import SendAudio, SendDocument, SendMediaGroup, SendPhoto, SendVideo
 from aiogram.utils.media_group import MediaGroupBuilder
 
 import aiohttp
 from aiohttp import web
 
-from deep_translator import GoogleTranslator
-from langdetect import detect
+from langdetect import DetectorFactory, detect
+from langdetect.detector_factory import init_factory
 import instaloader
 import static_ffmpeg
 
 from pathlib import Path
+from urllib.parse import parse_qs, urljoin, urlparse
+
+from cobalt_mirrors import COBALT_MIRRORS
 
 # ---------------------------
 #  БАЗОВА КОНФІГУРАЦІЯ
@@ -55,14 +77,77 @@ if not BOT_TOKEN:
 API_HOST = "0.0.0.0"
 API_PORT = int(os.getenv("PORT", 20000))
 
+# ---------- Отримання апдейтів: webhook або long polling ----------
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")  # свій Bot API (напр. fake_bot_api.py)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # публічна адреса бота; порожньо — long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Секрет, який Telegram повертає в заголовку кожного апдейту; за замовчуванням — похідний від токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))  # з'єднань від Telegram (1-100)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))  # апдейтів обробляємо одночасно
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", 500))  # прийнятих і ще не оброблених; понад це — 503
+
+# ---------- Спільний HTTP-клієнт ----------
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", 100))  # всього з'єднань у пулі
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", 20))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", 300))  # сек, кеш DNS
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 60))  # сек, простій keep-alive
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 120))  # сек, загальний таймаут запиту
+HTTP_PREWARM = os.getenv("HTTP_PREWARM", "1") == "1"
+HTTP_PREWARM_HOSTS = [
+    h.strip()
+    for h in os.getenv(
+        "HTTP_PREWARM_HOSTS",
+        "www.tikwm.com,api.vxtwitter.com,video.twimg.com,pbs.twimg.com",
+    ).split(",")
+    if h.strip()
+]
+
 static_ffmpeg.add_paths()
 
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
 dp = Dispatcher()
 
-translator = GoogleTranslator(source="auto", target="uk")
-
-STORAGE = {}
+# langdetect без seed дає різні відповіді для того самого тексту
+DetectorFactory.seed = 0
+
+# ---------- Сховище стану кнопок (data_id -> дані поста) ----------
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_MB", 256)) * 1024 * 1024
+STORAGE_MAX_ENTRIES = int(os.getenv("STORAGE_MAX_ENTRIES", 5000))
+STORAGE_TTL = int(os.getenv("STORAGE_TTL", 6 * 3600))  # сек з останнього звернення
+# memory (за замовчуванням) / sqlite / redis — sqlite і redis переживають рестарт,
+# redis ще й спільний для кількох процесів бота
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "state.db")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_REDIS_PREFIX = os.getenv("STATE_REDIS_PREFIX", "tgbot:")
+
+# ---------- Кеш file_id (пост -> file_id, які вже є в Telegram) ----------
+FILE_ID_CACHE_DB = os.getenv("FILE_ID_CACHE_DB", "")  # шлях до SQLite; порожньо — лише пам'ять
+FILE_ID_CACHE_MAX = int(os.getenv("FILE_ID_CACHE_MAX", 20000))
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL", 30 * 24 * 3600))
+
+# ---------- Черга задач і планувальник (справедливість між користувачами і чатами) ----------
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 8))  # воркерів = одночасних важких задач на весь бот
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", 200))  # задач у черзі; понад це — відмова
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", 300))  # сек на одну задачу
+JOB_DRAIN_TIMEOUT = float(os.getenv("JOB_DRAIN_TIMEOUT", 25))  # сек на доробку задач при зупинці
+SCHED_PER_USER = int(os.getenv("SCHED_PER_USER", 2))  # одночасних від одного користувача
+SCHED_PER_CHAT = int(os.getenv("SCHED_PER_CHAT", 3))  # одночасних в одному чаті
+SCHED_USER_QUEUE = int(os.getenv("SCHED_USER_QUEUE", 10))  # скільки може чекати від одного користувача
+
+# ---------- Трасування запитів ----------
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")  # спани у JSON lines; порожньо — не писати
+TRACE_MAX_MB = int(os.getenv("TRACE_MAX_MB", 20))  # ротація файлу
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 10))  # довші — у лог з розкладом
+
+# ---------- Профілювання (/debug/*) ----------
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")  # порожньо — ендпоінти вимкнені
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_MEMORY_SECONDS = float(os.getenv("PROFILE_MEMORY_SECONDS", 300))  # tracemalloc вимикається сам
 
 logging.basicConfig(
     level=logging.INFO,
@@ -70,16 +155,69 @@ logging.basicConfig(
     handlers=[logging.StreamHandler(sys.stdout)],
 )
 
-# ---------- Інстанс Instaloader (один, не створюємо щоразу) ----------
-INSTA_LOADER = instaloader.Instaloader(quiet=True)
-INSTA_LOADER.context._user_agent = "Instagram 269.0.0.18.75 Android"
+# ---------- FFmpeg (витяг аудіо) ----------
+# m4a: копіюємо наявну AAC-доріжку без перекодування; mp3 — лише якщо інакше ніяк
+AUDIO_PREFER_M4A = os.getenv("AUDIO_PREFER_M4A", "1") == "1"
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", 60))  # сек на один запуск ffmpeg
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", os.cpu_count() or 2))  # одночасних ffmpeg
+MEDIA_QUEUE_MAX = int(os.getenv("MEDIA_QUEUE_MAX", 20))  # скільки задач може чекати
+MEDIA_JOB_TIMEOUT = float(os.getenv("MEDIA_JOB_TIMEOUT", 150))  # сек на всю задачу
+
+# ---------- Завантаження медіа поста ----------
+ASSET_CONCURRENCY = int(os.getenv("ASSET_CONCURRENCY", 4))  # одночасних завантажень на один запит
+TELEGRAM_UPLOAD_LIMIT = int(os.getenv("TELEGRAM_UPLOAD_LIMIT", 50 * 1024 * 1024))  # більше Bot API не приймає
+
+# ---------- Розгортання коротких посилань TikTok ----------
+REDIRECT_CACHE_MAX = int(os.getenv("REDIRECT_CACHE_MAX", 10000))
+REDIRECT_CACHE_TTL = int(os.getenv("REDIRECT_CACHE_TTL", 24 * 3600))  # успішні
+REDIRECT_NEGATIVE_TTL = int(os.getenv("REDIRECT_NEGATIVE_TTL", 60))  # невдалі
+REDIRECT_MAX_HOPS = int(os.getenv("REDIRECT_MAX_HOPS", 5))
+
+# ---------- TikWM API (ліміт безкоштовного тарифу) ----------
+TIKWM_API_URL = os.getenv("TIKWM_API_URL", "https://www.tikwm.com/api/")
+TIKWM_RATE = float(os.getenv("TIKWM_RATE", 0.9))  # запитів на секунду
+TIKWM_BURST = int(os.getenv("TIKWM_BURST", 1))
+TIKWM_MAX_QUEUE = int(os.getenv("TIKWM_MAX_QUEUE", 30))  # більше — одразу відмова
+TIKWM_MAX_RETRIES = int(os.getenv("TIKWM_MAX_RETRIES", 3))
+TIKWM_BACKOFF_BASE = float(os.getenv("TIKWM_BACKOFF_BASE", 1.1))  # сек, множиться на 2^спроба
+
+# ---------- Провайдери TikTok (TikWM + дзеркала Cobalt) ----------
+TIKTOK_PROVIDERS = [
+    p.strip() for p in os.getenv("TIKTOK_PROVIDERS", "tikwm,cobalt").split(",") if p.strip()
+]
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", 2.5))  # сек до паралельного запиту до наступного
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", 15))  # сек на відповідь Cobalt
+PROVIDER_BREAKER_FAILURES = int(os.getenv("PROVIDER_BREAKER_FAILURES", 3))
+PROVIDER_BREAKER_RESET = float(os.getenv("PROVIDER_BREAKER_RESET", 60))  # сек до пробного запиту
+
+# ---------- Кеш перекладів ----------
+TRANSLATION_CACHE_DB = os.getenv("TRANSLATION_CACHE_DB", "")  # SQLite; порожньо — лише пам'ять
+TRANSLATION_CACHE_MAX = int(os.getenv("TRANSLATION_CACHE_MAX", 5000))
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", 30 * 24 * 3600))
+# Перекладаємо лише по кнопці 🇺🇦; з 1 — ще й у фоні одразу після відправки медіа
+TRANSLATE_PREFETCH = os.getenv("TRANSLATE_PREFETCH", "0") == "1"
+# google — веб-ендпоінт Google Translate; local — локальна заглушка без мережі (тести)
+TRANSLATE_BACKEND = os.getenv("TRANSLATE_BACKEND", "google").lower()
+TRANSLATE_BATCH_WINDOW = float(os.getenv("TRANSLATE_BATCH_WINDOW_MS", 40)) / 1000
+TRANSLATE_BATCH_MAX = int(os.getenv("TRANSLATE_BATCH_MAX", 16))  # текстів в одному запиті
+TRANSLATE_CONCURRENCY = int(os.getenv("TRANSLATE_CONCURRENCY", 4))  # одночасних запитів
+
+# ---------- Instaloader ----------
+INSTA_WORKERS = int(os.getenv("INSTA_WORKERS", 2))  # власні потоки, не спільний executor
+INSTA_MAX_QUEUE = int(os.getenv("INSTA_MAX_QUEUE", 20))
+INSTA_META_MAX = int(os.getenv("INSTA_META_MAX", 1000))
+INSTA_META_TTL = int(os.getenv("INSTA_META_TTL", 3600))  # але не довше, ніж живуть посилання CDN
+INSTA_COOLDOWN = int(os.getenv("INSTA_COOLDOWN", 300))  # пауза після 429 / «please wait»
+INSTA_MAX_SLEEP = float(os.getenv("INSTA_MAX_SLEEP", 5))  # довше не спимо в потоці Instaloader
 
 
 # ---------------------------
 #  КЛАВІАТУРИ
 # ---------------------------
 
-def get_video_keyboard(data_id: str, current_lang: str = "orig") -> InlineKeyboardMarkup:
+def get_video_keyboard(
+    data_id: str, current_lang: str = "orig", has_diff: bool = False
+) -> InlineKeyboardMarkup:
     """
     Для відео-постів (TikTok / X / Instagram video):
     – 🎵 Аудіо
@@ -95,9 +233,6 @@ def get_video_keyboard(data_id: str, current_lang: str = "orig") -> InlineKeyboa
 
     buttons = [[btn_audio, btn_video]]
 
-    data = STORAGE.get(data_id)
-    has_diff = bool(data and data.get("has_diff"))
-
     # Якщо мова вже українська – кнопки перекладу не показуємо
     if has_diff:
         if current_lang == "orig":
@@ -113,7 +248,9 @@ def get_video_keyboard(data_id: str, current_lang: str = "orig") -> InlineKeyboa
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def get_photo_keyboard(data_id: str, current_lang: str = "orig") -> InlineKeyboardMarkup:
+def get_photo_keyboard(
+    data_id: str, current_lang: str = "orig", has_diff: bool = False
+) -> InlineKeyboardMarkup:
     """
     Для фото/галереї (Instagram, X, TikTok-фото):
     – 🖼️ Тільки медіа
@@ -125,9 +262,6 @@ def get_photo_keyboard(data_id: str, current_lang: str = "orig") -> InlineKeyboa
 
     buttons = [[btn_clean]]
 
-    data = STORAGE.get(data_id)
-    has_diff = bool(data and data.get("has_diff"))
-
     if has_diff:
         if current_lang == "orig":
             lang_btn = InlineKeyboardButton(
@@ -143,255 +277,2833 @@ def get_photo_keyboard(data_id: str, current_lang: str = "orig") -> InlineKeyboa
 
 
 # ---------------------------
-#  ДОПОМІЖНІ ФУНКЦІЇ
+#  СТАТИСТИКА (/stats)
 # ---------------------------
 
-def sanitize_filename(name: str) -> str:
-    if not name:
-        return "audio"
-    name = re.sub(r'[\\/*?:"<>|]', "", str(name))
-    name = name.replace("\n", " ").strip()
-    return name[:50]
+# name -> функція, що повертає dict зі станом підсистеми
+STATS_PROVIDERS: Dict[str, Callable[[], dict]] = {}
 
 
-def parse_message_data(text: Optional[str]):
+def collect_stats() -> dict:
+    result = {}
+    for name, provider in STATS_PROVIDERS.items():
+        try:
+            result[name] = provider()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return result
+
+
+# ---------------------------
+#  МЕТРИКИ (Prometheus, /metrics)
+# ---------------------------
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+BYTES_BUCKETS = tuple(16 * 1024 * 4 ** i for i in range(9))  # 16 КБ .. 1 ГБ
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value:g}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # ключ міток -> [лічильники по бакетах..., sum, count]
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        row = self.values.get(key)
+        if row is None:
+            row = self.values[key] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, row in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, row):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': f'{bound:g}'})} {count:g}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {row[-1]:g}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {row[-2]:g}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {row[-1]:g}")
+        return lines
+
+
+class MetricsRegistry:
     """
-    Повертає: url, clean_mode, audio_mode
+    Мінімальний реєстр у форматі Prometheus text exposition.
+    collectors — функції, що на кожен scrape повертають
+    [(name, kind, help, [(labels, value), ...])] з уже наявних лічильників.
     """
-    if not text:
-        return None, False, False
-    url_match = re.search(r"(https?://[^\s]+)", text)
-    if not url_match:
-        return None, False, False
 
-    found_url = url_match.group(1)
+    def __init__(self):
+        self.metrics: List[Union[Counter, Histogram]] = []
+        self.collectors: List[Callable[[], list]] = []
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        metric = Gauge(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...], buckets: Tuple[float, ...]) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logging.warning(f"metrics collector error: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{_format_labels(labels)} {value:g}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
 
-    cmd_text = text.replace(found_url, "").lower()
 
-    clean_mode = (
-        "-" in cmd_text or "!" in cmd_text or "clear" in cmd_text or "чисто" in cmd_text
+METRICS = MetricsRegistry()
+STAGE_SECONDS = METRICS.histogram(
+    "bot_stage_seconds", "Duration of pipeline stages",
+    ("stage", "platform", "mode"), SECONDS_BUCKETS,
+)
+DOWNLOAD_BYTES = METRICS.histogram(
+    "bot_download_bytes", "Size of downloaded media assets",
+    ("kind", "platform", "mode"), BYTES_BUCKETS,
+)
+ERRORS = METRICS.counter("bot_errors_total", "Failed stages and requests", ("stage", "platform", "mode"))
+REQUESTS_TOTAL = METRICS.counter("bot_requests_total", "Handled requests", ("platform", "mode"))
+REQUESTS_IN_FLIGHT = METRICS.gauge("bot_requests_in_flight", "Requests being processed now", ("mode",))
+
+# Мітки поточного запиту (platform / mode); успадковуються задачами, створеними всередині
+REQUEST_LABELS: ContextVar[Optional[dict]] = ContextVar("request_labels", default=None)
+UNKNOWN_LABELS = {"platform": "unknown", "mode": "unknown"}
+
+
+def platform_of(url: Optional[str]) -> str:
+    url = url or ""
+    if "tiktok.com" in url:
+        return "tiktok"
+    if "twitter.com" in url or "x.com" in url:
+        return "twitter"
+    if "instagram.com" in url:
+        return "instagram"
+    return "other"
+
+
+def current_labels() -> dict:
+    return REQUEST_LABELS.get() or UNKNOWN_LABELS
+
+
+# ---------------------------
+#  ТРАСУВАННЯ ЗАПИТІВ (спани -> JSON lines)
+# ---------------------------
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attrs", "error")
+
+    def __init__(self, name: str, span_id: int, parent_id: Optional[int], attrs: dict):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.monotonic()) - self.start
+
+
+class Trace:
+    """Усі спани одного запиту користувача (повідомлення чи натискання кнопки)."""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started_at = time.time()
+        self.spans: List[Span] = []
+        # хто ще працює над запитом: хендлер + задачі JOBS (hand_off_request);
+        # останній, хто закінчив, завершує запит
+        self.holders = 1
+
+    def open(self, name: str, parent: Optional[Span], attrs: dict) -> Span:
+        span = Span(name, len(self.spans), parent.span_id if parent else None, attrs)
+        self.spans.append(span)
+        return span
+
+    def records(self) -> List[dict]:
+        root_start = self.spans[0].start
+        return [
+            {
+                "request_id": self.request_id,
+                "span_id": s.span_id,
+                "parent_id": s.parent_id,
+                "name": s.name,
+                "start_ms": round((s.start - root_start) * 1000, 1),
+                "duration_ms": round(s.duration * 1000, 1),
+                "error": s.error,
+                **({"attrs": s.attrs} if s.attrs else {}),
+            }
+            for s in self.spans
+        ]
+
+    def breakdown(self) -> str:
+        """Дерево спанів з відступами — для логу повільних запитів."""
+        children: Dict[Optional[int], List[Span]] = {}
+        for s in self.spans:
+            children.setdefault(s.parent_id, []).append(s)
+        root_start = self.spans[0].start
+        lines = []
+
+        def walk(parent_id: Optional[int], depth: int):
+            for s in children.get(parent_id, []):
+                error = f" ERROR {s.error}" if s.error else ""
+                lines.append(
+                    f"{'  ' * depth}{s.name} +{(s.start - root_start):.2f}s {s.duration:.2f}s{error}"
+                )
+                walk(s.span_id, depth + 1)
+
+        walk(None, 1)
+        return "\n".join(lines)
+
+
+CURRENT_TRACE: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+CURRENT_SPAN: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+TRACE_LOG = logging.getLogger("trace")
+TRACE_LOG.propagate = False
+if TRACE_FILE:
+    _trace_handler = logging.handlers.RotatingFileHandler(
+        TRACE_FILE, maxBytes=TRACE_MAX_MB * 1024 * 1024, backupCount=2, encoding="utf-8"
     )
-    audio_mode = ("!a" in cmd_text) or ("audio" in cmd_text) or ("аудіо" in cmd_text)
+    _trace_handler.setFormatter(logging.Formatter("%(message)s"))
+    TRACE_LOG.addHandler(_trace_handler)
+    TRACE_LOG.setLevel(logging.INFO)
+TRACE_STATS = {"requests": 0, "slow": 0}
+STATS_PROVIDERS["tracing"] = lambda: dict(TRACE_STATS)
 
-    return found_url, clean_mode, audio_mode
 
+def current_request_id() -> Optional[str]:
+    trace = CURRENT_TRACE.get()
+    return trace.request_id if trace else None
 
-async def download_content(url: str) -> Optional[bytes]:
-    if not url:
-        return None
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Вкладений спан поточного запиту. Поза запитом нічого не робить.
+    Задачі, створені всередині (gather / create_task), успадковують батьківський спан.
+    """
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.open(name, CURRENT_SPAN.get(), attrs)
+    token = CURRENT_SPAN.set(current)
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0 Safari/537.36"
-        }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as resp:
-                if resp.status == 200:
-                    return await resp.read()
+        yield current
     except Exception as e:
-        logging.warning(f"download_content error: {e}")
-    return None
+        current.error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    except asyncio.CancelledError:
+        current.error = "cancelled"
+        raise
+    finally:
+        current.end = time.monotonic()
+        CURRENT_SPAN.reset(token)
+
+
+def finish_trace(trace: Trace, labels: dict):
+    TRACE_STATS["requests"] += 1
+    if TRACE_FILE:
+        for record in trace.records():
+            TRACE_LOG.info(json.dumps(record, ensure_ascii=False))
+    total = trace.spans[0].duration
+    if total >= SLOW_REQUEST_SECONDS:
+        TRACE_STATS["slow"] += 1
+        logging.warning(
+            f"Slow request {trace.request_id} ({labels['platform']}/{labels['mode']}): "
+            f"{total:.2f}s\n{trace.breakdown()}"
+        )
 
 
-async def prepare_texts(text: str):
+@contextmanager
+def track_request(platform: str, mode: str):
     """
-    Повертає: (orig_text, trans_text, has_diff)
-    За замовчуванням показуємо ОРИГІНАЛ.
-    has_diff = True, якщо мова не українська.
+    Рамка одного запиту користувача: request ID і кореневий спан,
+    мітки для всіх стадій усередині, in-flight і лічильник запитів.
+    Вкладений виклик (кнопка -> process_media_request) лише уточнює
+    платформу зовнішнього і стає його дочірнім спаном.
     """
-    if not text:
-        return "", "", False
+    labels = REQUEST_LABELS.get()
+    if labels is not None:
+        if labels["platform"] == "unknown":
+            labels["platform"] = platform
+        with span(f"request.{mode}"):
+            yield labels
+        return
+
+    labels = {"platform": platform, "mode": mode}
+    trace = Trace(uuid.uuid4().hex[:12])
+    token = REQUEST_LABELS.set(labels)
+    trace_token = CURRENT_TRACE.set(trace)
+    REQUESTS_IN_FLIGHT.inc(mode=mode)
     try:
-        lang = detect(text)
-        if lang != "uk":
-            trans = await asyncio.to_thread(translator.translate, text)
-            return text, trans, True
-        # вже українська
-        return text, text, False
-    except Exception as e:
-        logging.warning(f"prepare_texts error: {e}")
-        return text, text, False
+        with span("request", mode=mode):
+            yield labels
+    except Exception:
+        ERRORS.inc(stage="request", **labels)
+        raise
+    finally:
+        CURRENT_TRACE.reset(trace_token)
+        REQUEST_LABELS.reset(token)
+        release_request(trace, labels)
+
+
+def release_request(trace: Trace, labels: dict):
+    trace.holders -= 1
+    if trace.holders > 0:
+        return
+    REQUESTS_IN_FLIGHT.dec(mode=labels["mode"])
+    REQUESTS_TOTAL.inc(**labels)
+    trace.spans[0].attrs["platform"] = labels["platform"]
+    finish_trace(trace, labels)
 
 
-def format_caption(author_name: str, author_url: str, text: str, original_url: str):
-    caption = f"👤 <a href='{author_url}'><b>{author_name}</b></a>\n\n"
-    if text:
-        caption += f"📝 {text}\n\n"
-    caption += f"🔗 <a href='{original_url}'>Оригінал</a>"
-    return caption[:1024]
+def hand_off_request() -> Optional[Tuple[Trace, dict]]:
+    """
+    Хендлер віддає частину запиту воркеру: запит (лічильники, траса)
+    завершиться, коли закінчать і хендлер, і resume_request у воркері.
+    """
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        return None
+    trace.holders += 1
+    return trace, REQUEST_LABELS.get()
+
+
+@contextmanager
+def resume_request(request: Tuple[Trace, dict]):
+    """Продовжує запит хендлера у воркері: ті самі request ID, траса і мітки."""
+    trace, labels = request
+    root = trace.spans[0]
+    token = REQUEST_LABELS.set(labels)
+    trace_token = CURRENT_TRACE.set(trace)
+    span_token = CURRENT_SPAN.set(root)
+    try:
+        yield labels
+    except Exception:
+        ERRORS.inc(stage="request", **labels)
+        raise
+    finally:
+        root.end = time.monotonic()  # запит триває до кінця задачі, а не лише хендлера
+        CURRENT_SPAN.reset(span_token)
+        CURRENT_TRACE.reset(trace_token)
+        REQUEST_LABELS.reset(token)
+        release_request(trace, labels)
+
+
+@contextmanager
+def observe_stage(stage: str, **attrs):
+    """
+    Стадія конвеєра: спан у трасі запиту + час у bot_stage_seconds;
+    виняток -> bot_errors_total (і летить далі).
+    """
+    started = time.monotonic()
+    try:
+        with span(stage, **attrs) as current:
+            yield current
+    except Exception:
+        ERRORS.inc(stage=stage, **current_labels())
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.monotonic() - started, stage=stage, **current_labels())
 
 
-def extract_audio_from_video_bytes(video_bytes: bytes) -> Optional[bytes]:
-    try:
-        unique = str(uuid.uuid4())
-        vid_path = f"temp_vid_{unique}.mp4"
-        aud_path = f"temp_aud_{unique}.mp3"
-        with open(vid_path, "wb") as f:
-            f.write(video_bytes)
-        subprocess.run(
-            [
-                "ffmpeg",
-                "-y",
-                "-i",
-                vid_path,
-                "-vn",
-                "-acodec",
-                "libmp3lame",
-                "-q:a",
-                "2",
-                aud_path,
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        with open(aud_path, "rb") as f:
-            audio_bytes = f.read()
-        os.remove(vid_path)
-        os.remove(aud_path)
-        return audio_bytes
-    except Exception as e:
-        logging.warning(f"extract_audio_from_video_bytes error: {e}")
-        return None
+def count_error(stage: str):
+    """Для стадій, що повідомляють про збій поверненням None, а не винятком."""
+    ERRORS.inc(stage=stage, **current_labels())
 
 
-async def get_instagram_post(user_url: str):
+class TelegramUploadMetrics(BaseRequestMiddleware):
     """
-    Повертає instaloader.Post або None
+    Час відправки медіа в Telegram (усі send_* з файлами) як стадія telegram_upload;
+    решта викликів Bot API — просто спани telegram.<метод> у трасі.
     """
-    try:
-        m = re.search(r"/(p|reel|reels)/([A-Za-z0-9_\-]+)", user_url)
-        if not m:
-            return None
-        shortcode = m.group(2)
 
-        def _load():
-            return instaloader.Post.from_shortcode(INSTA_LOADER.context, shortcode)
+    UPLOAD_METHODS = (SendVideo, SendPhoto, SendAudio, SendDocument, SendMediaGroup)
 
-        post = await asyncio.to_thread(_load)
-        return post
-    except Exception as e:
-        logging.warning(f"get_instagram_post error: {e}")
-        return None
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, self.UPLOAD_METHODS):
+            with span(f"telegram.{method.__api_method__}"):
+                return await make_request(bot, method)
+        with observe_stage("telegram_upload", method=method.__api_method__):
+            return await make_request(bot, method)
 
 
-def chunk_list(lst: List, size: int) -> List[List]:
-    return [lst[i:i + size] for i in range(0, len(lst), size)]
+bot.session.middleware(TelegramUploadMetrics())
 
 
-async def resend_photo_post(message: types.Message, data_id: str, target_lang: str):
-    """Повторно відправляє фото/галерею з описом потрібною мовою,
-    використовуючи вже збережені байти у STORAGE.
+# ---------------------------
+#  HTTP-КЛІЄНТ (спільний пул з'єднань)
+# ---------------------------
+
+class HttpClient:
+    """
+    Одна довгоживуча aiohttp.ClientSession на весь процес.
+    Створюється в main(), закривається при зупинці бота.
+    TCP/TLS-з'єднання та DNS перевикористовуються між запитами.
     """
-    data = STORAGE.get(data_id)
-    if not data:
-        return
 
-    text = data["orig_text"] if target_lang == "orig" else data["trans_text"]
-    caption = format_caption(
-        data["author_name"],
-        data["author_link"],
-        text,
-        data["user_url"],
-    )
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self.counters = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "dns_cache_hits": 0,
+            "dns_cache_misses": 0,
+        }
 
-    photo_bytes = data.get("photo_bytes")
-    gallery_data = data.get("gallery_data") or []
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
 
-    # Якщо одиночне фото
-    if photo_bytes and not gallery_data:
-        await message.answer_photo(
-            BufferedInputFile(photo_bytes, filename="photo.jpg"),
-            caption=caption,
-            parse_mode="HTML",
+        def bump(key):
+            async def _hook(session, ctx, params):
+                self.counters[key] += 1
+            return _hook
+
+        trace.on_request_start.append(bump("requests"))
+        trace.on_connection_create_end.append(bump("connections_created"))
+        trace.on_connection_reuseconn.append(bump("connections_reused"))
+        trace.on_dns_cache_hit.append(bump("dns_cache_hits"))
+        trace.on_dns_cache_miss.append(bump("dns_cache_misses"))
+        return trace
+
+    async def start(self):
+        if self._session and not self._session.closed:
+            return
+        self._connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE,
         )
-        return
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, sock_connect=15),
+            trace_configs=[self._trace_config()],
+        )
+        logging.info(
+            f"HTTP pool started (limit={HTTP_LIMIT}, per_host={HTTP_LIMIT_PER_HOST}, "
+            f"dns_ttl={HTTP_DNS_TTL}s, keepalive={HTTP_KEEPALIVE}s)"
+        )
+        if HTTP_PREWARM:
+            await self.prewarm(HTTP_PREWARM_HOSTS)
 
-    # Якщо галерея / змішане медіа
-    if gallery_data:
-        global_index = 0
-        for chunk in chunk_list(gallery_data, 10):
-            mg = MediaGroupBuilder()
-            first_in_chunk = True
-            for content, ctype in chunk:
-                cap = caption if (global_index == 0 and first_in_chunk) else None
-                if ctype == "video":
-                    mg.add_video(
-                        BufferedInputFile(content, filename="media.mp4"),
-                        caption=cap,
-                        parse_mode="HTML" if cap else None,
-                    )
-                else:
-                    mg.add_photo(
-                        BufferedInputFile(content, filename="photo.jpg"),
-                        caption=cap,
-                        parse_mode="HTML" if cap else None,
-                    )
-                first_in_chunk = False
-                global_index += 1
-            await message.answer_media_group(mg.build())
+    async def prewarm(self, hosts: List[str], timeout: float = 5.0):
+        """Відкриває по одному з'єднанню до основних хостів, щоб перший
+        запит користувача не платив за DNS + TCP + TLS."""
+
+        async def _touch(host: str):
+            try:
+                async with self.session.head(
+                    f"https://{host}/",
+                    allow_redirects=False,
+                    timeout=aiohttp.ClientTimeout(total=timeout),
+                ):
+                    pass
+            except Exception as e:
+                logging.warning(f"prewarm {host} failed: {e}")
+
+        await asyncio.gather(*(_touch(h) for h in hosts))
+        logging.info(f"HTTP pool prewarmed: {', '.join(hosts)}")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("HTTP client is not started")
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+    def stats(self) -> dict:
+        result = dict(self.counters)
+        conn = self._connector
+        if conn is not None:
+            idle = getattr(conn, "_conns", {})
+            result.update(
+                {
+                    "limit": conn.limit,
+                    "limit_per_host": conn.limit_per_host,
+                    "acquired": len(getattr(conn, "_acquired", ())),
+                    "idle": sum(len(v) for v in idle.values()),
+                    "idle_hosts": len(idle),
+                }
+            )
+        return result
 
 
-# -------------------------------------------------
-# ФУНКЦІЯ РОЗГОРТАННЯ
-# -------------------------------------------------
-async def resolve_redirect(url: str) -> str:
+HTTP = HttpClient()
+STATS_PROVIDERS["http"] = HTTP.stats
+
+
+# ---------------------------
+#  СХОВИЩЕ (STORAGE)
+# ---------------------------
+
+class SqliteKV:
     """
-    Розгортає короткі посилання vm.tiktok.com у повні.
-    Використовує User-Agent Facebook, щоб отримати прямий редірект.
+    Мінімальне key-value сховище в SQLite з TTL.
+    Операції дрібні (один рядок за ключем), тож викликаються синхронно.
     """
-    if "vm.tiktok.com" in url or "vt.tiktok.com" in url:
-        try:
-            # Імітуємо бота Facebook (найкраще працює для отримання редіректів)
-            headers = {
-                "User-Agent": "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
-            }
-            async with aiohttp.ClientSession() as session:
-                # allow_redirects=True - aiohttp сам пройде по редіректах
-                async with session.get(url, headers=headers, allow_redirects=True) as resp:
-                    return str(resp.url)
-        except Exception:
-            pass
-    return url
 
+    def __init__(self, path: str, table: str):
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+        )
 
-# -------------------------------------------------
-# PER-SOURCE HANDLERS
-# -------------------------------------------------
+    def get(self, key: str):
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key: str) -> Tuple[Optional[object], Optional[float]]:
+        """(значення, expires_at) або (None, None), якщо ключа нема чи він протух."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None, None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None, None
+        return value, expires_at
+
+    def set(self, key: str, value, ttl: Optional[float] = None, expires_at: Optional[float] = None):
+        if expires_at is None and ttl:
+            expires_at = time.time() + ttl
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def touch(self, key: str, ttl: float):
+        """Продовжує термін життя ключа, не переписуючи значення."""
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET expires_at = ? WHERE key = ?", (time.time() + ttl, key)
+            )
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?",
+                (time.time(),),
+            )
+        return cur.rowcount
 
-async def handle_tiktok(user_url: str):
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _record_size(data: dict) -> int:
+    """Приблизний розмір запису в байтах: медіа + тексти."""
+    size = 64 * len(data)
+    for value in data.values():
+        if isinstance(value, (bytes, bytearray)):
+            size += len(value)
+        elif isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, tuple) and item and isinstance(item[0], (bytes, bytearray)):
+                    size += len(item[0])
+    return size
+
+
+class _StoreEntry:
+    __slots__ = ("data", "nbytes", "expires_at")
+
+    def __init__(self, data: dict, nbytes: int, expires_at: float):
+        self.data = data
+        self.nbytes = nbytes
+        self.expires_at = expires_at
+
+
+class MediaStore:
     """
-    Повертає:
-    author_name, author_link, raw_desc, audio_name, audio_bytes, video_bytes, photo_bytes, gallery_data
+    Обмежене сховище data_id -> запис поста.
+    – ліміт за кількістю записів і за сумарним розміром у байтах
+    – TTL рахується з останнього звернення, тож порядок LRU
+      збігається з порядком завершення TTL
+    – при перевищенні лімітів викидаються найдавніші записи
     """
-    # 1. Розгортаємо посилання
-    full_url = await resolve_redirect(user_url)
-    
-    # Очищуємо URL від зайвих параметрів
-    full_url = full_url.split("?")[0]
 
-    api_url = "https://www.tikwm.com/api/"
-
-    async with aiohttp.ClientSession() as session:
-        # Перша спроба
-        async with session.post(api_url, data={"url": full_url, "hd": 1}) as r:
-            data = await r.json()
-            
-            if "data" not in data:
-                error_msg = data.get("msg", "Unknown error")
-                
-                # Якщо ліміт або помилка парсингу - пауза і повтор
-                if "Url parsing is failed" in error_msg or "Free Api Limit" in error_msg:
-                     logging.warning("First attempt failed, waiting 1.1s and retrying...")
-                     await asyncio.sleep(1.1)  # ПАУЗА 1.1 сек
-                     
-                     # Друга спроба
-                     async with session.post(api_url, data={"url": full_url, "hd": 1}) as r2:
-                         data = await r2.json()
-                         if "data" not in data:
-                             raise Exception(f"TikWM Error: {data.get('msg')}")
-                else:
-                    raise Exception(f"TikWM Error: {error_msg}")
+    def __init__(self, max_bytes: int, max_entries: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _StoreEntry]" = OrderedDict()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, data_id: str) -> bool:
+        return self.get(data_id, count=False) is not None
+
+    def _drop(self, data_id: str) -> Optional[_StoreEntry]:
+        entry = self._entries.pop(data_id, None)
+        if entry is not None:
+            self.bytes_held -= entry.nbytes
+        return entry
+
+    def _expire(self, now: float):
+        while self._entries:
+            data_id, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            self._drop(data_id)
+            self.expirations += 1
+
+    def _evict(self):
+        # Останній (щойно доданий) запис не чіпаємо, навіть якщо він сам більший за ліміт
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self.bytes_held > self.max_bytes
+        ):
+            data_id = next(iter(self._entries))
+            self._drop(data_id)
+            self.evictions += 1
+
+    def get(self, data_id: str, count: bool = True) -> Optional[dict]:
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get(data_id)
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+        entry.expires_at = now + self.ttl
+        self._entries.move_to_end(data_id)
+        if count:
+            self.hits += 1
+        return entry.data
+
+    def put(self, data_id: str, data: dict):
+        now = time.monotonic()
+        self._drop(data_id)
+        nbytes = _record_size(data)
+        self._entries[data_id] = _StoreEntry(data, nbytes, now + self.ttl)
+        self.bytes_held += nbytes
+        self._expire(now)
+        self._evict()
+
+    def update(self, data_id: str, **fields) -> Optional[dict]:
+        """Оновлює поля запису та перераховує його розмір; це теж звернення (TTL, LRU)."""
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get(data_id)
+        if entry is None:
+            return None
+        entry.expires_at = now + self.ttl
+        self._entries.move_to_end(data_id)
+        entry.data.update(fields)
+        nbytes = _record_size(entry.data)
+        self.bytes_held += nbytes - entry.nbytes
+        entry.nbytes = nbytes
+        self._evict()
+        return entry.data
+
+    def pop(self, data_id: str) -> Optional[dict]:
+        entry = self._drop(data_id)
+        return entry.data if entry else None
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes_held": self.bytes_held,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# Поля запису з медіа-байтами: у персистентних бекендах лежать окремо від метаданих
+SINGLE_BLOBS = {"photo_bytes": "photo", "audio_bytes": "audio"}
+BLOB_FIELDS = (*SINGLE_BLOBS, "gallery_data")
+
+
+def split_record(record: dict) -> Tuple[dict, Dict[str, bytes]]:
+    """
+    record -> (meta, blobs).
+    meta серіалізується в JSON; blobs: 'photo', 'audio' і 'g0'..'gN' -> bytes.
+    """
+    meta = {k: v for k, v in record.items() if k not in BLOB_FIELDS}
+    blobs: Dict[str, bytes] = {}
+    for field, name in SINGLE_BLOBS.items():
+        if field in record:
+            meta[f"has_{name}_blob"] = bool(record[field])
+            if record[field]:
+                blobs[name] = record[field]
+    if "gallery_data" in record:
+        gallery = record["gallery_data"] or []
+        meta["gallery_kinds"] = [ctype for _, ctype in gallery]
+        for i, (content, _) in enumerate(gallery):
+            blobs[f"g{i}"] = content
+    return meta, blobs
+
+
+def blob_names(meta: dict) -> List[str]:
+    names = [name for name in SINGLE_BLOBS.values() if meta.get(f"has_{name}_blob")]
+    names += [f"g{i}" for i in range(len(meta.get("gallery_kinds") or []))]
+    return names
+
+
+class StateBackend(ABC):
+    """
+    Сховище записів data_id для кнопок.
+    get() повертає метадані; медіа-байти — окремо через get_blobs(),
+    бо потрібні лише для повторної відправки без file_id.
+    """
+
+    name = "base"
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    async def get(self, data_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def put(self, data_id: str, record: dict):
+        ...
+
+    @abstractmethod
+    async def update(self, data_id: str, **fields) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def get_blobs(self, data_id: str, meta: Optional[dict] = None) -> dict:
+        """Повертає {'photo_bytes', 'audio_bytes', 'gallery_data'} для запису."""
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "hits": self.hits, "misses": self.misses}
+
+
+class KVStateBackend(StateBackend):
+    """
+    Зовнішнє key-value сховище: метадані й медіа-байти — окремими ключами.
+    Нащадки реалізують _get_meta/_set_meta/_get_blob/_set_blob/_del_blob/_touch_blob.
+    """
+
+    @abstractmethod
+    async def _get_meta(self, data_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def _set_meta(self, data_id: str, meta: dict):
+        ...
+
+    @abstractmethod
+    async def _get_blob(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def _set_blob(self, key: str, value: bytes):
+        ...
+
+    @abstractmethod
+    async def _del_blob(self, key: str):
+        ...
+
+    @abstractmethod
+    async def _touch_blob(self, key: str):
+        """Продовжує TTL медіа-ключа до self.ttl."""
+
+    async def get(self, data_id: str) -> Optional[dict]:
+        meta = await self._get_meta(data_id)
+        if meta is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return meta
+
+    async def _write_blobs(self, data_id: str, blobs: Dict[str, bytes]):
+        for name, value in blobs.items():
+            await self._set_blob(f"{data_id}:{name}", value)
+
+    async def put(self, data_id: str, record: dict):
+        meta, blobs = split_record(record)
+        # спершу медіа, потім метадані — щоб ніхто не побачив запис без його байтів
+        await self._write_blobs(data_id, blobs)
+        await self._set_meta(data_id, meta)
+
+    async def update(self, data_id: str, **fields) -> Optional[dict]:
+        meta = await self._get_meta(data_id)
+        if meta is None:
+            return None
+        if any(k in fields for k in BLOB_FIELDS):
+            merged = await self.get_blobs(data_id, meta)
+            for name in blob_names(meta):
+                await self._del_blob(f"{data_id}:{name}")
+            merged.update({k: fields.pop(k) for k in BLOB_FIELDS if k in fields})
+            blob_meta, blobs = split_record(merged)
+            meta.update(blob_meta)
+            await self._write_blobs(data_id, blobs)
+        else:
+            # метадані отримають свіжий TTL — медіа мають жити не менше
+            for name in blob_names(meta):
+                await self._touch_blob(f"{data_id}:{name}")
+        meta.update(fields)
+        await self._set_meta(data_id, meta)
+        return meta
+
+    async def get_blobs(self, data_id: str, meta: Optional[dict] = None) -> dict:
+        meta = meta if meta is not None else await self._get_meta(data_id)
+        result = {field: None for field in SINGLE_BLOBS}
+        result["gallery_data"] = []
+        if not meta:
+            return result
+        for field, name in SINGLE_BLOBS.items():
+            if meta.get(f"has_{name}_blob"):
+                result[field] = await self._get_blob(f"{data_id}:{name}")
+        for i, ctype in enumerate(meta.get("gallery_kinds") or []):
+            content = await self._get_blob(f"{data_id}:g{i}")
+            if content:
+                result["gallery_data"].append((content, ctype))
+        return result
+
+
+class MemoryStateBackend(StateBackend):
+    """Пам'ять процесу (MediaStore): найшвидше, але живе до рестарту."""
+
+    name = "memory"
+
+    def __init__(self, store: MediaStore):
+        super().__init__(store.ttl)
+        self.store = store
+
+    async def get(self, data_id: str) -> Optional[dict]:
+        return self.store.get(data_id)
+
+    async def put(self, data_id: str, record: dict):
+        self.store.put(data_id, record)
+
+    async def update(self, data_id: str, **fields) -> Optional[dict]:
+        return self.store.update(data_id, **fields)
+
+    async def get_blobs(self, data_id: str, meta: Optional[dict] = None) -> dict:
+        data = meta if meta is not None else self.store.get(data_id, count=False)
+        data = data or {}
+        result = {field: data.get(field) for field in SINGLE_BLOBS}
+        result["gallery_data"] = data.get("gallery_data") or []
+        return result
+
+    def stats(self) -> dict:
+        return {"backend": self.name, **self.store.stats()}
+
+
+class SqliteStateBackend(KVStateBackend):
+    """Локальний SQLite-файл: переживає рестарт, спільний для процесів на одній машині."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, ttl: float):
+        super().__init__(ttl)
+        self.meta = SqliteKV(path, "state_meta")
+        self.blobs = SqliteKV(path, "state_blobs")
+        self._last_purge = 0.0
+
+    async def _purge(self):
+        now = time.monotonic()
+        if now - self._last_purge < 600:
+            return
+        self._last_purge = now
+        purged = await asyncio.to_thread(self.meta.purge_expired)
+        purged += await asyncio.to_thread(self.blobs.purge_expired)
+        if purged:
+            logging.info(f"STATE sqlite: purged {purged} expired rows")
+
+    async def _get_meta(self, data_id: str) -> Optional[dict]:
+        raw = await asyncio.to_thread(self.meta.get, data_id)
+        return json.loads(raw) if raw is not None else None
+
+    async def _set_meta(self, data_id: str, meta: dict):
+        raw = json.dumps(meta, ensure_ascii=False)
+        await asyncio.to_thread(self.meta.set, data_id, raw, self.ttl)
+        await self._purge()
+
+    async def _get_blob(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self.blobs.get, key)
+
+    async def _set_blob(self, key: str, value: bytes):
+        await asyncio.to_thread(self.blobs.set, key, value, self.ttl)
+
+    async def _del_blob(self, key: str):
+        await asyncio.to_thread(self.blobs.delete, key)
+
+    async def _touch_blob(self, key: str):
+        await asyncio.to_thread(self.blobs.touch, key, self.ttl)
+
+    async def close(self):
+        self.meta.close()
+        self.blobs.close()
+
+
+class RedisStateBackend(KVStateBackend):
+    """
+    Redis (або сумісний: KeyDB, Dragonfly, Valkey) — спільний стан для
+    кількох процесів/машин. Потрібен пакет `redis` (pip install redis).
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str, ttl: float):
+        super().__init__(ttl)
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis потребує пакет redis: pip install redis")
+        self.prefix = prefix
+        self.client = aioredis.from_url(url)
+
+    async def _get_meta(self, data_id: str) -> Optional[dict]:
+        raw = await self.client.get(f"{self.prefix}meta:{data_id}")
+        return json.loads(raw) if raw is not None else None
+
+    async def _set_meta(self, data_id: str, meta: dict):
+        raw = json.dumps(meta, ensure_ascii=False)
+        await self.client.set(f"{self.prefix}meta:{data_id}", raw, ex=int(self.ttl))
+
+    async def _get_blob(self, key: str) -> Optional[bytes]:
+        return await self.client.get(f"{self.prefix}blob:{key}")
+
+    async def _set_blob(self, key: str, value: bytes):
+        await self.client.set(f"{self.prefix}blob:{key}", value, ex=int(self.ttl))
+
+    async def _del_blob(self, key: str):
+        await self.client.delete(f"{self.prefix}blob:{key}")
+
+    async def _touch_blob(self, key: str):
+        await self.client.expire(f"{self.prefix}blob:{key}", int(self.ttl))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def make_state_backend() -> StateBackend:
+    if STATE_BACKEND == "sqlite":
+        logging.info(f"STATE backend: sqlite ({STATE_SQLITE_PATH})")
+        return SqliteStateBackend(STATE_SQLITE_PATH, STORAGE_TTL)
+    if STATE_BACKEND == "redis":
+        logging.info(f"STATE backend: redis ({STATE_REDIS_PREFIX}*)")
+        return RedisStateBackend(STATE_REDIS_URL, STATE_REDIS_PREFIX, STORAGE_TTL)
+    return MemoryStateBackend(
+        MediaStore(STORAGE_MAX_BYTES, STORAGE_MAX_ENTRIES, STORAGE_TTL)
+    )
+
+
+STORAGE = make_state_backend()
+STATS_PROVIDERS["storage"] = STORAGE.stats
+
+
+# ---------------------------
+#  КЕШ FILE_ID
+# ---------------------------
+
+# Медіа: або сирі байти, або file_id, який Telegram уже має
+Media = Union[bytes, str]
+
+POST_KEY_PATTERNS = [
+    ("tiktok", re.compile(r"tiktok\.com/.*?/(?:video|photo)/(\d+)")),
+    ("twitter", re.compile(r"(?:twitter|x)\.com/.*?/status/(\d+)")),
+    ("instagram", re.compile(r"instagram\.com/(?:.*?/)?(?:p|reel|reels)/([A-Za-z0-9_\-]+)")),
+]
+
+
+def canonical_post_key(url: str) -> Optional[str]:
+    """
+    'tiktok:<id>' / 'twitter:<id>' / 'instagram:<shortcode>' — однаковий для
+    всіх варіантів одного посилання (www, ?utm, x.com vs twitter.com).
+    Короткі vm.tiktok.com треба розгорнути заздалегідь.
+    """
+    if not url:
+        return None
+    for platform, pattern in POST_KEY_PATTERNS:
+        m = pattern.search(url)
+        if m:
+            return f"{platform}:{m.group(1)}"
+    return None
+
+
+def file_cache_has_media(entry: dict) -> bool:
+    return bool(entry.get("video") or entry.get("photo") or entry.get("gallery"))
+
+
+class FileIdCache:
+    """
+    canonical_post_key -> {метадані поста + file_id відео/фото/галереї/аудіо}.
+    Пам'ять (LRU) спереду, SQLite (необов'язково) — щоб пережити рестарт.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()
+        self._db = SqliteKV(db_path, "file_ids") if db_path else None
+        if self._db:
+            purged = self._db.purge_expired()
+            logging.info(f"FILE_ID_CACHE: SQLite {db_path} (purged {purged} expired)")
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, entry: dict, expires_at: float):
+        self._mem[key] = (entry, expires_at)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _lookup(self, key: str) -> Tuple[Optional[dict], float]:
+        """(запис, expires_at); термін життя — той, що записано разом із рядком."""
+        now = time.time()
+        item = self._mem.get(key)
+        if item is not None:
+            entry, expires_at = item
+            if expires_at > now:
+                self._mem.move_to_end(key)
+                return entry, expires_at
+            del self._mem[key]
+        if self._db:
+            raw, expires_at = self._db.get_with_expiry(key)
+            if raw is not None:
+                entry = json.loads(raw)
+                expires_at = expires_at if expires_at is not None else now + self.ttl
+                self._remember(key, entry, expires_at)
+                return entry, expires_at
+        return None, 0.0
+
+    def get(self, key: str) -> Optional[dict]:
+        entry, _ = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def merge(self, key: str, defaults: Optional[dict] = None, **fields):
+        """
+        Доповнює запис новими file_id (напр. аудіо після кнопки 🎵).
+        defaults — поля лише для нового запису (існуючі не перезаписують).
+        Термін життя існуючого запису не продовжується — рахується від першої відправки.
+        """
+        existing, expires_at = self._lookup(key)
+        entry = dict(existing if existing is not None else defaults or {})
+        entry.update({k: v for k, v in fields.items() if v is not None})
+        if existing is None:
+            expires_at = time.time() + self.ttl
+        self._remember(key, entry, expires_at)
+        if self._db:
+            try:
+                self._db.set(key, json.dumps(entry, ensure_ascii=False), expires_at=expires_at)
+            except Exception as e:
+                logging.warning(f"FILE_ID_CACHE write error: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._mem),
+            "persistent": bool(self._db),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+FILE_ID_CACHE = FileIdCache(FILE_ID_CACHE_MAX, FILE_ID_CACHE_TTL, FILE_ID_CACHE_DB)
+STATS_PROVIDERS["file_id_cache"] = FILE_ID_CACHE.stats
+
+
+# ---------------------------
+#  ДОПОМІЖНІ ФУНКЦІЇ
+# ---------------------------
+
+def sanitize_filename(name: str) -> str:
+    if not name:
+        return "audio"
+    name = re.sub(r'[\\/*?:"<>|]', "", str(name))
+    name = name.replace("\n", " ").strip()
+    return name[:50]
+
+
+def parse_message_data(text: Optional[str]):
+    """
+    Повертає: url, clean_mode, audio_mode
+    """
+    if not text:
+        return None, False, False
+    url_match = re.search(r"(https?://[^\s]+)", text)
+    if not url_match:
+        return None, False, False
+
+    found_url = url_match.group(1)
+
+    cmd_text = text.replace(found_url, "").lower()
+
+    clean_mode = (
+        "-" in cmd_text or "!" in cmd_text or "clear" in cmd_text or "чисто" in cmd_text
+    )
+    audio_mode = ("!a" in cmd_text) or ("audio" in cmd_text) or ("аудіо" in cmd_text)
+
+    return found_url, clean_mode, audio_mode
+
+
+async def download_content(url: str) -> Optional[bytes]:
+    if not url:
+        return None
+    try:
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0 Safari/537.36"
+        }
+        async with HTTP.session.get(url, headers=headers) as resp:
+            if resp.status == 200:
+                return await resp.read()
+    except Exception as e:
+        logging.warning(f"download_content error: {e}")
+    return None
+
+
+class TranslationCache:
+    """
+    Кеш визначеної мови та перекладів за хешем нормалізованого тексту.
+    Ключі: 'lang:<hash>' -> код мови, 'tr:<мова>:<hash>' -> переклад.
+    LRU у пам'яті + (необов'язково) SQLite, щоб пережити рестарт.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, str]" = OrderedDict()
+        self._db = SqliteKV(db_path, "translations") if db_path else None
+        if self._db:
+            self._db.purge_expired()
+        self.counters = {"lang_hits": 0, "lang_misses": 0, "tr_hits": 0, "tr_misses": 0}
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+    def _get(self, key: str) -> Optional[str]:
+        value = self._mem.get(key)
+        if value is not None:
+            self._mem.move_to_end(key)
+            return value
+        if self._db:
+            value = self._db.get(key)
+            if value is not None:
+                self._remember(key, value)
+        return value
+
+    def _remember(self, key: str, value: str):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _set(self, key: str, value: str):
+        self._remember(key, value)
+        if self._db:
+            try:
+                self._db.set(key, value, self.ttl)
+            except Exception as e:
+                logging.warning(f"TRANSLATION_CACHE write error: {e}")
+
+    def _count(self, kind: str, hit: bool):
+        self.counters[f"{kind}_{'hits' if hit else 'misses'}"] += 1
+
+    def get_lang(self, text: str) -> Optional[str]:
+        value = self._get(f"lang:{self.text_hash(text)}")
+        self._count("lang", value is not None)
+        return value
+
+    def set_lang(self, text: str, lang: str):
+        self._set(f"lang:{self.text_hash(text)}", lang)
+
+    def get_translation(self, text: str, target: str) -> Optional[str]:
+        value = self._get(f"tr:{target}:{self.text_hash(text)}")
+        self._count("tr", value is not None)
+        return value
+
+    def set_translation(self, text: str, target: str, translated: str):
+        self._set(f"tr:{target}:{self.text_hash(text)}", translated)
+
+    def stats(self) -> dict:
+        c = self.counters
+        lookups = sum(c.values())
+        return {
+            "entries": len(self._mem),
+            "persistent": bool(self._db),
+            **c,
+            "hit_rate": round((c["lang_hits"] + c["tr_hits"]) / lookups, 3) if lookups else 0.0,
+        }
+
+
+TRANSLATIONS = TranslationCache(
+    TRANSLATION_CACHE_MAX, TRANSLATION_CACHE_TTL, TRANSLATION_CACHE_DB
+)
+STATS_PROVIDERS["translation_cache"] = TRANSLATIONS.stats
+
+
+# -------------------------------------------------
+# ВИЗНАЧЕННЯ МОВИ
+# -------------------------------------------------
+
+DETECT_NOISE_RE = re.compile(r"https?://\S+|www\.\S+|[#@][\w.]+")
+
+# Діапазони письмових систем, за якими мова зрозуміла без langdetect
+SCRIPT_RANGES = [
+    ("cyrillic", 0x0400, 0x04FF),
+    ("greek", 0x0370, 0x03FF),
+    ("hebrew", 0x0590, 0x05FF),
+    ("arabic", 0x0600, 0x06FF),
+    ("thai", 0x0E00, 0x0E7F),
+    ("hangul", 0xAC00, 0xD7AF),
+    ("kana", 0x3040, 0x30FF),
+    ("han", 0x4E00, 0x9FFF),
+]
+SCRIPT_LANGS = {
+    "greek": "el",
+    "hebrew": "he",
+    "arabic": "ar",
+    "thai": "th",
+    "hangul": "ko",
+    "kana": "ja",
+    "han": "zh-cn",
+}
+UK_ONLY_LETTERS = set("іїєґІЇЄҐ")
+# ъ не беремо: у болгарській це звичайна голосна
+RU_ONLY_LETTERS = set("ыэёЫЭЁ")
+# Літери інших кириличних абеток (сербська, македонська, білоруська, казахська...)
+OTHER_CYRILLIC_LETTERS = set("ђјљњћџѓќѕўәғқңөұүһҗҳӣӯЂЈЉЊЋЏЃЌЅЎӘҒҚҢӨҰҮҺҖҲӢӮ")
+
+# 'und' — у тексті нема що перекладати (самі хештеги, емодзі, посилання)
+LANG_UNDETERMINED = "und"
+
+DETECT_STATS = {"heuristic": 0, "detector": 0, "undetermined": 0, "errors": 0}
+STATS_PROVIDERS["language_detect"] = lambda: dict(DETECT_STATS)
+
+
+def strip_detection_noise(text: str) -> str:
+    return DETECT_NOISE_RE.sub(" ", text)
+
+
+def script_of(ch: str) -> Optional[str]:
+    code = ord(ch)
+    for name, lo, hi in SCRIPT_RANGES:
+        if lo <= code <= hi:
+            return name
+    return "latin" if ch.isascii() or code < 0x0250 else None
+
+
+def quick_detect(text: str) -> Optional[str]:
+    """
+    Дешевий детермінований шлях: за письмом і характерними літерами.
+    Повертає код мови, LANG_UNDETERMINED або None (тоді — langdetect).
+    """
+    letters = [ch for ch in text if ch.isalpha()]
+    if not letters:
+        return LANG_UNDETERMINED
+
+    counts: Dict[str, int] = {}
+    for ch in letters:
+        script = script_of(ch)
+        counts[script] = counts.get(script, 0) + 1
+    # Японська пише кандзі разом із каною, корейська інколи — ханчею:
+    # ієрогліфи рахуємо за письмом, з яким вони трапились
+    if "kana" in counts:
+        counts["kana"] += counts.pop("han", 0)
+    elif "hangul" in counts:
+        counts["hangul"] += counts.pop("han", 0)
+    script, count = max(counts.items(), key=lambda item: item[1])
+    if count / len(letters) < 0.9:
+        return None  # змішаний текст
+
+    if script == "cyrillic":
+        # Лише однозначні випадки; решту кирилиці (болгарська, сербська, ...) — langdetect
+        if any(ch in OTHER_CYRILLIC_LETTERS for ch in letters):
+            return None
+        has_uk = any(ch in UK_ONLY_LETTERS for ch in letters)
+        has_ru = any(ch in RU_ONLY_LETTERS for ch in letters)
+        if has_uk and not has_ru:
+            return "uk"
+        if has_ru and not has_uk:
+            return "ru"
+        return None
+    return SCRIPT_LANGS.get(script)
+
+
+async def detect_language(text: str) -> str:
+    """
+    Спершу прибираємо хештеги/згадки/посилання, далі — quick_detect,
+    і лише неоднозначний текст віддаємо langdetect (у потоці, не в event loop).
+    """
+    cleaned = strip_detection_noise(text)
+    lang = quick_detect(cleaned)
+    if lang == LANG_UNDETERMINED:
+        DETECT_STATS["undetermined"] += 1
+        return lang
+    if lang:
+        DETECT_STATS["heuristic"] += 1
+        return lang
+    DETECT_STATS["detector"] += 1
+    try:
+        return await asyncio.to_thread(detect, cleaned)
+    except Exception as e:
+        DETECT_STATS["errors"] += 1
+        logging.warning(f"detect_language error: {e}")
+        return LANG_UNDETERMINED
+
+
+async def prepare_texts(text: str):
+    """
+    Повертає: (orig_text, has_diff)
+    Лише визначає мову — сам переклад робиться на вимогу (translate_text).
+    has_diff = True, якщо мова не українська (тоді показуємо кнопку 🇺🇦).
+    """
+    if not text:
+        return "", False
+    try:
+        lang = TRANSLATIONS.get_lang(text)
+        if lang is None:
+            with observe_stage("lang_detect"):
+                lang = await detect_language(text)
+            TRANSLATIONS.set_lang(text, lang)
+        return text, lang not in ("uk", LANG_UNDETERMINED)
+    except Exception as e:
+        logging.warning(f"prepare_texts error: {e}")
+        return text, False
+
+
+class GoogleWebTranslator:
+    """
+    Неофіційний веб-ендпоінт Google Translate через спільний HTTP-пул.
+    translate_a/t приймає кілька q за раз; якщо відповідь не схожа на
+    пакетну — перекладаємо поштучно через translate_a/single.
+    """
+
+    name = "google"
+    BATCH_URL = "https://translate.googleapis.com/translate_a/t"
+    SINGLE_URL = "https://translate.googleapis.com/translate_a/single"
+
+    @staticmethod
+    def _parse_batch(data, count: int) -> Optional[List[str]]:
+        if count == 1 and not (isinstance(data, list) and len(data) == 1):
+            data = [data]
+        if not isinstance(data, list) or len(data) != count:
+            return None
+        result = []
+        for item in data:
+            if isinstance(item, str):
+                result.append(item)
+            elif isinstance(item, list) and item and isinstance(item[0], str):
+                result.append(item[0])
+            else:
+                return None
+        return result
+
+    async def _translate_one(self, text: str, target: str) -> str:
+        params = {"client": "gtx", "sl": "auto", "tl": target, "dt": "t", "q": text}
+        async with HTTP.session.get(self.SINGLE_URL, params=params) as r:
+            if r.status != 200:
+                raise Exception(f"Google Translate error, status={r.status}")
+            data = await r.json(content_type=None)
+        return "".join(seg[0] for seg in data[0] if seg and seg[0])
+
+    async def translate_batch(self, texts: List[str], target: str) -> List[str]:
+        form = [("q", t) for t in texts]
+        params = {"client": "gtx", "sl": "auto", "tl": target}
+        try:
+            async with HTTP.session.post(self.BATCH_URL, params=params, data=form) as r:
+                if r.status == 200:
+                    parsed = self._parse_batch(await r.json(content_type=None), len(texts))
+                    if parsed is not None:
+                        return parsed
+        except Exception as e:
+            logging.warning(f"batch translate failed, falling back to single: {e}")
+        return list(await asyncio.gather(*(self._translate_one(t, target) for t in texts)))
+
+
+class LocalTranslator:
+    """Локальна заглушка: без мережі, детермінована. Для тестів і розробки."""
+
+    name = "local"
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.calls = 0
+
+    async def translate_batch(self, texts: List[str], target: str) -> List[str]:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return [f"[{target}] {t}" for t in texts]
+
+
+class TranslationService:
+    """
+    Асинхронний перекладач з мікро-пакетами: запити, що прийшли протягом
+    `window` секунд, ідуть одним викликом бекенду (до `batch_max` текстів).
+    Кожен виклик translate() отримує свій future; паралельних пакетів —
+    не більше `concurrency`.
+    """
+
+    def __init__(self, backend, window: float, batch_max: int, concurrency: int):
+        self.backend = backend
+        self.window = window
+        self.batch_max = batch_max
+        self.concurrency = concurrency
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._pending: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self.counters = {"requests": 0, "batches": 0, "texts_sent": 0, "errors": 0}
+
+    async def translate(self, text: str, target: str = "uk") -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._pending.setdefault(target, [])
+        queue.append((text, future))
+        self.counters["requests"] += 1
+        if len(queue) >= self.batch_max:
+            self._flush(target)
+        elif target not in self._timers:
+            self._timers[target] = loop.call_later(self.window, self._flush, target)
+        return await future
+
+    def _flush(self, target: str):
+        timer = self._timers.pop(target, None)
+        if timer:
+            timer.cancel()
+        batch = self._pending.pop(target, [])
+        if batch:
+            spawn(self._run_batch(target, batch))
+
+    async def _run_batch(self, target: str, batch: List[Tuple[str, asyncio.Future]]):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        texts = list(dict.fromkeys(text for text, _ in batch))  # без дублікатів
+        async with self._sem:
+            self.counters["batches"] += 1
+            self.counters["texts_sent"] += len(texts)
+            try:
+                translated = dict(zip(texts, await self.backend.translate_batch(texts, target)))
+            except Exception as e:
+                self.counters["errors"] += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        for text, future in batch:
+            if not future.done():
+                future.set_result(translated.get(text, text))
+
+    def stats(self) -> dict:
+        c = self.counters
+        return {
+            "backend": self.backend.name,
+            **c,
+            "avg_batch_size": round(c["texts_sent"] / c["batches"], 2) if c["batches"] else 0.0,
+        }
+
+
+TRANSLATOR = TranslationService(
+    LocalTranslator() if TRANSLATE_BACKEND == "local" else GoogleWebTranslator(),
+    TRANSLATE_BATCH_WINDOW,
+    TRANSLATE_BATCH_MAX,
+    TRANSLATE_CONCURRENCY,
+)
+STATS_PROVIDERS["translator"] = TRANSLATOR.stats
+
+
+async def translate_text(text: str, target: str = "uk") -> Optional[str]:
+    """Переклад через кеш; при помилці — None (нічого не кешуємо, наступний виклик спробує знову)."""
+    if not text:
+        return ""
+    trans = TRANSLATIONS.get_translation(text, target)
+    if trans is not None:
+        return trans
+    try:
+        with observe_stage("translation"):
+            trans = await TRANSLATOR.translate(text, target)
+    except Exception as e:
+        logging.warning(f"translate_text error: {e}")
+        return None
+    if not trans:
+        return None
+    TRANSLATIONS.set_translation(text, target, trans)
+    return trans
+
+
+async def record_text(data_id: str, data: dict, target_lang: str) -> str:
+    """Текст запису потрібною мовою; переклад рахуємо при першому запиті і зберігаємо."""
+    if target_lang == "orig" or not data.get("has_diff"):
+        return data["orig_text"]
+    if data.get("trans_text") is None:
+        trans = await translate_text(data["orig_text"])
+        if trans is None:
+            # перекладач недоступний — показуємо оригінал, але не запам'ятовуємо його як переклад
+            return data["orig_text"]
+        await STORAGE.update(data_id, trans_text=trans)
+        data["trans_text"] = trans
+    return data["trans_text"]
+
+
+BACKGROUND_TASKS = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """create_task, який тримає посилання на задачу до її завершення."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+async def prefetch_translation(data_id: str):
+    data = await STORAGE.get(data_id)
+    if data:
+        await record_text(data_id, data, "trans")
+
+
+def format_caption(author_name: str, author_url: str, text: str, original_url: str):
+    caption = f"👤 <a href='{author_url}'><b>{author_name}</b></a>\n\n"
+    if text:
+        caption += f"📝 {text}\n\n"
+    caption += f"🔗 <a href='{original_url}'>Оригінал</a>"
+    return caption[:1024]
+
+
+def mp4_is_faststart(data: bytes) -> bool:
+    """
+    True, якщо moov-атом MP4 стоїть перед mdat. Лише такий файл ffmpeg
+    прочитає з pipe; інакше йому потрібен seek і вхід має бути файлом.
+    """
+    pos = 0
+    while pos + 8 <= len(data):
+        size = int.from_bytes(data[pos:pos + 4], "big")
+        box = data[pos + 4:pos + 8]
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1 and pos + 16 <= len(data):
+            size = int.from_bytes(data[pos + 8:pos + 16], "big")
+        if size < 8:
+            break
+        pos += size
+    return True  # не MP4 / не розібрали — хай ffmpeg пробує з pipe
+
+
+async def run_ffmpeg(args: List[str], input_bytes: Optional[bytes]) -> Optional[bytes]:
+    """
+    Запускає ffmpeg асинхронно: вхід через stdin, результат зі stdout.
+    При таймауті чи скасуванні процес гарантовано вбивається.
+    Ненульовий код — None; чи це помилка, вирішує той, хто викликає.
+    """
+    with observe_stage("ffmpeg"):
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", *args,
+            stdin=asyncio.subprocess.PIPE if input_bytes is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(input_bytes), FFMPEG_TIMEOUT)
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    if proc.returncode != 0:
+        logging.warning(f"ffmpeg exited {proc.returncode}: {err.decode(errors='ignore')[-300:]}")
+        return None
+    return out or None
+
+
+async def _extract_audio_from(src: str, input_bytes: Optional[bytes]) -> Optional[Tuple[bytes, str]]:
+    if AUDIO_PREFER_M4A:
+        # Без перекодування; fragmented MP4, бо stdout не підтримує seek
+        out = await run_ffmpeg(
+            [
+                "-i", src, "-vn", "-map", "0:a:0", "-c:a", "copy",
+                "-f", "ipod", "-movflags", "+frag_keyframe+empty_moov", "pipe:1",
+            ],
+            input_bytes,
+        )
+        if out:
+            return out, "m4a"
+        # очікувано для opus/vorbis: їх не покласти в m4a без перекодування — не помилка
+    out = await run_ffmpeg(
+        [
+            "-i", src, "-vn", "-map", "0:a:0", "-c:a", "libmp3lame", "-q:a", "2",
+            "-f", "mp3", "pipe:1",
+        ],
+        input_bytes,
+    )
+    if out:
+        return out, "mp3"
+    count_error("ffmpeg")
+    return None
+
+
+async def extract_audio(video_bytes: bytes) -> Optional[Tuple[bytes, str]]:
+    """
+    Витягує аудіо з відео. Повертає (audio_bytes, 'm4a'|'mp3') або None.
+    Нічого не пише в робочу директорію: відео йде в ffmpeg через stdin,
+    а якщо MP4 не «faststart» — через тимчасовий файл у системному tmp.
+    """
+    try:
+        if mp4_is_faststart(video_bytes):
+            return await _extract_audio_from("pipe:0", video_bytes)
+
+        with tempfile.TemporaryDirectory(prefix="tgbot_audio_") as tmp:
+            src = os.path.join(tmp, "input.mp4")
+            await asyncio.to_thread(Path(src).write_bytes, video_bytes)
+            return await _extract_audio_from(src, None)
+    except asyncio.TimeoutError:
+        logging.warning("extract_audio: ffmpeg timeout")
+    except Exception as e:
+        logging.warning(f"extract_audio error: {e}")
+    return None
+
+
+class PoolBusy(Exception):
+    """Черга пулу обробки медіа заповнена — запит відхилено."""
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class MediaPool:
+    """
+    Обмежений пул для важкої обробки медіа (ffmpeg).
+    Не більше `workers` задач одночасно, не більше `queue_max` у черзі;
+    решту відхиляємо з PoolBusy, щоб сплеск запитів не з'їв усі ядра.
+    """
+
+    def __init__(self, workers: int, queue_max: int, job_timeout: float):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.job_timeout = job_timeout
+        self._sem = asyncio.Semaphore(workers)
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.durations = deque(maxlen=500)
+        self.wait_times = deque(maxlen=500)
+
+    async def run(
+        self,
+        factory: Callable[[], Awaitable],
+        on_queued: Optional[Callable[[int], Awaitable]] = None,
+    ):
+        """
+        Виконує factory() у пулі. Якщо всі воркери зайняті — ставить у чергу
+        і викликає on_queued(позиція); якщо черга повна — PoolBusy.
+        """
+        queued = self._sem.locked()
+        if queued and self.waiting >= self.queue_max:
+            self.rejected += 1
+            raise PoolBusy()
+
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            if queued and on_queued:
+                await on_queued(self.waiting)
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+
+        started = time.monotonic()
+        self.wait_times.append(started - queued_at)
+        self.active += 1
+        try:
+            result = await asyncio.wait_for(factory(), self.job_timeout)
+            self.completed += 1
+            return result
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+            self._sem.release()
+            self.durations.append(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "queue_max": self.queue_max,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "job_seconds_p50": round(percentile(self.durations, 0.5), 3),
+            "job_seconds_p95": round(percentile(self.durations, 0.95), 3),
+            "wait_seconds_p95": round(percentile(self.wait_times, 0.95), 3),
+        }
+
+
+MEDIA_POOL = MediaPool(MEDIA_WORKERS, MEDIA_QUEUE_MAX, MEDIA_JOB_TIMEOUT)
+STATS_PROVIDERS["media_pool"] = MEDIA_POOL.stats
+
+
+async def extract_audio_pooled(
+    message: types.Message, video_bytes: bytes
+) -> Optional[Tuple[bytes, str]]:
+    """
+    extract_audio через MEDIA_POOL: якщо довелося стати в чергу — показуємо
+    позицію. Якщо черга переповнена — PoolBusy летить далі до виклику.
+    """
+    queue_msg = None
+
+    async def on_queued(position: int):
+        nonlocal queue_msg
+        try:
+            queue_msg = await message.answer(
+                f"⏳ Зараз багато запитів, ви в черзі на позиції {position}..."
+            )
+        except Exception as e:
+            logging.warning(f"queue notice error: {e}")
+
+    try:
+        return await MEDIA_POOL.run(lambda: extract_audio(video_bytes), on_queued)
+    except asyncio.TimeoutError:
+        logging.warning("extract_audio: media job timeout")
+    finally:
+        if queue_msg:
+            try:
+                await queue_msg.delete()
+            except Exception:
+                pass
+    return None
+
+
+def with_extension(filename: str, ext: str) -> str:
+    return f"{os.path.splitext(filename)[0]}.{ext}"
+
+
+# -------------------------------------------------
+# INSTAGRAM: окремий пул потоків, кеш метаданих, cool-down
+# -------------------------------------------------
+
+class InstagramCooldown(Exception):
+    """Instagram нещодавно відповів 429 / «please wait» — не стукаємо, поки не мине пауза."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"instagram cool-down, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class InstaRateController(instaloader.RateController):
+    """
+    Стандартний RateController на 429 засинає в потоці на хвилини.
+    Для бота краще одразу впасти: паузу рахує InstagramClient для всіх запитів.
+    """
+
+    def handle_429(self, query_type: str) -> None:
+        raise instaloader.exceptions.TooManyRequestsException(f"429 Too Many Requests ({query_type})")
+
+    def sleep(self, secs: float):
+        if secs > INSTA_MAX_SLEEP:
+            raise instaloader.exceptions.TooManyRequestsException(
+                f"rate controller asked to wait {secs:.0f}s"
+            )
+        super().sleep(secs)
+
+
+INSTA_LOADER = instaloader.Instaloader(
+    quiet=True, rate_controller=lambda ctx: InstaRateController(ctx)
+)
+INSTA_LOADER.context._user_agent = "Instagram 269.0.0.18.75 Android"
+
+INSTA_SHORTCODE_RE = re.compile(r"/(p|reel|reels)/([A-Za-z0-9_\-]+)")
+
+
+class InstagramClient:
+    """
+    Усі виклики Instaloader — у власному обмеженому пулі потоків,
+    щоб повільний Instagram не займав потоки перекладача й ffmpeg.
+    Метадані поста (автор, підпис, тип, URL медіа) кешуються за shortcode,
+    поки не спливуть посилання CDN.
+    """
+
+    def __init__(self, loader, workers: int, max_queue: int, max_entries: int, ttl: float, cooldown: float):
+        self.loader = loader
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="instaloader")
+        self.max_queue = max_queue
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cooldown = cooldown
+        self.pending = 0
+        self.cooldown_until = 0.0
+        self._meta: "OrderedDict[str, dict]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "errors": 0, "rate_limited": 0, "cooldown_rejects": 0, "rejected": 0}
+
+    @staticmethod
+    def is_rate_limited(exc: Exception) -> bool:
+        if isinstance(exc, instaloader.exceptions.TooManyRequestsException):
+            return True
+        text = str(exc).lower()
+        return "429" in text or "please wait" in text
+
+    @staticmethod
+    def url_expiry(url: Optional[str]) -> Optional[float]:
+        """Посилання CDN Instagram несуть час завершення в параметрі oe (unix time, hex)."""
+        if not url:
+            return None
+        try:
+            return float(int(parse_qs(urlparse(url).query)["oe"][0], 16))
+        except (KeyError, ValueError, IndexError):
+            return None
+
+    def cooldown_left(self) -> float:
+        return max(0.0, self.cooldown_until - time.monotonic())
+
+    def _cached(self, shortcode: str) -> Optional[dict]:
+        meta = self._meta.get(shortcode)
+        if meta is None:
+            return None
+        if meta["expires_at"] <= time.time():
+            del self._meta[shortcode]
+            return None
+        self._meta.move_to_end(shortcode)
+        return meta
+
+    def _remember(self, shortcode: str, meta: dict):
+        expiries = [self.url_expiry(meta["url"])]
+        expiries += [self.url_expiry(node["url"]) for node in meta["nodes"]]
+        # хвилина запасу, щоб не віддати посилання, яке згасне посеред завантаження
+        expires_at = min([time.time() + self.ttl] + [e - 60 for e in expiries if e])
+        meta["expires_at"] = expires_at
+        self._meta[shortcode] = meta
+        self._meta.move_to_end(shortcode)
+        while len(self._meta) > self.max_entries:
+            self._meta.popitem(last=False)
+
+    def _load(self, shortcode: str) -> dict:
+        # Виконується в потоці пулу: усі властивості Post можуть ходити в мережу
+        post = instaloader.Post.from_shortcode(self.loader.context, shortcode)
+        nodes = []
+        if post.typename == "GraphSidecar":
+            for node in post.get_sidecar_nodes():
+                nodes.append({
+                    "url": node.video_url if node.is_video else node.display_url,
+                    "type": "video" if node.is_video else "photo",
+                })
+        return {
+            "shortcode": shortcode,
+            "owner": post.owner_username,
+            "caption": post.caption or "",
+            "typename": post.typename,
+            "is_video": post.is_video,
+            "url": post.video_url if post.is_video else post.url,
+            "nodes": nodes,
+        }
+
+    async def get(self, shortcode: str) -> dict:
+        meta = self._cached(shortcode)
+        if meta is not None:
+            self.counters["hits"] += 1
+            return meta
+        self.counters["misses"] += 1
+
+        left = self.cooldown_left()
+        if left:
+            self.counters["cooldown_rejects"] += 1
+            raise InstagramCooldown(left)
+        if self.pending >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise RateLimitBusy(self.pending + 1, "Instagram")
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with observe_stage("provider"):
+                meta = await loop.run_in_executor(self.executor, self._load, shortcode)
+        except Exception as e:
+            self.counters["errors"] += 1
+            if self.is_rate_limited(e):
+                self.counters["rate_limited"] += 1
+                self.cooldown_until = time.monotonic() + self.cooldown
+                logging.warning(f"Instagram rate limit ({e}); cool-down {self.cooldown}s")
+                raise InstagramCooldown(self.cooldown) from e
+            raise
+        finally:
+            self.pending -= 1
+        self._remember(shortcode, meta)
+        return meta
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "cached": len(self._meta),
+            "pending": self.pending,
+            "cooldown_left": round(self.cooldown_left(), 1),
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+INSTAGRAM = InstagramClient(
+    INSTA_LOADER, INSTA_WORKERS, INSTA_MAX_QUEUE, INSTA_META_MAX, INSTA_META_TTL, INSTA_COOLDOWN
+)
+STATS_PROVIDERS["instagram"] = INSTAGRAM.stats
+
+
+async def get_instagram_post(user_url: str) -> Optional[dict]:
+    """
+    Повертає метадані поста (dict) або None.
+    InstagramCooldown / RateLimitBusy пробрасуємо — це не «пост не знайдено».
+    """
+    m = INSTA_SHORTCODE_RE.search(user_url)
+    if not m:
+        return None
+    try:
+        return await INSTAGRAM.get(m.group(2))
+    except (InstagramCooldown, RateLimitBusy):
+        raise
+    except Exception as e:
+        logging.warning(f"get_instagram_post error: {e}")
+        return None
+
+
+def chunk_list(lst: List, size: int) -> List[List]:
+    return [lst[i:i + size] for i in range(0, len(lst), size)]
+
+
+def as_input_file(media: Media, filename: str):
+    """Байти загортаємо у BufferedInputFile, file_id передаємо як є."""
+    if isinstance(media, (bytes, bytearray)):
+        return BufferedInputFile(media, filename=filename)
+    return media
+
+
+async def send_gallery(
+    message: types.Message,
+    gallery: List[Tuple[Media, str]],
+    caption: Optional[str] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Шле галерею альбомами по 10 (підпис — лише на першому елементі).
+    Повертає [(file_id, 'photo'|'video')] у порядку відправки.
+    """
+    sent_items: List[Tuple[str, str]] = []
+    global_index = 0
+    for chunk in chunk_list(gallery, 10):
+        mg = MediaGroupBuilder()
+        for content, ctype in chunk:
+            cap = caption if global_index == 0 else None
+            if ctype == "video":
+                mg.add_video(
+                    as_input_file(content, "media.mp4"),
+                    caption=cap,
+                    parse_mode="HTML" if cap else None,
+                )
+            else:
+                mg.add_photo(
+                    as_input_file(content, "photo.jpg"),
+                    caption=cap,
+                    parse_mode="HTML" if cap else None,
+                )
+            global_index += 1
+        for msg in await message.answer_media_group(mg.build()):
+            if msg.video:
+                sent_items.append((msg.video.file_id, "video"))
+            elif msg.photo:
+                sent_items.append((msg.photo[-1].file_id, "photo"))
+    return sent_items
+
+
+async def resend_photo_post(message: types.Message, data_id: str, target_lang: Optional[str]) -> bool:
+    """Повторно відправляє фото/галерею з описом потрібною мовою
+    (target_lang=None — «тільки медіа», без опису).
+    Бере file_id з попередньої відправки, а якщо їх нема — збережені байти у STORAGE.
+    Повертає False, якщо відправляти нічого.
+    """
+    data = await STORAGE.get(data_id)
+    if not data:
+        return False
+
+    caption = None
+    if target_lang is not None:
+        text = await record_text(data_id, data, target_lang)
+        caption = format_caption(
+            data["author_name"],
+            data["author_link"],
+            text,
+            data["user_url"],
+        )
+
+    photo = data.get("photo_file_id")
+    gallery = data.get("gallery_file_ids") or []
+    if not photo and not gallery:
+        blobs = await STORAGE.get_blobs(data_id, data)
+        photo, gallery = blobs["photo_bytes"], blobs["gallery_data"]
+
+    # Якщо одиночне фото
+    if photo and not gallery:
+        await message.answer_photo(
+            as_input_file(photo, "photo.jpg"),
+            caption=caption,
+            parse_mode="HTML" if caption else None,
+        )
+        return True
+
+    # Якщо галерея / змішане медіа
+    if gallery:
+        await send_gallery(message, gallery, caption=caption)
+        return True
+    return False
+
+
+async def send_post_audio(message: types.Message, data_id: str, data: dict) -> bool:
+    """
+    Кнопка 🎵 для вже відправленого поста — з того, що в нас уже є:
+    1) file_id аудіо (запис або FILE_ID_CACHE) — просто пересилаємо;
+    2) пряме посилання на музику з маніфесту (TikTok music) — качаємо лише її;
+    3) відео з Telegram за video_file_id -> ffmpeg.
+    Повертає False, якщо нічого з цього нема (тоді — повний пайплайн).
+    """
+    post_key = data.get("post_key")
+    audio_name = data.get("audio_name") or "audio.mp3"
+
+    audio_file_id = data.get("audio_file_id")
+    if not audio_file_id and post_key:
+        cached = FILE_ID_CACHE.get(post_key)
+        audio_file_id = cached.get("audio") if cached else None
+
+    sent = None
+    if audio_file_id:
+        sent = await message.answer_audio(audio_file_id)
+    else:
+        audio_bytes = (await STORAGE.get_blobs(data_id, data))["audio_bytes"]
+        if not audio_bytes and data.get("music_url"):
+            audio_bytes, = await fetch_assets([Asset(data["music_url"], "audio")])
+        if audio_bytes:
+            sent = await message.answer_audio(
+                BufferedInputFile(audio_bytes, filename=audio_name)
+            )
+        elif data.get("video_file_id"):
+            try:
+                video_bytes = (await bot.download(data["video_file_id"])).read()
+            except Exception as e:
+                # напр. відео > 20 МБ — Bot API не віддає такі файли
+                logging.warning(f"send_post_audio: download video by file_id failed: {e}")
+                return False
+            try:
+                extracted = await extract_audio_pooled(message, video_bytes)
+            except PoolBusy:
+                await message.answer("😔 Сервер зайнятий обробкою аудіо. Спробуйте за хвилину.")
+                return True
+            if not extracted:
+                return False
+            audio_bytes, ext = extracted
+            sent = await message.answer_audio(
+                BufferedInputFile(audio_bytes, filename=with_extension(audio_name, ext))
+            )
+
+    if not sent:
+        return False
+
+    # Далі — лише file_id; байти більше не потрібні
+    await STORAGE.update(data_id, audio_file_id=sent.audio.file_id, audio_bytes=None)
+    if post_key:
+        FILE_ID_CACHE.merge(post_key, audio=sent.audio.file_id)
+    return True
+
+
+# -------------------------------------------------
+# ФУНКЦІЯ РОЗГОРТАННЯ
+# -------------------------------------------------
+SHORT_LINK_HOSTS = ("vm.tiktok.com", "vt.tiktok.com")
+TIKTOK_CANONICAL_RE = re.compile(r"tiktok\.com/.*?/(?:video|photo)/\d+")
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class RedirectResolver:
+    """
+    Розгортає vm/vt.tiktok.com вручну, хоп за хопом (allow_redirects=False),
+    і зупиняється, щойно Location містить канонічний /video/<id> чи /photo/<id>.
+    Тіла відповідей не читаємо, сторінку TikTok не завантажуємо взагалі.
+    Результати кешуються: успішні — надовго, невдалі — ненадовго.
+    """
+
+    # Імітуємо бота Facebook (найкраще працює для отримання редіректів)
+    HEADERS = {
+        "User-Agent": "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
+    }
+
+    def __init__(self, max_entries: int, ttl: float, negative_ttl: float, max_hops: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_hops = max_hops
+        # url -> (розгорнутий url або None, expires_at)
+        self._cache: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self.counters = {"hits": 0, "negative_hits": 0, "misses": 0, "failures": 0}
+        self.hops: Dict[int, int] = {}
+        self.latencies = deque(maxlen=500)
+
+    def _cached(self, url: str):
+        item = self._cache.get(url)
+        if item is None:
+            return False, None
+        resolved, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._cache[url]
+            return False, None
+        self._cache.move_to_end(url)
+        return True, resolved
+
+    def _remember(self, url: str, resolved: Optional[str]):
+        ttl = self.ttl if resolved else self.negative_ttl
+        self._cache[url] = (resolved, time.monotonic() + ttl)
+        self._cache.move_to_end(url)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def _follow(self, url: str) -> Tuple[Optional[str], int]:
+        current = url
+        hops = 0
+        while hops < self.max_hops:
+            async with HTTP.session.get(
+                current, headers=self.HEADERS, allow_redirects=False
+            ) as resp:
+                location = resp.headers.get("Location")
+                if resp.status not in REDIRECT_STATUSES or not location:
+                    break
+            current = urljoin(current, location)
+            hops += 1
+            if TIKTOK_CANONICAL_RE.search(current):
+                return current, hops
+        return None, hops
+
+    async def resolve(self, url: str) -> str:
+        if not any(host in url for host in SHORT_LINK_HOSTS):
+            return url
+
+        found, resolved = self._cached(url)
+        if found:
+            self.counters["hits" if resolved else "negative_hits"] += 1
+            return resolved or url
+
+        self.counters["misses"] += 1
+        started = time.monotonic()
+        hops = 0
+        try:
+            # стадія redirect — лише справжні мережеві хопи, без кешу й звичайних посилань
+            with observe_stage("redirect"):
+                resolved, hops = await self._follow(url)
+        except Exception as e:
+            logging.warning(f"resolve_redirect {url} error: {e}")
+            resolved = None
+        self.latencies.append(time.monotonic() - started)
+        self.hops[hops] = self.hops.get(hops, 0) + 1
+        if not resolved:
+            self.counters["failures"] += 1
+        self._remember(url, resolved)
+        return resolved or url
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._cache),
+            **self.counters,
+            "hops": {str(k): v for k, v in sorted(self.hops.items())},
+            "latency_p50": round(percentile(self.latencies, 0.5), 3),
+            "latency_p95": round(percentile(self.latencies, 0.95), 3),
+        }
+
+
+REDIRECTS = RedirectResolver(
+    REDIRECT_CACHE_MAX, REDIRECT_CACHE_TTL, REDIRECT_NEGATIVE_TTL, REDIRECT_MAX_HOPS
+)
+STATS_PROVIDERS["redirects"] = REDIRECTS.stats
+
+
+async def resolve_redirect(url: str) -> str:
+    """
+    Розгортає короткі посилання vm.tiktok.com / vt.tiktok.com у повні
+    (через кеш REDIRECTS). Інші посилання повертає як є.
+    """
+    return await REDIRECTS.resolve(url)
+
+
+# -------------------------------------------------
+# МАНІФЕСТ ПОСТА І ПАРАЛЕЛЬНЕ ЗАВАНТАЖЕННЯ МЕДІА
+# -------------------------------------------------
+
+class Asset:
+    """
+    Один файл поста: url + тип (video / photo / audio) + розмір, якщо провайдер його знає.
+    `data` — байти після завантаження або file_id із кешу; до того — None.
+    """
+
+    __slots__ = ("url", "kind", "size", "data", "_task")
+
+    def __init__(self, url: Optional[str], kind: str, size: Optional[int] = None, data: Optional[Media] = None):
+        self.url = url
+        self.kind = kind
+        self.size = size
+        self.data = data
+        self._task: Optional[asyncio.Task] = None
+
+
+class PostManifest:
+    """
+    Що є в пості: метадані одразу, файли — лише посиланнями.
+    Кожен режим завантажує тільки те, що справді відправить (assets_for).
+    """
+
+    __slots__ = (
+        "author_name", "author_link", "raw_desc", "audio_name", "video", "photo", "gallery", "audio", "partial_meta",
+    )
+
+    def __init__(
+        self,
+        author_name: str,
+        author_link: str,
+        raw_desc: str,
+        audio_name: str,
+        video: Optional[Asset] = None,
+        photo: Optional[Asset] = None,
+        gallery: Optional[List[Asset]] = None,
+        audio: Optional[Asset] = None,
+    ):
+        self.author_name = author_name
+        self.author_link = author_link
+        self.raw_desc = raw_desc
+        self.audio_name = audio_name
+        self.video = video
+        self.photo = photo
+        self.gallery = gallery or []
+        self.audio = audio
+        # метадані з резервного джерела (без опису) — у кеші їх замінить перша повна відповідь
+        self.partial_meta = False
+
+    @classmethod
+    def from_file_ids(cls, cached: dict) -> "PostManifest":
+        """Запис FILE_ID_CACHE як маніфест, де всі файли вже «завантажені» (file_id)."""
+        def known(kind: str, file_id: Optional[str]) -> Optional[Asset]:
+            return Asset(None, kind, data=file_id) if file_id else None
+
+        manifest = cls(
+            cached.get("author_name", "User"),
+            cached.get("author_link", ""),
+            cached.get("raw_desc", ""),
+            cached.get("audio_name", "audio.mp3"),
+            video=known("video", cached.get("video")),
+            photo=known("photo", cached.get("photo")),
+            gallery=[Asset(None, kind, data=file_id) for file_id, kind in cached.get("gallery") or []],
+            audio=known("audio", cached.get("audio")),
+        )
+        manifest.partial_meta = bool(cached.get("partial_meta"))
+        return manifest
+
+    @property
+    def is_video_post(self) -> bool:
+        return self.video is not None and not self.gallery
+
+    def visual(self) -> List[Asset]:
+        if self.video:
+            return [self.video]
+        if self.photo:
+            return [self.photo]
+        return list(self.gallery)
+
+    def assets_for(self, mode: str) -> List[Asset]:
+        """
+        standard — медіа, а для фото-постів ще й музика (її шлемо окремим аудіо);
+        clean — лише медіа; audio — музика, а без неї відео (для ffmpeg).
+        """
+        if mode == "audio":
+            return [self.audio] if self.audio else [self.video] if self.video else []
+        if mode == "clean" or self.is_video_post or not self.audio:
+            return self.visual()
+        return self.visual() + [self.audio]
+
+
+class AssetStats:
+    """Час і обсяг завантаження кожного файлу — окремо за типами, щоб регресії було видно."""
+
+    def __init__(self, window: int = 500):
+        self.kinds: Dict[str, dict] = {}
+        self.window = window
+
+    def record(self, kind: str, seconds: float, nbytes: Optional[int]):
+        entry = self.kinds.setdefault(
+            kind,
+            {"count": 0, "failures": 0, "bytes": 0, "latencies": deque(maxlen=self.window)},
+        )
+        entry["count"] += 1
+        entry["latencies"].append(seconds)
+        if nbytes is None:
+            entry["failures"] += 1
+        else:
+            entry["bytes"] += nbytes
+
+    def stats(self) -> dict:
+        result = {}
+        for kind, entry in self.kinds.items():
+            latencies = entry["latencies"]
+            result[kind] = {
+                "count": entry["count"],
+                "failures": entry["failures"],
+                "bytes": entry["bytes"],
+                "p50": round(percentile(latencies, 0.5), 3),
+                "p95": round(percentile(latencies, 0.95), 3),
+                "max": round(max(latencies, default=0.0), 3),
+            }
+        return result
+
+
+ASSET_STATS = AssetStats()
+STATS_PROVIDERS["assets"] = ASSET_STATS.stats
+
+
+async def fetch_assets(assets: List[Asset], concurrency: int = ASSET_CONCURRENCY) -> List[Optional[Media]]:
+    """
+    Завантажує всі файли поста одночасно (не більше `concurrency` разом),
+    тож запит триває приблизно як найповільніший файл, а не як їх сума.
+    Уже наявні (`data`) не чіпаємо; одночасні запити того самого Asset
+    чекають на одне завантаження. Порядок результатів відповідає `assets`.
+    """
+    limit = asyncio.Semaphore(concurrency)
+
+    async def download(asset: Asset) -> Optional[bytes]:
+        async with limit:
+            started = time.monotonic()
+            with observe_stage("download", kind=asset.kind) as current:
+                content = await download_content(asset.url)
+                if current is not None:
+                    current.attrs["bytes"] = len(content) if content else 0
+            elapsed = time.monotonic() - started
+        ASSET_STATS.record(asset.kind, elapsed, len(content) if content else None)
+        if content:
+            DOWNLOAD_BYTES.observe(len(content), kind=asset.kind, **current_labels())
+        else:
+            count_error("download")
+        logging.debug(
+            f"asset {asset.kind}: {elapsed:.2f}s, {len(content) if content else 0} bytes, {asset.url[:80]}"
+        )
+        if content:
+            asset.data = content
+        return content
+
+    async def fetch_one(asset: Asset) -> Optional[Media]:
+        if asset.data is not None or not asset.url:
+            return asset.data
+        if asset._task is None:
+            asset._task = asyncio.ensure_future(download(asset))
+        return await asyncio.shield(asset._task)
+
+    return list(await asyncio.gather(*(fetch_one(a) for a in assets)))
+
+
+# -------------------------------------------------
+# PER-SOURCE HANDLERS
+# -------------------------------------------------
+
+class RateLimitBusy(Exception):
+    """Черга до обмеженого API задовга — відмовляємо одразу, а не через хвилину."""
+
+    def __init__(self, position: int, service: str = "TikTok"):
+        super().__init__(f"{service} rate limiter queue is full (position {position})")
+        self.position = position
+        self.service = service
+
+
+class TokenBucket:
+    """
+    Спільний на процес ліміт частоти: `rate` запитів/сек із запасом `burst`.
+    Очікувачі обслуговуються по черзі (FIFO); якщо в черзі вже max_waiters —
+    RateLimitBusy. pause() зупиняє всіх, коли API саме сказав «забагато».
+    """
+
+    def __init__(self, rate: float, burst: int, max_waiters: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_waiters = max_waiters
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._lock: Optional[asyncio.Lock] = None
+        self.counters = {"acquired": 0, "rejected": 0, "pauses": 0}
+        self.wait_times = deque(maxlen=500)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.counters["pauses"] += 1
+
+    async def acquire(self):
+        if self.waiting >= self.max_waiters:
+            self.counters["rejected"] += 1
+            raise RateLimitBusy(self.waiting + 1)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self.paused_until:
+                        await asyncio.sleep(self.paused_until - now)
+                        continue
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+        self.counters["acquired"] += 1
+        self.wait_times.append(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "rate_per_sec": self.rate,
+            "queue_depth": self.waiting,
+            **self.counters,
+            "wait_p50": round(percentile(self.wait_times, 0.5), 3),
+            "wait_p95": round(percentile(self.wait_times, 0.95), 3),
+        }
+
+
+TIKWM_LIMITER = TokenBucket(TIKWM_RATE, TIKWM_BURST, TIKWM_MAX_QUEUE)
+TIKWM_STATS = {"calls": 0, "retries": 0, "limit_errors": 0, "parse_errors": 0}
+STATS_PROVIDERS["tikwm"] = lambda: {**TIKWM_STATS, "limiter": TIKWM_LIMITER.stats()}
+
+
+def backoff_delay(attempt: int, base: float) -> float:
+    """Експоненційна затримка з джитером, щоб повтори не збігались у часі."""
+    return base * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class ProviderQuota(Exception):
+    """Провайдер відповів «ліміт безкоштовного API» — це квота, а не збій."""
+
+
+class PostUnavailable(Exception):
+    """Провайдер працює, але пост не віддає (видалений, приватний, битий URL)."""
+
+
+class ProviderDown(Exception):
+    """Провайдер відповів 5xx — збій самого провайдера."""
+
+
+async def tikwm_request(full_url: str) -> dict:
+    """
+    POST до TikWM через TIKWM_LIMITER. На «Free Api Limit» пригальмовує
+    весь процес, на «Url parsing is failed» — лише цей запит; повтори
+    з експоненційною затримкою і джитером.
+    """
+    error_msg = "Unknown error"
+    for attempt in range(TIKWM_MAX_RETRIES + 1):
+        if attempt:
+            TIKWM_STATS["retries"] += 1
+        await TIKWM_LIMITER.acquire()
+        TIKWM_STATS["calls"] += 1
+        async with HTTP.session.post(TIKWM_API_URL, data={"url": full_url, "hd": 1}) as r:
+            if r.status >= 500:
+                raise ProviderDown(f"TikWM error, status={r.status}")
+            data = await r.json(content_type=None)
+
+        if data.get("data"):
+            return data["data"]
+
+        error_msg = data.get("msg", "Unknown error")
+        if attempt == TIKWM_MAX_RETRIES:
+            break
+        delay = backoff_delay(attempt, TIKWM_BACKOFF_BASE)
+        if "Free Api Limit" in error_msg:
+            TIKWM_STATS["limit_errors"] += 1
+            TIKWM_LIMITER.pause(delay)
+        elif "Url parsing is failed" in error_msg:
+            TIKWM_STATS["parse_errors"] += 1
+            await asyncio.sleep(delay)
+        else:
+            break
+        logging.warning(f"TikWM attempt {attempt + 1} failed ({error_msg}), retrying in {delay:.1f}s")
+
+    if "Free Api Limit" in error_msg:
+        raise ProviderQuota(f"TikWM Error: {error_msg}")
+    if "Url parsing is failed" in error_msg:
+        raise PostUnavailable(f"TikWM Error: {error_msg}")
+    raise Exception(f"TikWM Error: {error_msg}")
+
+
+# -------------------------------------------------
+# TIKTOK: ЛАНЦЮЖОК ПРОВАЙДЕРІВ (hedging + circuit breaker)
+# -------------------------------------------------
+
+class CircuitBreaker:
+    """
+    closed → (failure_threshold помилок поспіль) → open → (reset_timeout) →
+    half_open: пропускаємо один пробний запит; успіх — closed, помилка — open.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.opens = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+        if self.probe_in_flight:
+            return False
+        self.probe_in_flight = True
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Запит скасовано (програв хеджування) — не успіх і не помилка."""
+        self.probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "opens": self.opens}
+
+
+class TikTokProvider(ABC):
+    """Джерело метаданих TikTok; fetch() повертає dict у форматі TikWM."""
+
+    name = "provider"
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(PROVIDER_BREAKER_FAILURES, PROVIDER_BREAKER_RESET)
+        self.counters = {"calls": 0, "wins": 0, "errors": 0, "quota": 0, "unavailable": 0, "cancelled": 0}
+
+    @abstractmethod
+    async def fetch(self, full_url: str) -> dict:
+        ...
+
+    def stats(self) -> dict:
+        return {**self.counters, "breaker": self.breaker.stats()}
+
+
+class TikWMProvider(TikTokProvider):
+    name = "tikwm"
+
+    async def fetch(self, full_url: str) -> dict:
+        return await tikwm_request(full_url)
+
+
+class CobaltProvider(TikTokProvider):
+    """
+    Дзеркало Cobalt (API /api/json). Авторів Cobalt не віддає —
+    беремо @username з самого посилання.
+    """
+
+    def __init__(self, api_url: str):
+        super().__init__()
+        self.api_url = api_url
+        self.name = f"cobalt:{urlparse(api_url).netloc}"
+
+    async def fetch(self, full_url: str) -> dict:
+        headers = {"Accept": "application/json", "Content-Type": "application/json"}
+        async with HTTP.session.post(
+            self.api_url,
+            json={"url": full_url},
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=PROVIDER_TIMEOUT),
+        ) as r:
+            if r.status >= 500:
+                raise ProviderDown(f"Cobalt error, status={r.status}")
+            if r.status == 429:
+                raise ProviderQuota(f"Cobalt error, status={r.status}")
+            data = await r.json(content_type=None)
+
+        status = data.get("status")
+        if status in ("error", "rate-limit"):
+            # нові версії Cobalt кладуть код помилки в error.code
+            error = data.get("error")
+            text = str(data.get("text") or (error.get("code") if isinstance(error, dict) else error) or status)
+            if status == "rate-limit" or "rate_exceeded" in text:
+                raise ProviderQuota(f"Cobalt error: {text}")
+            raise PostUnavailable(f"Cobalt error: {text}")
+        m = re.search(r"/@([^/?#]+)", full_url)
+        username = m.group(1) if m else "TikTok"
+        # Опису Cobalt не віддає, тож "title" нема — handle_tiktok позначить маніфест partial_meta
+        result = {
+            "author": {"nickname": username, "unique_id": username},
+            "music_info": {"author": username, "title": "Audio"},
+            "music": data.get("audio"),
+        }
+        if status == "picker":
+            result["images"] = [
+                item["url"] for item in data.get("picker", []) if item.get("url")
+            ]
+        elif status in ("stream", "redirect") and data.get("url"):
+            result["hdplay"] = data["url"]
+        else:
+            raise Exception(f"Cobalt error: {data.get('text') or status}")
+        return result
+
+
+def make_tiktok_providers() -> List[TikTokProvider]:
+    providers: List[TikTokProvider] = []
+    for name in TIKTOK_PROVIDERS:
+        if name == "tikwm":
+            providers.append(TikWMProvider())
+        elif name == "cobalt":
+            providers.extend(CobaltProvider(url) for url in COBALT_MIRRORS)
+    # Кілька дзеркал на одному хості — розрізняємо їх у статистиці
+    seen: Dict[str, int] = {}
+    for provider in providers:
+        seen[provider.name] = seen.get(provider.name, 0) + 1
+        if seen[provider.name] > 1:
+            provider.name = f"{provider.name}#{seen[provider.name]}"
+    return providers
+
+
+TIKTOK_PROVIDER_CHAIN = make_tiktok_providers()
+HEDGE_STATS = {"requests": 0, "hedges": 0, "unavailable": 0, "all_failed": 0}
+STATS_PROVIDERS["tiktok_providers"] = lambda: {
+    **HEDGE_STATS,
+    "providers": {p.name: p.stats() for p in TIKTOK_PROVIDER_CHAIN},
+}
+
+
+async def _call_provider(provider: TikTokProvider, full_url: str) -> dict:
+    provider.counters["calls"] += 1
+    try:
+        with span(f"provider.{provider.name}"):
+            result = await provider.fetch(full_url)
+    except asyncio.CancelledError:
+        provider.counters["cancelled"] += 1
+        provider.breaker.release()
+        raise
+    except RateLimitBusy:
+        # наш власний ліміт, а не збій провайдера
+        provider.breaker.release()
+        raise
+    except ProviderQuota:
+        # звичайне обмеження частоти: переходимо до наступного, але breaker не відкриваємо
+        provider.counters["quota"] += 1
+        provider.breaker.release()
+        raise
+    except PostUnavailable:
+        # провайдер живий, проблема в пості — breaker не чіпаємо
+        provider.counters["unavailable"] += 1
+        provider.breaker.release()
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError, ProviderDown):
+        # мережа, таймаут, 5xx — це і є збій провайдера
+        provider.counters["errors"] += 1
+        provider.breaker.failure()
+        raise
+    except Exception:
+        # дивна відповідь (не JSON, незнайомий статус) — рахуємо, але breaker не відкриваємо
+        provider.counters["errors"] += 1
+        provider.breaker.release()
+        raise
+    provider.breaker.success()
+    return result
+
+
+async def hedged_fetch(providers: List[TikTokProvider], full_url: str, hedge_delay: float) -> dict:
+    """
+    Йдемо ланцюжком провайдерів: стартуємо першого доступного; якщо за
+    hedge_delay він не відповів (або впав) — паралельно стартуємо наступного.
+    Перший успішний результат виграє, решту скасовуємо; «пост недоступний»
+    від будь-кого завершує пошук одразу.
+    """
+    HEDGE_STATS["requests"] += 1
+    pending = iter(providers)
+    running: Dict[asyncio.Task, TikTokProvider] = {}
+    errors: List[Exception] = []
+
+    def launch_next() -> bool:
+        for provider in pending:
+            if provider.breaker.allow():
+                task = asyncio.create_task(_call_provider(provider, full_url))
+                running[task] = provider
+                return True
+        return False
+
+    launch_next()
+    try:
+        while running:
+            done, _ = await asyncio.wait(
+                running, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                provider = running.pop(task)
+                if task.exception() is None:
+                    provider.counters["wins"] += 1
+                    return task.result()
+                if isinstance(task.exception(), PostUnavailable):
+                    # пост недоступний — інші провайдери скажуть те саме
+                    HEDGE_STATS["unavailable"] += 1
+                    raise task.exception()
+                errors.append(task.exception())
+                logging.warning(f"TikTok provider {provider.name} failed: {task.exception()}")
+            # таймаут хеджування або провайдер впав — підключаємо наступного
+            if launch_next() and not done:
+                HEDGE_STATS["hedges"] += 1
+    finally:
+        for task in running:
+            task.cancel()
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    HEDGE_STATS["all_failed"] += 1
+    busy = [e for e in errors if isinstance(e, RateLimitBusy)]
+    if busy and len(busy) == len(errors):
+        raise busy[0]
+    if errors:
+        raise errors[-1]
+    raise Exception("Усі провайдери TikTok недоступні")
+
+
+async def handle_tiktok(user_url: str) -> PostManifest:
+    """
+    Повертає PostManifest: метадані + посилання на відео / фото / музику.
+    """
+    # 1. Розгортаємо посилання
+    full_url = await resolve_redirect(user_url)
+    
+    # Очищуємо URL від зайвих параметрів
+    full_url = full_url.split("?")[0]
 
-            data = data["data"]
+    with observe_stage("provider"):
+        data = await hedged_fetch(TIKTOK_PROVIDER_CHAIN, full_url, HEDGE_DELAY)
 
     author_name = data["author"]["nickname"]
     unique_id = data["author"]["unique_id"]
@@ -402,37 +3114,23 @@ async def handle_tiktok(user_url: str):
     m_title = data.get("music_info", {}).get("title", "Audio")
     audio_name = f"{sanitize_filename(m_author)} - {sanitize_filename(m_title)}.mp3"
 
-    audio_bytes = None
-    mb = await download_content(data.get("music"))
-    if mb:
-        audio_bytes = mb
-
-    video_bytes = None
-    photo_bytes = None
-    gallery_data: List[Tuple[bytes, str]] = []
-
-    if "images" in data and data["images"]:
-        tasks = [download_content(u) for u in data["images"]]
-        imgs = await asyncio.gather(*tasks)
-        for img in imgs:
-            if img:
-                gallery_data.append((img, "photo"))
+    manifest = PostManifest(author_name, author_link, raw_desc, audio_name)
+    manifest.partial_meta = "title" not in data
+    if data.get("music"):
+        manifest.audio = Asset(data["music"], "audio")
+
+    images = data.get("images") or []
+    if images:
+        manifest.gallery = [Asset(u, "photo") for u in images]
+    elif data.get("hdplay") and (data.get("hd_size") or 0) <= TELEGRAM_UPLOAD_LIMIT:
+        manifest.video = Asset(data["hdplay"], "video", data.get("hd_size"))
     else:
-        video_bytes = await download_content(data.get("hdplay") or data.get("play"))
-
-    return (
-        author_name,
-        author_link,
-        raw_desc,
-        audio_name,
-        audio_bytes,
-        video_bytes,
-        photo_bytes,
-        gallery_data,
-    )
+        # HD завеликий для Bot API (або його нема) — беремо звичайну якість
+        manifest.video = Asset(data.get("play") or data.get("hdplay"), "video", data.get("size"))
+    return manifest
 
 
-async def handle_twitter(user_url: str):
+async def handle_twitter(user_url: str) -> PostManifest:
     """
     X / Twitter через vxtwitter.
     """
@@ -444,8 +3142,8 @@ async def handle_twitter(user_url: str):
     tw_id = m.group(1)
     api_url = f"https://api.vxtwitter.com/Twitter/status/{tw_id}"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(api_url) as r:
+    with observe_stage("provider"):
+        async with HTTP.session.get(api_url) as r:
             if r.status != 200:
                 raise Exception(f"Twitter API error, status={r.status}")
             tweet = await r.json()
@@ -456,11 +3154,7 @@ async def handle_twitter(user_url: str):
     raw_desc = tweet.get("text", "")
 
     audio_name = f"{sanitize_filename(author_name)} - twitter.mp3"
-    audio_bytes = None
-
-    video_bytes = None
-    photo_bytes = None
-    gallery_data: List[Tuple[bytes, str]] = []
+    manifest = PostManifest(author_name, author_link, raw_desc, audio_name)
 
     media_list = tweet.get("media_extended", [])
     if not media_list and "media_url" in tweet:
@@ -469,81 +3163,556 @@ async def handle_twitter(user_url: str):
     has_video = any(m["type"] in ["video", "gif"] for m in media_list)
     if has_video:
         vid = next(m for m in media_list if m["type"] in ["video", "gif"])
-        video_bytes = await download_content(vid["url"])
+        manifest.video = Asset(vid["url"], "video")
     else:
-        tasks = [download_content(m["url"]) for m in media_list]
-        imgs = await asyncio.gather(*tasks)
-        for img in imgs:
-            if img:
-                gallery_data.append((img, "photo"))
-
-    return (
-        author_name,
-        author_link,
-        raw_desc,
-        audio_name,
-        audio_bytes,
-        video_bytes,
-        photo_bytes,
-        gallery_data,
-    )
+        manifest.gallery = [Asset(m["url"], "photo") for m in media_list]
+    return manifest
 
 
-async def handle_instagram(user_url: str):
+async def handle_instagram(user_url: str) -> PostManifest:
     """
     Instagram:
     – одиночне відео
     – одиночне фото
     – sidecar: фото/відео-галерея
     """
-    post = await get_instagram_post(user_url)
+    with span("instagram.meta"):
+        post = await get_instagram_post(user_url)
     if not post:
         raise Exception("Не вдалося отримати пост Instagram")
 
-    author_name = post.owner_username or "Instagram"
+    author_name = post["owner"] or "Instagram"
     author_link = f"https://instagram.com/{author_name}"
-    raw_desc = (post.caption or "").split("\n")[0]
+    raw_desc = post["caption"].split("\n")[0]
     audio_name = f"{sanitize_filename(author_name)}.mp3"
-
-    audio_bytes = None
-    video_bytes = None
-    photo_bytes = None
-    gallery_data: List[Tuple[bytes, str]] = []
+    manifest = PostManifest(author_name, author_link, raw_desc, audio_name)
 
     # Sidecar (галерея)
-    if post.typename == "GraphSidecar":
-        nodes = list(post.get_sidecar_nodes())
-
-        async def dl(node):
-            url = node.video_url if node.is_video else node.display_url
-            return await download_content(url), "video" if node.is_video else "photo"
-
-        tasks = [dl(n) for n in nodes]
-        results = await asyncio.gather(*tasks)
-        for content, ctype in results:
-            if content:
-                gallery_data.append((content, ctype))
+    if post["typename"] == "GraphSidecar":
+        manifest.gallery = [Asset(n["url"], n["type"]) for n in post["nodes"]]
 
     else:
         # Одиночне відео або фото
-        if post.is_video:
-            url = post.video_url
-            video_bytes = await download_content(url)
+        if post["is_video"]:
+            manifest.video = Asset(post["url"], "video")
+        else:
+            manifest.photo = Asset(post["url"], "photo")
+    return manifest
+
+
+# -------------------------------------------------
+# ОБ'ЄДНАННЯ ОДНАКОВИХ ЗАПИТІВ (single-flight)
+# -------------------------------------------------
+
+class SingleFlight:
+    """
+    Поки для ключа вже йде завантаження, нові запити з тим самим ключем
+    не стартують власне, а чекають на результат першого.
+    Сам fetch живе в окремій задачі: скасування одного з очікувачів
+    не зриває завантаження для решти.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable]):
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logging.info(f"single-flight: joined in-flight fetch for {key}")
         else:
-            url = post.url
-            photo_bytes = await download_content(url)
-
-    return (
-        author_name,
-        author_link,
-        raw_desc,
-        audio_name,
-        audio_bytes,
-        video_bytes,
-        photo_bytes,
-        gallery_data,
+            self.leaders += 1
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+
+            def _done(t: asyncio.Task, key=key):
+                self._inflight.pop(key, None)
+                if not t.cancelled():
+                    t.exception()  # щоб не було "exception was never retrieved"
+
+            task.add_done_callback(_done)
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "fetches": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+INFLIGHT = SingleFlight()
+STATS_PROVIDERS["single_flight"] = INFLIGHT.stats
+
+
+async def fetch_post(fetch_url: str) -> PostManifest:
+    """Обирає обробник за платформою; повертає маніфест поста (файли ще не завантажені)."""
+    if "tiktok.com" in fetch_url:
+        return await handle_tiktok(fetch_url)
+    if "twitter.com" in fetch_url or "x.com" in fetch_url:
+        return await handle_twitter(fetch_url)
+    if "instagram.com" in fetch_url:
+        return await handle_instagram(fetch_url)
+    raise Exception("Непідтримуване посилання")
+
+
+# -------------------------------------------------
+# ЧЕРГА ЗАДАЧ: справедливий планувальник + пул воркерів
+# -------------------------------------------------
+
+PRIORITY_INTERACTIVE = 0  # натискання кнопок
+PRIORITY_NORMAL = 1  # нові посилання
+
+
+class SchedulerBusy(Exception):
+    """Задачу не прийнято: у користувача забагато в черзі або черга бота повна."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"job rejected: {reason}")
+        self.reason = reason  # 'user' | 'global' | 'shutdown'
+
+
+class Job(ABC):
+    """
+    Важка робота, яку хендлер ставить у чергу і одразу відповідає Telegram.
+    Підкласи — конкретні типи задач; run() виконує воркер JobPool.
+    """
+
+    kind = "job"
+    __slots__ = ("user_id", "chat_id", "priority", "platform", "mode", "request", "enqueued_at", "started_at")
+
+    def __init__(self, user_id: int, chat_id: int, priority: int, platform: str, mode: str):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.priority = priority
+        self.platform = platform
+        self.mode = mode
+        self.request: Optional[Tuple[Trace, dict]] = None  # запит хендлера, що поставив задачу
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+
+    @abstractmethod
+    async def run(self):
+        ...
+
+    async def timed_out(self):
+        """Викликається, якщо run() не вклався в JOB_TIMEOUT."""
+
+
+class FetchPostJob(Job):
+    """Нове посилання (або повтор у режимі clean/audio): повний process_media_request."""
+
+    kind = "fetch_post"
+    __slots__ = (
+        "message", "user_url", "clean_mode", "audio_mode", "is_button_click", "status_msg", "queued", "status_lock",
     )
 
+    def __init__(
+        self,
+        message: types.Message,
+        user_url: str,
+        clean_mode: bool = False,
+        audio_mode: bool = False,
+        is_button_click: bool = False,
+        status_msg: Optional[types.Message] = None,
+    ):
+        user_id, chat_id = requester_ids(message)
+        mode = "callback" if is_button_click else "audio" if audio_mode else "clean" if clean_mode else "standard"
+        super().__init__(
+            user_id, chat_id,
+            PRIORITY_INTERACTIVE if is_button_click else PRIORITY_NORMAL,
+            platform_of(user_url), mode,
+        )
+        self.message = message
+        self.user_url = user_url
+        self.clean_mode = clean_mode
+        self.audio_mode = audio_mode
+        self.is_button_click = is_button_click
+        self.status_msg = status_msg
+        self.queued = False  # показали користувачу позицію в черзі
+        # правки статусу по черзі: «Обробляю» воркера не випередить «У черзі» хендлера
+        self.status_lock = asyncio.Lock()
+
+    async def run(self):
+        async with self.status_lock:
+            if self.queued and self.status_msg:
+                try:
+                    await self.status_msg.edit_text("⏳ Обробляю...")
+                except Exception:
+                    pass
+        await process_media_request(
+            self.message,
+            self.user_url,
+            clean_mode=self.clean_mode,
+            audio_mode=self.audio_mode,
+            is_button_click=self.is_button_click,
+            status_msg=self.status_msg,
+        )
+
+    async def timed_out(self):
+        if self.status_msg:
+            try:
+                await self.status_msg.edit_text("❌ Помилка завантаження.")
+            except Exception:
+                pass
+
+
+class ExtractAudioJob(Job):
+    """Кнопка 🎵: аудіо з того, що вже є, інакше — повний конвеєр в audio-режимі."""
+
+    kind = "extract_audio"
+    __slots__ = ("message", "data_id", "data")
+
+    def __init__(self, message: types.Message, user: Optional[types.User], data_id: str, data: dict):
+        user_id, chat_id = requester_ids(message, user)
+        super().__init__(user_id, chat_id, PRIORITY_INTERACTIVE, platform_of(data.get("user_url")), "callback")
+        self.message = message
+        self.data_id = data_id
+        self.data = data
+
+    async def run(self):
+        if not await send_post_audio(self.message, self.data_id, self.data):
+            await process_media_request(
+                self.message,
+                self.data["user_url"],
+                audio_mode=True,
+                is_button_click=True,
+            )
+
+
+class ResendGalleryJob(Job):
+    """
+    Кнопки фото-поста: повторна відправка фото/галереї з описом потрібною
+    мовою (pho_lang) або без опису (pho_clean, target_lang=None).
+    """
+
+    kind = "resend_gallery"
+    __slots__ = ("message", "data_id", "data", "target_lang")
+
+    def __init__(
+        self,
+        message: types.Message,
+        user: Optional[types.User],
+        data_id: str,
+        data: dict,
+        target_lang: Optional[str],
+    ):
+        user_id, chat_id = requester_ids(message, user)
+        super().__init__(user_id, chat_id, PRIORITY_INTERACTIVE, platform_of(data.get("user_url")), "callback")
+        self.message = message
+        self.data_id = data_id
+        self.data = data
+        self.target_lang = target_lang
+
+    async def run(self):
+        if self.target_lang is None:
+            # Медіа вже є у STORAGE (file_id або байти) — повторно не качаємо
+            if not await resend_photo_post(self.message, self.data_id, None):
+                await process_media_request(
+                    self.message,
+                    self.data["user_url"],
+                    clean_mode=True,
+                    is_button_click=True,
+                    force_lang=self.data.get("current_lang", "orig"),
+                )
+            return
+
+        # 1) Повторно шлемо повний пост (фото/галерею) з потрібною мовою опису
+        await resend_photo_post(self.message, self.data_id, self.target_lang)
+
+        # 2) Оновлюємо клавіатуру під «Опції:»
+        await STORAGE.update(self.data_id, current_lang=self.target_lang)
+        try:
+            await bot.edit_message_reply_markup(
+                chat_id=self.message.chat.id,
+                message_id=self.message.message_id,
+                reply_markup=get_photo_keyboard(
+                    self.data_id, current_lang=self.target_lang, has_diff=self.data["has_diff"]
+                ),
+            )
+        except Exception:
+            pass
+
+
+class FairScheduler:
+    """
+    Черга задач між хендлерами aiogram і воркерами.
+    Обмежує одночасні задачі на користувача і на чат; черги — окремі для
+    кожного чату, чати обслуговуються по колу, тож 30 посилань від одного
+    користувача чи з однієї галасливої групи не відсувають решту.
+    Натискання кнопок мають пріоритет над новими посиланнями.
+    """
+
+    def __init__(self, per_user: int, per_chat: int, user_queue: int, queue_max: int):
+        self.per_user = per_user
+        self.per_chat = per_chat
+        self.user_queue = user_queue
+        self.queue_max = queue_max
+        self.active_users: Dict[int, int] = {}
+        self.active_chats: Dict[int, int] = {}
+        self.waiting_users: Dict[int, int] = {}
+        self.waiting_kinds: Dict[str, int] = {}
+        # пріоритет -> chat_id -> черга; порядок чатів у OrderedDict і є «коло»
+        self.lanes: Dict[int, "OrderedDict[int, deque]"] = {
+            PRIORITY_INTERACTIVE: OrderedDict(),
+            PRIORITY_NORMAL: OrderedDict(),
+        }
+        self._idle: deque = deque()  # future вільних воркерів
+        self.counters = {"submitted": 0, "rejected_user": 0, "rejected_global": 0}
+
+    @property
+    def waiting(self) -> int:
+        return sum(self.waiting_users.values())
+
+    def _eligible(self, job: Job) -> bool:
+        return (
+            self.active_users.get(job.user_id, 0) < self.per_user
+            and self.active_chats.get(job.chat_id, 0) < self.per_chat
+        )
+
+    def _pick(self) -> Optional[Job]:
+        for priority in sorted(self.lanes):
+            lane = self.lanes[priority]
+            for chat_id in list(lane):
+                queue = lane[chat_id]
+                # голова черги може впиратися в ліміт користувача — беремо першу, яку можна
+                job = next((j for j in queue if self._eligible(j)), None)
+                if job is None:
+                    continue
+                queue.remove(job)
+                if queue:
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+                return job
+        return None
+
+    @staticmethod
+    def _dec(counts: dict, key):
+        counts[key] -= 1
+        if counts[key] <= 0:
+            del counts[key]
+
+    def _dispatch(self):
+        """Роздає задачі вільним воркерам, поки є і ті, і ті."""
+        while self._idle:
+            waiter = self._idle[0]
+            if waiter.done():  # воркер зупинено
+                self._idle.popleft()
+                continue
+            job = self._pick()
+            if job is None:
+                return
+            self._idle.popleft()
+            self._dec(self.waiting_users, job.user_id)
+            self._dec(self.waiting_kinds, job.kind)
+            self.active_users[job.user_id] = self.active_users.get(job.user_id, 0) + 1
+            self.active_chats[job.chat_id] = self.active_chats.get(job.chat_id, 0) + 1
+            job.started_at = time.monotonic()
+            waiter.set_result(job)
+
+    def submit(self, job: Job) -> int:
+        """
+        Ставить задачу в чергу. Повертає кількість задач у черзі перед нею
+        (0 — якщо її вже взяв вільний воркер). Переповнення — SchedulerBusy.
+        """
+        if self.waiting >= self.queue_max:
+            self.counters["rejected_global"] += 1
+            raise SchedulerBusy("global")
+        if job.priority == PRIORITY_NORMAL and self.waiting_users.get(job.user_id, 0) >= self.user_queue:
+            self.counters["rejected_user"] += 1
+            raise SchedulerBusy("user")
+        self.counters["submitted"] += 1
+        ahead = self.waiting
+        self.lanes[job.priority].setdefault(job.chat_id, deque()).append(job)
+        self.waiting_users[job.user_id] = self.waiting_users.get(job.user_id, 0) + 1
+        self.waiting_kinds[job.kind] = self.waiting_kinds.get(job.kind, 0) + 1
+        self._dispatch()
+        return 0 if job.started_at is not None else ahead + 1
+
+    async def next(self) -> Job:
+        """Чекає наступну задачу для воркера."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._idle.append(waiter)
+        self._dispatch()
+        return await waiter
+
+    def done(self, job: Job):
+        self._dec(self.active_users, job.user_id)
+        self._dec(self.active_chats, job.chat_id)
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "waiting": self.waiting,
+            "waiting_by_kind": dict(self.waiting_kinds),
+            "waiting_chats": {
+                "interactive": len(self.lanes[PRIORITY_INTERACTIVE]),
+                "normal": len(self.lanes[PRIORITY_NORMAL]),
+            },
+        }
+
+
+JOB_WAIT_SECONDS = METRICS.histogram(
+    "bot_job_wait_seconds", "Time jobs spend queued before a worker takes them", ("kind",), SECONDS_BUCKETS,
+)
+JOB_RUN_SECONDS = METRICS.histogram(
+    "bot_job_run_seconds", "Time workers spend running jobs", ("kind",), SECONDS_BUCKETS,
+)
+JOBS_TOTAL = METRICS.counter("bot_jobs_total", "Finished or rejected jobs", ("kind", "result"))
+
+
+class JobPool:
+    """
+    Фіксований пул asyncio-воркерів, що беруть задачі з FairScheduler.
+    Кількість воркерів — глобальна межа одночасної важкої роботи.
+    """
+
+    def __init__(self, scheduler: FairScheduler, workers: int, job_timeout: float):
+        self.scheduler = scheduler
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.accepting = True
+        self._tasks: List[asyncio.Task] = []
+        self.wait_times = deque(maxlen=500)
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"job-worker-{i}") for i in range(self.workers)
+        ]
+
+    async def drain(self, timeout: float):
+        """
+        Перед зупинкою: нових задач не приймаємо, а вже прийняті (у черзі
+        й у роботі) доробляємо — не довше timeout секунд.
+        """
+        self.accepting = False
+        deadline = time.monotonic() + timeout
+        while (self.scheduler.waiting or self.busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.scheduler.waiting or self.busy:
+            logging.warning(
+                f"JOBS drain timed out: {self.busy} running, {self.scheduler.waiting} queued will be cancelled"
+            )
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job: Job) -> int:
+        try:
+            if not self.accepting:
+                raise SchedulerBusy("shutdown")
+            ahead = self.scheduler.submit(job)
+        except SchedulerBusy:
+            JOBS_TOTAL.inc(kind=job.kind, result="rejected")
+            raise
+        # задачу прийнято — вона продовжує запит хендлера (воркер стартує не раніше наступного await)
+        job.request = hand_off_request()
+        return ahead
+
+    async def _worker(self):
+        while True:
+            job = await self.scheduler.next()
+            waited = job.started_at - job.enqueued_at
+            self.wait_times.append(waited)
+            JOB_WAIT_SECONDS.observe(waited, kind=job.kind)
+            self.busy += 1
+            try:
+                if job.request:
+                    context = resume_request(job.request)
+                else:  # задача поза запитом (напр. з коду, не з хендлера)
+                    context = track_request(job.platform, job.mode)
+                with context:
+                    result = await self._run(job, waited)
+            finally:
+                elapsed = time.monotonic() - job.started_at
+                self.busy -= 1
+                self.busy_seconds += elapsed
+                JOB_RUN_SECONDS.observe(elapsed, kind=job.kind)
+                self.scheduler.done(job)
+            JOBS_TOTAL.inc(kind=job.kind, result=result)
+
+    async def _run(self, job: Job, waited: float) -> str:
+        with span(f"job.{job.kind}", wait_ms=round(waited * 1000, 1)):
+            try:
+                await asyncio.wait_for(job.run(), self.job_timeout)
+                return "ok"
+            except asyncio.TimeoutError:
+                logging.warning(f"job {job.kind} [{current_request_id()}] timed out after {self.job_timeout}s")
+                await job.timed_out()
+                return "timeout"
+            except Exception as e:
+                count_error("job")
+                logging.exception(f"job {job.kind} [{current_request_id()}] failed: {e}")
+                return "error"
+
+    def utilization(self) -> float:
+        """Частка часу, яку воркери були зайняті, від старту пулу."""
+        uptime = (time.monotonic() - self.started_at) * self.workers
+        return self.busy_seconds / uptime if uptime > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "utilization": round(self.utilization(), 3),
+            "wait_seconds_p50": round(percentile(self.wait_times, 0.5), 3),
+            "wait_seconds_p95": round(percentile(self.wait_times, 0.95), 3),
+            "scheduler": self.scheduler.stats(),
+        }
+
+
+def job_metrics() -> list:
+    return [
+        (
+            "bot_job_queue_depth", "gauge", "Jobs waiting for a worker",
+            [({"kind": kind}, n) for kind, n in JOBS.scheduler.waiting_kinds.items()]
+            or [({"kind": "all"}, 0)],
+        ),
+        (
+            "bot_job_workers", "gauge", "Job workers by state",
+            [({"state": "busy"}, JOBS.busy), ({"state": "idle"}, JOBS.workers - JOBS.busy)],
+        ),
+        (
+            "bot_job_worker_busy_seconds_total", "counter",
+            "Total worker busy time; rate() / workers = utilization",
+            [({}, JOBS.busy_seconds)],
+        ),
+    ]
+
+
+JOBS = JobPool(
+    FairScheduler(SCHED_PER_USER, SCHED_PER_CHAT, SCHED_USER_QUEUE, JOB_QUEUE_MAX),
+    JOB_WORKERS,
+    JOB_TIMEOUT,
+)
+STATS_PROVIDERS["jobs"] = JOBS.stats
+METRICS.collectors.append(job_metrics)
+
+
+def requester_ids(message: types.Message, user: Optional[types.User] = None) -> Tuple[int, int]:
+    """(user_id, chat_id); для постів каналів користувача нема — рахуємо чатом."""
+    user = user or message.from_user
+    return (user.id if user else message.chat.id), message.chat.id
+
+
+def rejected_text(reason: str) -> str:
+    if reason == "user":
+        return "⏳ У вас уже багато запитів у черзі. Дочекайтеся їх і надішліть ще раз."
+    if reason == "shutdown":
+        return "⏳ Бот перезапускається. Надішліть посилання ще раз за хвилину."
+    return "⏳ Бот зараз перевантажений. Спробуйте за хвилину."
+
 
 # ==========================================
 #  MAIN LOGIC
@@ -556,124 +3725,140 @@ async def process_media_request(
     audio_mode: bool = False,
     is_button_click: bool = False,
     force_lang: str = "orig",  # 'orig' або 'trans'
+    status_msg: Optional[types.Message] = None,  # «⏳ Обробляю...», якщо хендлер уже надіслав
 ):
     if not user_url:
         return
+    mode = "callback" if is_button_click else "audio" if audio_mode else "clean" if clean_mode else "standard"
+    with track_request(platform_of(user_url), mode):
+        await _process_media_request(
+            message, user_url, clean_mode, audio_mode, is_button_click, force_lang, status_msg
+        )
 
-    status_msg = None
-    if not clean_mode and not audio_mode and not is_button_click:
+
+async def _process_media_request(
+    message: types.Message,
+    user_url: str,
+    clean_mode: bool,
+    audio_mode: bool,
+    is_button_click: bool,
+    force_lang: str,
+    status_msg: Optional[types.Message],
+):
+
+    if status_msg is None and not clean_mode and not audio_mode and not is_button_click:
         status_msg = await message.reply("⏳ Обробляю...")
 
+    post_key = None
+    manifest: Optional[PostManifest] = None
+    file_ids = {}  # те, що Telegram повернув у цьому запиті (для FILE_ID_CACHE)
+
     try:
         author_name = "User"
         author_link = user_url
         raw_desc = ""
         audio_name = "audio.mp3"
 
-        audio_bytes = None
-        video_bytes = None
-        photo_bytes = None
-        gallery_data: List[Tuple[bytes, str]] = []
-
-        # TikTok
-        if "tiktok.com" in user_url:
-            (
-                author_name,
-                author_link,
-                raw_desc,
-                audio_name,
-                audio_bytes,
-                video_bytes,
-                photo_bytes,
-                gallery_data,
-            ) = await handle_tiktok(user_url)
-
-        # Twitter / X
-        elif "twitter.com" in user_url or "x.com" in user_url:
-            (
-                author_name,
-                author_link,
-                raw_desc,
-                audio_name,
-                audio_bytes,
-                video_bytes,
-                photo_bytes,
-                gallery_data,
-            ) = await handle_twitter(user_url)
-
-        # Instagram
-        elif "instagram.com" in user_url:
-            (
-                author_name,
-                author_link,
-                raw_desc,
-                audio_name,
-                audio_bytes,
-                video_bytes,
-                photo_bytes,
-                gallery_data,
-            ) = await handle_instagram(user_url)
+        fetch_url = await resolve_redirect(user_url)
+        post_key = canonical_post_key(fetch_url)
+
+        cached = FILE_ID_CACHE.get(post_key) if post_key else None
+        if cached and not (cached.get("audio") if audio_mode else file_cache_has_media(cached)):
+            cached = None
+        if cached and cached.get("partial_meta") and not (clean_mode or audio_mode):
+            cached = None  # у кеші пост без опису — пробуємо взяти повний у провайдера
+
+        # Повторне посилання — відповідаємо file_id, без провайдера і CDN
+        if cached:
+            manifest = PostManifest.from_file_ids(cached)
+        # Нове посилання — один маніфест на всі одночасні запити цього поста
         else:
-            raise Exception("Непідтримуване посилання")
+            with span("fetch_post", post_key=post_key):
+                manifest = await INFLIGHT.do(post_key or fetch_url, lambda: fetch_post(fetch_url))
+
+        author_name = manifest.author_name
+        author_link = manifest.author_link or author_link
+        raw_desc = manifest.raw_desc
+        audio_name = manifest.audio_name
+
+        # Завантажуємо лише те, що цей режим справді відправить.
+        # Медіа — це або байти, або file_id із кешу
+        mode = "audio" if audio_mode else "clean" if clean_mode else "standard"
+        with span("fetch_assets", mode=mode):
+            await fetch_assets(manifest.assets_for(mode))
+            if audio_mode and manifest.audio and manifest.audio.data is None and manifest.video:
+                # пряме посилання на музику не спрацювало — витягнемо з відео
+                await fetch_assets([manifest.video])
+
+        audio_media: Optional[Media] = manifest.audio.data if manifest.audio else None
+        video_media: Optional[Media] = manifest.video.data if manifest.video else None
+        photo_media: Optional[Media] = manifest.photo.data if manifest.photo else None
+        gallery_media: List[Tuple[Media, str]] = [
+            (a.data, a.kind) for a in manifest.gallery if a.data is not None
+        ]
 
         # AUDIO ONLY (кнопка / режим)
         if audio_mode:
-            if audio_bytes:
-                await message.answer_audio(
-                    BufferedInputFile(audio_bytes, filename=audio_name)
-                )
-            elif video_bytes:
-                extracted = await asyncio.to_thread(
-                    extract_audio_from_video_bytes, video_bytes
+            sent = None
+            failure_text = "Не вдалося отримати аудіо 😔"
+            if audio_media:
+                sent = await message.answer_audio(
+                    as_input_file(audio_media, audio_name)
                 )
+            elif isinstance(video_media, bytes):
+                try:
+                    with span("extract_audio"):
+                        extracted = await extract_audio_pooled(message, video_media)
+                except PoolBusy:
+                    extracted = None
+                    failure_text = "😔 Сервер зайнятий обробкою аудіо. Спробуйте за хвилину."
                 if extracted:
-                    await message.answer_audio(
-                        BufferedInputFile(extracted, filename=audio_name)
+                    audio_bytes, ext = extracted
+                    sent = await message.answer_audio(
+                        BufferedInputFile(
+                            audio_bytes, filename=with_extension(audio_name, ext)
+                        )
                     )
-                else:
-                    await message.answer("Не вдалося отримати аудіо 😔")
+            if sent:
+                file_ids["audio"] = sent.audio.file_id
             else:
-                await message.answer("Не вдалося отримати аудіо 😔")
+                await message.answer(failure_text)
 
             if status_msg:
                 await status_msg.delete()
             return
 
-        # Тексти / переклад
-        orig_text, trans_text, has_diff = await prepare_texts(raw_desc)
-        text_to_show = orig_text if force_lang == "orig" else trans_text
-        caption = format_caption(author_name, author_link, text_to_show, user_url)
-
         # CLEAN MODE — тільки медіа без описів/кнопок
         if clean_mode:
-            if video_bytes:
-                await message.answer_video(
-                    BufferedInputFile(video_bytes, filename="video.mp4")
+            if video_media:
+                sent = await message.answer_video(
+                    as_input_file(video_media, "video.mp4")
                 )
-            elif photo_bytes:
-                await message.answer_photo(
-                    BufferedInputFile(photo_bytes, filename="photo.jpg")
+                file_ids["video"] = sent.video.file_id
+            elif photo_media:
+                sent = await message.answer_photo(
+                    as_input_file(photo_media, "photo.jpg")
                 )
-            elif gallery_data:
-                for chunk in chunk_list(gallery_data, 10):
-                    mg = MediaGroupBuilder()
-                    for content, ctype in chunk:
-                        if ctype == "video":
-                            mg.add_video(
-                                BufferedInputFile(content, filename="media.mp4")
-                            )
-                        else:
-                            mg.add_photo(
-                                BufferedInputFile(content, filename="photo.jpg")
-                            )
-                    await message.answer_media_group(mg.build())
+                file_ids["photo"] = sent.photo[-1].file_id
+            elif gallery_media:
+                file_ids["gallery"] = await send_gallery(message, gallery_media)
             if status_msg:
                 await status_msg.delete()
             return
 
+        # Тексти: мову визначаємо одразу, перекладаємо лише якщо просять
+        with span("prepare_texts"):
+            orig_text, has_diff = await prepare_texts(raw_desc)
+        trans_text = None
+        if force_lang == "trans" and has_diff:
+            trans_text = await translate_text(orig_text)
+        text_to_show = trans_text if trans_text is not None else orig_text
+        caption = format_caption(author_name, author_link, text_to_show, user_url)
+
         # СТАНДАРТНИЙ РЕЖИМ
         data_id = str(uuid.uuid4())[:8]
-        STORAGE[data_id] = {
+        is_video_post = bool(video_media and manifest.is_video_post)
+        record = {
             "user_url": user_url,
             "orig_text": orig_text,
             "trans_text": trans_text,
@@ -681,89 +3866,139 @@ async def process_media_request(
             "author_name": author_name,
             "author_link": author_link,
             "audio_name": audio_name,
-            "kind": None,
+            "kind": "video" if is_video_post else "photo",
+            "post_key": post_key,
             "video_file_id": None,
+            "audio_file_id": audio_media if isinstance(audio_media, str) else None,
             "current_lang": force_lang,
         }
+        if is_video_post and manifest.audio and manifest.audio.url:
+            # Музику не качаємо, доки не натиснуть 🎵 — зберігаємо лише посилання
+            record["music_url"] = manifest.audio.url
+        if not is_video_post:
+            # байти потрібні лише поки Telegram не дав file_id
+            record["photo_bytes"] = photo_media if isinstance(photo_media, bytes) else None
+            record["gallery_data"] = [
+                item for item in gallery_media if isinstance(item[0], bytes)
+            ]
+        with span("storage.put"):
+            await STORAGE.put(data_id, record)
 
         # ---------- ВІДЕО-ПОСТ ----------
-        if video_bytes and not gallery_data:
-            STORAGE[data_id]["kind"] = "video"
+        if is_video_post:
             sent = await message.answer_video(
-                BufferedInputFile(video_bytes, filename="video.mp4"),
+                as_input_file(video_media, "video.mp4"),
                 caption=caption,
                 parse_mode="HTML",
-                reply_markup=get_video_keyboard(data_id, current_lang=force_lang),
+                reply_markup=get_video_keyboard(
+                    data_id, current_lang=force_lang, has_diff=has_diff
+                ),
             )
-            STORAGE[data_id]["video_file_id"] = sent.video.file_id
+            file_ids["video"] = sent.video.file_id
+            await STORAGE.update(data_id, video_file_id=sent.video.file_id)
 
         # ---------- ФОТО / ГАЛЕРЕЯ ----------
         else:
-            STORAGE[data_id]["kind"] = "photo"
-            STORAGE[data_id]["photo_bytes"] = photo_bytes
-            STORAGE[data_id]["gallery_data"] = gallery_data
-
             # 1) Шлемо саме медіа з описом (оригінал/вибрана мова)
-            if photo_bytes and not gallery_data:
-                await message.answer_photo(
-                    BufferedInputFile(photo_bytes, filename="photo.jpg"),
+            if photo_media and not gallery_media:
+                sent = await message.answer_photo(
+                    as_input_file(photo_media, "photo.jpg"),
                     caption=caption,
                     parse_mode="HTML",
                 )
+                file_ids["photo"] = sent.photo[-1].file_id
+                await STORAGE.update(data_id, photo_file_id=file_ids["photo"], photo_bytes=None)
             else:
                 # галерея / змішане медіа
-                for_idx = 0
-                for chunk in chunk_list(gallery_data, 10):
-                    mg = MediaGroupBuilder()
-                    first_in_chunk = True
-                    for content, ctype in chunk:
-                        cap = caption if for_idx == 0 and first_in_chunk else None
-                        if ctype == "video":
-                            mg.add_video(
-                                BufferedInputFile(content, filename="media.mp4"),
-                                caption=cap,
-                                parse_mode="HTML" if cap else None,
-                            )
-                        else:
-                            mg.add_photo(
-                                BufferedInputFile(content, filename="photo.jpg"),
-                                caption=cap,
-                                parse_mode="HTML" if cap else None,
-                            )
-                        first_in_chunk = False
-                        for_idx += 1
-                    await message.answer_media_group(mg.build())
+                file_ids["gallery"] = await send_gallery(
+                    message, gallery_media, caption=caption
+                )
+                await STORAGE.update(
+                    data_id, gallery_file_ids=file_ids["gallery"], gallery_data=[]
+                )
 
             # 2) Окреме повідомлення «Опції» з кнопками
             opts_msg = await message.answer(
                 "Опції:",
-                reply_markup=get_photo_keyboard(data_id, current_lang=force_lang),
+                reply_markup=get_photo_keyboard(
+                    data_id, current_lang=force_lang, has_diff=has_diff
+                ),
             )
-            STORAGE[data_id]["opts_msg_id"] = opts_msg.message_id
+            await STORAGE.update(data_id, opts_msg_id=opts_msg.message_id)
 
             # 3) Якщо в пості є аудіо (TikTok / інші) — кидаємо окремо
-            if audio_bytes:
+            if audio_media:
                 try:
-                    await message.answer_audio(
-                        BufferedInputFile(audio_bytes, filename=audio_name)
+                    sent = await message.answer_audio(
+                        as_input_file(audio_media, audio_name)
                     )
+                    file_ids["audio"] = sent.audio.file_id
                 except Exception as e:
                     logging.warning(f"send audio after photo error: {e}")
 
+        # Переклад у фоні: до натискання 🇺🇦 він уже буде готовий
+        if TRANSLATE_PREFETCH and has_diff and trans_text is None:
+            spawn(prefetch_translation(data_id))
+
         if status_msg:
             try:
                 await status_msg.delete()
             except Exception:
                 pass
 
+    except RateLimitBusy as e:
+        logging.warning(f"process_media_request: {e}")
+        busy_text = (
+            f"⏳ Зараз забагато запитів до {e.service} (ви були б {e.position}-м у черзі). "
+            "Спробуйте за хвилину."
+        )
+        try:
+            if status_msg:
+                await status_msg.edit_text(busy_text)
+            else:
+                await message.answer(busy_text)
+        except Exception:
+            pass
+
+    except InstagramCooldown as e:
+        logging.warning(f"process_media_request: {e}")
+        minutes = max(1, round(e.retry_after / 60))
+        busy_text = f"⏳ Instagram тимчасово обмежив запити. Спробуйте приблизно за {minutes} хв."
+        try:
+            if status_msg:
+                await status_msg.edit_text(busy_text)
+            else:
+                await message.answer(busy_text)
+        except Exception:
+            pass
+
     except Exception as e:
-        logging.exception(f"process_media_request error: {e}")
+        count_error("request")
+        logging.exception(f"process_media_request error [{current_request_id()}]: {e}")
         if status_msg:
             try:
                 await status_msg.edit_text("❌ Помилка завантаження.")
             except Exception:
                 pass
 
+    finally:
+        if manifest and "gallery" in file_ids and len(file_ids["gallery"]) < len(manifest.gallery):
+            # частина галереї не завантажилась — неповний альбом не кешуємо,
+            # наступний запит спробує завантажити його знову
+            del file_ids["gallery"]
+        if post_key and file_ids:
+            meta = dict(
+                author_name=author_name,
+                author_link=author_link,
+                raw_desc=raw_desc,
+                audio_name=audio_name,
+            )
+            if manifest and manifest.partial_meta:
+                # неповні метадані не перезаписують повні, а лише заповнюють новий запис
+                FILE_ID_CACHE.merge(post_key, defaults={**meta, "partial_meta": True}, **file_ids)
+            else:
+                FILE_ID_CACHE.merge(post_key, partial_meta=False, **meta, **file_ids)
+
 
 # ==========================================
 #  CALLBACKS
@@ -771,14 +4006,32 @@ async def process_media_request(
 
 @dp.callback_query()
 async def handle_callbacks(callback: CallbackQuery):
+    with track_request("unknown", "callback") as labels:
+        await _handle_callback(callback, labels)
+
+
+async def submit_callback_job(callback: CallbackQuery, job: Job, ack: Optional[str] = None):
+    """Відповідає на натискання одразу, а важку роботу віддає воркерам."""
+    try:
+        JOBS.submit(job)
+    except SchedulerBusy as e:
+        await callback.answer(rejected_text(e.reason), show_alert=True)
+        return
+    await callback.answer(ack)
+
+
+async def _handle_callback(callback: CallbackQuery, labels: dict):
     try:
         parts = callback.data.split(":")
         action = parts[0]
+        # data_id завжди останній: vid_clean:<id>, vid_lang:<lang>:<id>, ...
+        data_id = parts[-1]
+        data = await STORAGE.get(data_id)
+        if data:
+            labels["platform"] = platform_of(data.get("user_url"))
 
         # ---------- ВІДЕО ----------
         if action == "vid_clean":
-            data_id = parts[1]
-            data = STORAGE.get(data_id)
             if data and data.get("video_file_id"):
                 await callback.message.answer_video(data["video_file_id"])
             else:
@@ -786,32 +4039,24 @@ async def handle_callbacks(callback: CallbackQuery):
             await callback.answer()
 
         elif action == "vid_audio":
-            data_id = parts[1]
-            data = STORAGE.get(data_id)
             if not data:
                 await callback.answer("Застаріло", show_alert=True)
                 return
-            await callback.answer("Витягую аудіо...")
-            await process_media_request(
-                callback.message,
-                data["user_url"],
-                audio_mode=True,
-                is_button_click=True,
+            await submit_callback_job(
+                callback,
+                ExtractAudioJob(callback.message, callback.from_user, data_id, data),
+                "Витягую аудіо...",
             )
 
         elif action == "vid_lang":
             target_lang = parts[1]  # orig / trans
-            data_id = parts[2]
-            data = STORAGE.get(data_id)
             if not data:
                 await callback.answer("Застаріло", show_alert=True)
                 return
 
-            text = (
-                data["orig_text"]
-                if target_lang == "orig"
-                else data["trans_text"]
-            )
+            # відповідаємо до перекладу: record_text може піти в мережу
+            await callback.answer()
+            text = await record_text(data_id, data, target_lang)
             new_cap = format_caption(
                 data["author_name"],
                 data["author_link"],
@@ -825,59 +4070,34 @@ async def handle_callbacks(callback: CallbackQuery):
                     caption=new_cap,
                     parse_mode="HTML",
                     reply_markup=get_video_keyboard(
-                        data_id, current_lang=target_lang
+                        data_id, current_lang=target_lang, has_diff=data["has_diff"]
                     ),
                 )
-                data["current_lang"] = target_lang
+                await STORAGE.update(data_id, current_lang=target_lang)
             except Exception as e:
                 logging.warning(f"vid_lang edit caption error: {e}")
-            await callback.answer()
 
         # ---------- ФОТО / ГАЛЕРЕЯ ----------
         elif action == "pho_clean":
-            data_id = parts[1]
-            data = STORAGE.get(data_id)
             if not data:
                 await callback.answer("Застаріло", show_alert=True)
                 return
-
-            await process_media_request(
-                callback.message,
-                data["user_url"],
-                clean_mode=True,
-                is_button_click=True,
-                force_lang=data.get("current_lang", "orig"),
+            await submit_callback_job(
+                callback, ResendGalleryJob(callback.message, callback.from_user, data_id, data, None)
             )
-            await callback.answer()
 
         elif action == "pho_lang":
             target_lang = parts[1]  # orig / trans
-            data_id = parts[2]
-            data = STORAGE.get(data_id)
             if not data:
                 await callback.answer("Застаріло", show_alert=True)
                 return
-
-            # 1) Повторно шлемо повний пост (фото/галерею) з потрібною мовою опису
-            await resend_photo_post(callback.message, data_id, target_lang)
-
-            # 2) Оновлюємо клавіатуру під «Опції:»
-            data["current_lang"] = target_lang
-            try:
-                await bot.edit_message_reply_markup(
-                    chat_id=callback.message.chat.id,
-                    message_id=callback.message.message_id,
-                    reply_markup=get_photo_keyboard(
-                        data_id, current_lang=target_lang
-                    ),
-                )
-            except Exception:
-                pass
-
-            await callback.answer()
+            await submit_callback_job(
+                callback, ResendGalleryJob(callback.message, callback.from_user, data_id, data, target_lang)
+            )
 
     except Exception as e:
-        logging.exception(f"Callback error: {e}")
+        count_error("request")
+        logging.exception(f"Callback error [{current_request_id()}]: {e}")
 
 
 # ==========================================
@@ -892,37 +4112,497 @@ async def cmd_start(message: types.Message):
 @dp.message(F.text.regexp(r"(https?://[^\s]+)"))
 async def handle_link(message: types.Message):
     user_url, clean, audio = parse_message_data(message.text or "")
-    await process_media_request(
-        message,
-        user_url,
-        clean_mode=clean,
-        audio_mode=audio,
-        force_lang="orig",  # за замовчуванням показуємо оригінал
-    )
+    if not user_url:
+        return
+    mode = "audio" if audio else "clean" if clean else "standard"
+    with track_request(platform_of(user_url), mode):
+        await submit_link_job(message, user_url, clean, audio)
+
+
+async def submit_link_job(message: types.Message, user_url: str, clean: bool, audio: bool):
+    # Відповідаємо одразу; завантаження і відправку робить воркер JOBS
+    status_msg = None
+    if not clean and not audio:
+        status_msg = await message.reply("⏳ Обробляю...")
+    job = FetchPostJob(message, user_url, clean_mode=clean, audio_mode=audio, status_msg=status_msg)
+    try:
+        ahead = JOBS.submit(job)
+    except SchedulerBusy as e:
+        if status_msg:
+            await status_msg.edit_text(rejected_text(e.reason))
+        else:
+            await message.reply(rejected_text(e.reason))
+        return
+    if ahead and status_msg and job.started_at is None:
+        # замок беремо до першого await — воркер ще не встиг стартувати
+        async with job.status_lock:
+            job.queued = True
+            try:
+                await status_msg.edit_text(f"⏳ У черзі: {ahead}. Зачекайте...")
+            except Exception:
+                pass
+
+
+# ==========================================
+#  ПРОФІЛЮВАННЯ (/debug/*, лише з PROFILE_TOKEN)
+# ==========================================
+
+class SamplingProfiler:
+    """
+    Семплює стек потоку event loop через sys._current_frames() з окремого
+    потоку: сам loop не зупиняємо і не інструментуємо, тож можна запускати
+    під живим навантаженням. Результат — найгарячіші функції (self / total)
+    і згорнуті стеки (формат flamegraph.pl / speedscope).
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    @staticmethod
+    def _sample(thread_id: int, seconds: float, interval: float) -> Tuple[Dict[str, int], int]:
+        stacks: Dict[str, int] = {}
+        total = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ";".join(reversed(names))
+                stacks[key] = stacks.get(key, 0) + 1
+                total += 1
+            time.sleep(interval)
+        return stacks, total
+
+    async def profile(self, seconds: float, interval: float) -> Tuple[Dict[str, int], int]:
+        async with self._lock:
+            return await asyncio.to_thread(self._sample, threading.get_ident(), seconds, interval)
+
+    @staticmethod
+    def summarize(stacks: Dict[str, int], total: int, limit: int) -> dict:
+        self_counts: Dict[str, int] = {}
+        total_counts: Dict[str, int] = {}
+        for stack, count in stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + count
+            for name in set(frames):
+                total_counts[name] = total_counts.get(name, 0) + count
+
+        def top(counts: Dict[str, int]) -> List[dict]:
+            ordered = sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+            return [
+                {"function": name, "samples": n, "percent": round(100 * n / total, 1)}
+                for name, n in ordered
+            ]
+
+        return {"samples": total, "self": top(self_counts), "total": top(total_counts)}
+
+
+class MemoryProfiler:
+    """
+    tracemalloc на вимогу: перший виклик вмикає трасування і знімає базовий
+    знімок, наступні — різниця з попереднім, згрупована за місцем алокації.
+    Трасування помітно сповільнює весь процес, тому через `window` секунд
+    після старту воно вимикається саме.
+    """
+
+    def __init__(self, window: float, frames: int = 10):
+        self.window = window
+        self.frames = frames
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self.previous_at = 0.0
+        self.stops_at = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def start(self):
+        """Викликається з event loop: вмикає трасування і планує його вимкнення."""
+        if tracemalloc.is_tracing():
+            return
+        tracemalloc.start(self.frames)
+        self.previous = None
+        self.stops_at = time.monotonic() + self.window
+        self._timer = asyncio.get_running_loop().call_later(self.window, self.stop)
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        tracemalloc.stop()
+        self.previous = None
+
+    def diff(self, group_by: str, limit: int) -> dict:
+        """Знімок і порівняння з попереднім; трасування має бути ввімкнене (start)."""
+        snapshot = self._snapshot()
+        now = time.monotonic()
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "traced_current_bytes": current,
+            "traced_peak_bytes": peak,
+            "tracing_stops_in": round(max(0.0, self.stops_at - now), 1),
+            "group_by": group_by,
+        }
+        if self.previous is None:
+            result["baseline"] = True
+            result["top"] = [
+                {"site": str(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics(group_by)[:limit]
+            ]
+        else:
+            result["seconds_since_previous"] = round(now - self.previous_at, 1)
+            result["top"] = [
+                {
+                    "site": str(stat.traceback) if group_by != "traceback" else stat.traceback.format(),
+                    "size": stat.size,
+                    "size_diff": stat.size_diff,
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in snapshot.compare_to(self.previous, group_by)[:limit]
+            ]
+        self.previous = snapshot
+        self.previous_at = now
+        return result
+
+
+# Коли створено кожну задачу — щоб знайти ті, що висять найдовше
+TASK_STARTED: "weakref.WeakKeyDictionary[asyncio.Task, float]" = weakref.WeakKeyDictionary()
+
+
+def timed_task_factory(loop: asyncio.AbstractEventLoop, coro, **kwargs) -> asyncio.Task:
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    TASK_STARTED[task] = time.monotonic()
+    return task
+
+
+def task_report(limit: int) -> dict:
+    now = time.monotonic()
+    tasks = asyncio.all_tasks()
+    by_coro: Dict[str, int] = {}
+    timed = []
+    for task in tasks:
+        coro = task.get_coro()
+        name = getattr(coro, "__qualname__", type(coro).__name__)
+        by_coro[name] = by_coro.get(name, 0) + 1
+        started = TASK_STARTED.get(task)
+        if started is not None:
+            timed.append((now - started, task, name))
+    timed.sort(key=lambda item: item[0], reverse=True)
+
+    longest = []
+    for age, task, name in timed[:limit]:
+        stack = task.get_stack(limit=1)
+        where = (
+            f"{os.path.basename(stack[0].f_code.co_filename)}:{stack[0].f_lineno}"
+            if stack else None
+        )
+        longest.append({"task": task.get_name(), "coro": name, "age_seconds": round(age, 2), "awaiting_at": where})
+
+    return {
+        "total": len(tasks),
+        "untimed": len(tasks) - len(timed),
+        "by_coroutine": dict(sorted(by_coro.items(), key=lambda kv: kv[1], reverse=True)),
+        "longest_running": longest,
+    }
+
+
+CPU_PROFILER = SamplingProfiler()
+MEMORY_PROFILER = MemoryProfiler(PROFILE_MEMORY_SECONDS)
+
+
+def debug_authorized(request: web.Request) -> bool:
+    if not PROFILE_TOKEN:
+        return False
+    token = request.headers.get("X-Debug-Token") or request.query.get("token", "")
+    return hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def query_number(request: web.Request, name: str, default: float, lo: float, hi: float) -> float:
+    """Числовий параметр запиту, обмежений [lo, hi]; сміття — 400, а не 500."""
+    raw = request.query.get(name)
+    if raw is None:
+        return default
+    try:
+        value = float(raw)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{name}: expected a number")
+    if value != value or value < lo:  # NaN або замало
+        raise web.HTTPBadRequest(text=f"{name}: must be >= {lo:g}")
+    return min(value, hi)
+
+
+def add_debug_routes(app: web.Application):
+    """/debug/cpu, /debug/memory, /debug/tasks — без правильного токена 404."""
+
+    def guarded(handler):
+        async def wrapper(request: web.Request):
+            if not debug_authorized(request):
+                raise web.HTTPNotFound()
+            return await handler(request)
+        return wrapper
+
+    async def handle_cpu(request):
+        seconds = query_number(request, "seconds", 10, 0.1, PROFILE_MAX_SECONDS)
+        interval = query_number(request, "interval_ms", 5, 1, 1000) / 1000
+        limit = int(query_number(request, "limit", 30, 1, 1000))
+        if CPU_PROFILER.busy:
+            return web.json_response({"error": "profile already running"}, status=409)
+        stacks, total = await CPU_PROFILER.profile(seconds, interval)
+        if request.query.get("format") == "collapsed":
+            lines = [f"{stack} {count}" for stack, count in sorted(stacks.items())]
+            return web.Response(text="\n".join(lines) + "\n")
+        return web.json_response({"seconds": seconds, **SamplingProfiler.summarize(stacks, total, limit)})
+
+    async def handle_memory(request):
+        if request.query.get("stop") == "1":
+            MEMORY_PROFILER.stop()
+            return web.json_response({"tracing": False})
+        group_by = request.query.get("group_by", "lineno")
+        if group_by not in ("lineno", "filename", "traceback"):
+            raise web.HTTPBadRequest(text="group_by: lineno | filename | traceback")
+        limit = int(query_number(request, "limit", 25, 1, 1000))
+        MEMORY_PROFILER.start()
+        try:
+            # знімок і порівняння — важкі, не в event loop
+            result = await asyncio.to_thread(MEMORY_PROFILER.diff, group_by, limit)
+        except RuntimeError:  # вікно трасування скінчилось просто під час знімка
+            return web.json_response({"error": "tracing stopped, retry"}, status=409)
+        return web.json_response(result)
+
+    async def handle_tasks(request):
+        return web.json_response(task_report(int(query_number(request, "limit", 20, 1, 1000))))
+
+    app.router.add_get("/debug/cpu", guarded(handle_cpu))
+    app.router.add_get("/debug/memory", guarded(handle_memory))
+    app.router.add_get("/debug/tasks", guarded(handle_tasks))
 
 
 # ==========================================
 #  WEB-SERVER (для Render / VPS health-check)
 # ==========================================
 
-async def start_web_server():
+def cache_metrics() -> list:
+    """Попадання/промахи кешів — з лічильників, які кеші вже ведуть для /stats."""
+    storage = STORAGE.stats()
+    caches = {
+        "file_id": (FILE_ID_CACHE.hits, FILE_ID_CACHE.misses),
+        "state": (storage.get("hits", 0), storage.get("misses", 0)),
+        "redirect": (
+            REDIRECTS.counters["hits"] + REDIRECTS.counters["negative_hits"],
+            REDIRECTS.counters["misses"],
+        ),
+        "language": (TRANSLATIONS.counters["lang_hits"], TRANSLATIONS.counters["lang_misses"]),
+        "translation": (TRANSLATIONS.counters["tr_hits"], TRANSLATIONS.counters["tr_misses"]),
+        "instagram_meta": (INSTAGRAM.counters["hits"], INSTAGRAM.counters["misses"]),
+        "single_flight": (INFLIGHT.coalesced, INFLIGHT.leaders),
+    }
+    return [
+        (
+            "bot_cache_hits_total", "counter", "Cache hits by cache",
+            [({"cache": name}, hits) for name, (hits, _) in caches.items()],
+        ),
+        (
+            "bot_cache_misses_total", "counter", "Cache misses by cache",
+            [({"cache": name}, misses) for name, (_, misses) in caches.items()],
+        ),
+    ]
+
+
+METRICS.collectors.append(cache_metrics)
+
+
+# ==========================================
+#  АПДЕЙТИ: WEBHOOK (основний режим) / LONG POLLING (запасний)
+# ==========================================
+
+WEBHOOK_UPDATES = METRICS.counter(
+    "bot_webhook_updates_total", "Webhook deliveries by result", ("result",)
+)
+
+
+class WebhookFeeder:
+    """
+    Приймає апдейти від Telegram на вебхук. Відповідаємо 200 одразу, а
+    обробляємо у фоні — не більше `concurrency` апдейтів одночасно.
+    Якщо необроблених більше за `backlog`, відповідаємо 503: Telegram
+    повторить доставку пізніше, і пам'ять не росте під сплеском.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret: str, concurrency: int, backlog: int):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self.concurrency = concurrency
+        self.backlog = backlog
+        self.pending = 0
+        self.active = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            WEBHOOK_UPDATES.inc(result="unauthorized")
+            return web.Response(status=401)
+        if self.pending >= self.backlog:
+            WEBHOOK_UPDATES.inc(result="overloaded")
+            return web.Response(status=503, headers={"Retry-After": "5"})
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            WEBHOOK_UPDATES.inc(result="invalid")
+            logging.warning(f"webhook: bad update: {e}")
+            return web.Response(status=400)
+
+        WEBHOOK_UPDATES.inc(result="accepted")
+        self.pending += 1
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: types.Update):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        try:
+            async with self._slots:
+                self.active += 1
+                try:
+                    await self.dispatcher.feed_update(self.bot, update)
+                finally:
+                    self.active -= 1
+        except Exception as e:
+            logging.exception(f"webhook: update {update.update_id} failed: {e}")
+        finally:
+            self.pending -= 1
+
+    async def drain(self, timeout: float = 10):
+        """Даємо вже прийнятим апдейтам завершитись перед зупинкою."""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def stats(self) -> dict:
+        return {
+            "mode": "webhook" if WEBHOOK_URL else "polling",
+            "pending": self.pending,
+            "active": self.active,
+            "concurrency": self.concurrency,
+            "backlog": self.backlog,
+        }
+
+
+WEBHOOK = WebhookFeeder(dp, bot, WEBHOOK_SECRET, UPDATE_CONCURRENCY, UPDATE_BACKLOG)
+STATS_PROVIDERS["updates"] = WEBHOOK.stats
+
+
+def webhook_metrics() -> list:
+    return [
+        (
+            "bot_webhook_updates_pending", "gauge", "Accepted webhook updates not yet handled",
+            [({}, WEBHOOK.pending)],
+        ),
+    ]
+
+
+METRICS.collectors.append(webhook_metrics)
+
+
+async def setup_webhook() -> bool:
+    """Реєструє вебхук у Telegram; False — лишаємось на long polling."""
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+            # апдейти, які Telegram притримав під час деплою, не викидаємо
+        )
+    except Exception as e:
+        logging.error(f"setWebhook failed, falling back to long polling: {e}")
+        return False
+    logging.info(f"Webhook set: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    return True
+
+
+async def run_webhook():
+    """Чекає SIGINT/SIGTERM; апдейти тим часом приймає веб-сервер."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    # Вебхук не видаляємо: поки бот перезапускається, Telegram притримає апдейти
+    await stop.wait()
+
+
+async def start_web_server() -> web.AppRunner:
     app = web.Application()
 
     async def handle_root(request):
         return web.Response(text="Bot is alive!")
 
+    async def handle_stats(request):
+        return web.json_response(collect_stats())
+
+    async def handle_metrics(request):
+        return web.Response(text=METRICS.render(), content_type="text/plain")
+
     app.router.add_get("/", handle_root)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_get("/metrics", handle_metrics)
+    if WEBHOOK_URL:
+        app.router.add_post(WEBHOOK_PATH, WEBHOOK.handle)
+    add_debug_routes(app)
 
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, API_HOST, API_PORT)
     await site.start()
     logging.info(f"Web server started on {API_HOST}:{API_PORT}")
+    return runner
 
 
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
-    await asyncio.gather(start_web_server(), dp.start_polling(bot))
+    asyncio.get_running_loop().set_task_factory(timed_task_factory)
+    await HTTP.start()
+    # Профілі мов langdetect вантажимо заздалегідь і не в event loop
+    await asyncio.to_thread(init_factory)
+    JOBS.start()
+    runner = await start_web_server()
+    try:
+        if WEBHOOK_URL and await setup_webhook():
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            # сесію закриваємо самі: задачам JOBS вона ще потрібна
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_CONCURRENCY, close_bot_session=False)
+    finally:
+        # Зупинка: спершу перестаємо приймати апдейти, потім доробляємо
+        # вже прийняті — і хендлери, і задачі в JOBS
+        await runner.cleanup()
+        await WEBHOOK.drain()
+        await JOBS.drain(JOB_DRAIN_TIMEOUT)
+        await JOBS.stop()
+        await bot.session.close()
+        logging.info(f"HTTP pool stats on shutdown: {HTTP.stats()}")
+        await HTTP.close()
+        await STORAGE.close()
+        INSTAGRAM.close()
 
 
 if __name__ == "__main__":
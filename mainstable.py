@@ -4,7 +4,7 @@ import os
 import asyncio
 import re
 import uuid
-import random # Для випадкового вибору дзеркала
+import time
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart
 from aiogram.types import FSInputFile, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto, InputMediaVideo
@@ -17,6 +17,8 @@ import instaloader
 import static_ffmpeg
 import subprocess
 
+from cobalt_mirrors import COBALT_MIRRORS  # дзеркала Cobalt — спільні з main.py
+
 # Активуємо FFmpeg
 static_ffmpeg.add_paths()
 
@@ -28,15 +30,15 @@ RENDER_URL = "https://tiktok-bot-z88j.onrender.com"
 # Кеш
 STORAGE = {}
 
-# Дзеркала Cobalt
-COBALT_MIRRORS = [
-    "https://co.wuk.sh/api/json",
-    "https://api.cobalt.tools/api/json",
-    "https://cobalt.pub/api/json",
-    "https://api.succoon.com/api/json",
-    "https://cobalt.zip/api/json",
-    "https://cobalt.xy24.eu/api/json"
-]
+
+# Реєстр дзеркал: EWMA затримки й успішності, карантин для тих, що падають
+MIRROR_EWMA_ALPHA = 0.3
+MIRROR_TIMEOUT_FACTOR = 3        # дедлайн спроби = EWMA затримки * фактор
+MIRROR_MIN_TIMEOUT = 3
+MIRROR_MAX_TIMEOUT = 15
+MIRROR_DEFAULT_LATENCY = 2.5     # поки дзеркало не відповідало жодного разу
+MIRROR_QUARANTINE_AFTER = 2      # помилок поспіль до карантину
+MIRROR_QUARANTINE = 120          # сек
 
 logging.basicConfig(
     level=logging.INFO,
@@ -145,26 +147,112 @@ def extract_audio_from_video(video_bytes):
         return audio_bytes
     except: return None
 
+class MirrorRegistry:
+    def __init__(self, mirrors):
+        self.mirrors = {m: {"latency": None, "success": 1.0, "fails_in_row": 0, "quarantined_until": 0.0, "ok": 0, "errors": 0} for m in mirrors}
+
+    def score(self, mirror):
+        # Менше — краще: очікувана затримка, поділена на ймовірність успіху
+        s = self.mirrors[mirror]
+        latency = s["latency"] if s["latency"] is not None else MIRROR_DEFAULT_LATENCY
+        return latency / max(s["success"], 0.05)
+
+    def ranked(self):
+        now = time.monotonic()
+        healthy = [m for m, s in self.mirrors.items() if s["quarantined_until"] <= now]
+        if not healthy:
+            # Всі в карантині — пробуємо тих, у кого він закінчиться найраніше
+            return sorted(self.mirrors, key=lambda m: self.mirrors[m]["quarantined_until"])
+        return sorted(healthy, key=self.score)
+
+    def deadline(self, mirror):
+        latency = self.mirrors[mirror]["latency"] or MIRROR_DEFAULT_LATENCY
+        return min(max(latency * MIRROR_TIMEOUT_FACTOR, MIRROR_MIN_TIMEOUT), MIRROR_MAX_TIMEOUT)
+
+    def _ewma(self, old, value):
+        return value if old is None else old + MIRROR_EWMA_ALPHA * (value - old)
+
+    def record_success(self, mirror, latency):
+        s = self.mirrors[mirror]
+        s["latency"] = self._ewma(s["latency"], latency)
+        s["success"] = self._ewma(s["success"], 1.0)
+        s["fails_in_row"] = 0
+        s["ok"] += 1
+
+    def record_failure(self, mirror, latency=None):
+        # latency передаємо лише для таймаутів: повільне дзеркало має опуститись у рейтингу
+        s = self.mirrors[mirror]
+        if latency is not None:
+            s["latency"] = self._ewma(s["latency"], latency)
+        s["success"] = self._ewma(s["success"], 0.0)
+        s["fails_in_row"] += 1
+        s["errors"] += 1
+        if s["fails_in_row"] >= MIRROR_QUARANTINE_AFTER:
+            s["quarantined_until"] = time.monotonic() + MIRROR_QUARANTINE
+            logging.warning(f"Cobalt mirror {mirror} quarantined for {MIRROR_QUARANTINE}s")
+
+    def snapshot(self):
+        now = time.monotonic()
+        result = []
+        for m in sorted(self.mirrors, key=self.score):
+            s = self.mirrors[m]
+            result.append({
+                "mirror": m,
+                "score": round(self.score(m), 3),
+                "latency": round(s["latency"], 3) if s["latency"] is not None else None,
+                "success": round(s["success"], 3),
+                "deadline": round(self.deadline(m), 2),
+                "ok": s["ok"],
+                "errors": s["errors"],
+                "quarantine_left": max(0, round(s["quarantined_until"] - now, 1)),
+            })
+        return result
+
+MIRRORS = MirrorRegistry(COBALT_MIRRORS)
+
 async def get_cobalt_data(user_url, is_youtube=False):
     payload = {"url": user_url}
     if is_youtube:
         payload.update({"videoQuality":"720","youtubeVideoCodec":"h264","audioFormat":"mp3","filenamePattern":"classic"})
     
     headers = {"Accept": "application/json", "Content-Type": "application/json"}
-    
-    # Перемішуємо дзеркала для балансування
-    mirrors = COBALT_MIRRORS.copy()
-    random.shuffle(mirrors)
 
     async with aiohttp.ClientSession() as session:
-        for mirror in mirrors:
+        # Найшвидші й найнадійніші дзеркала — першими, кожне зі своїм дедлайном
+        for mirror in MIRRORS.ranked():
+            deadline = MIRRORS.deadline(mirror)
+            started = time.monotonic()
             try:
-                async with session.post(mirror, json=payload, headers=headers, timeout=15) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if 'error' in data: continue
-                        if data.get('status') in ['stream', 'redirect', 'picker']: return data
-            except: continue
+                async with session.post(mirror, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=deadline)) as response:
+                    if response.status >= 500:
+                        MIRRORS.record_failure(mirror)
+                        continue
+                    data = await response.json(content_type=None)
+            except asyncio.TimeoutError:
+                MIRRORS.record_failure(mirror, time.monotonic() - started)
+                continue
+            except Exception:
+                # мережа або не-JSON відповідь — дзеркало несправне
+                MIRRORS.record_failure(mirror)
+                continue
+
+            if not isinstance(data, dict):
+                MIRRORS.record_failure(mirror)
+                continue
+            status = data.get('status')
+            if status in ['stream', 'redirect', 'picker']:
+                MIRRORS.record_success(mirror, time.monotonic() - started)
+                return data
+            error = data.get('error')
+            error = str(data.get('text') or (error.get('code') if isinstance(error, dict) else error) or '')
+            if response.status == 429 or status == 'rate-limit' or 'rate_exceeded' in error or 'auth' in error:
+                # ліміт чи доступ саме цього дзеркала — пробуємо наступне, здоров'я не чіпаємо
+                continue
+            if status == 'error':
+                # проблема в посиланні (приватний/видалений пост) — інші дзеркала скажуть те саме
+                logging.info(f"Cobalt {mirror}: {error or 'error'}")
+                return None
+            MIRRORS.record_failure(mirror)
     return None
 
 async def keep_alive_ping():
@@ -181,6 +269,7 @@ async def keep_alive_ping():
 async def start_web_server():
     app = web.Application()
     app.router.add_get('/', lambda r: web.Response(text="Bot is alive!"))
+    app.router.add_get('/mirrors', lambda r: web.json_response(MIRRORS.snapshot()))
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', int(os.environ.get("PORT", 8080)))
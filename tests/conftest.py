@@ -0,0 +1,30 @@
+"""
+Спільне для тестів: main.py читає налаштування з оточення під час
+імпорту, тож виставляємо їх до першого `import main`.
+"""
+
+import os
+import socket
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-token")
+os.environ.setdefault("TRACE_FILE", "")
+os.environ.setdefault("HTTP_PREWARM", "0")
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("TIKWM_RATE", "1000")
+os.environ.setdefault("TIKWM_BURST", "1000")
+os.environ.setdefault("TIKWM_MAX_RETRIES", "0")
+
+# static_ffmpeg під час імпорту main завантажує ffmpeg — тестам він не потрібен
+import static_ffmpeg  # noqa: E402
+
+static_ffmpeg.add_paths = lambda *args, **kwargs: None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
@@ -0,0 +1,100 @@
+"""JobPool: воркери, таймаути і запит хендлера, що продовжується у воркері."""
+
+import asyncio
+
+import pytest
+
+import main
+
+
+class RecordingJob(main.Job):
+    kind = "recording"
+    __slots__ = ("seen", "delay", "timed_out_called")
+
+    def __init__(self, user_id: int, seen: list, delay: float = 0.0):
+        super().__init__(user_id, user_id, main.PRIORITY_NORMAL, "tiktok", "standard")
+        self.seen = seen
+        self.delay = delay
+        self.timed_out_called = False
+
+    async def run(self):
+        await asyncio.sleep(self.delay)
+        self.seen.append((self.user_id, main.current_request_id()))
+
+    async def timed_out(self):
+        self.timed_out_called = True
+
+
+def pool(workers: int = 1, job_timeout: float = 5, queue_max: int = 100) -> main.JobPool:
+    return main.JobPool(main.FairScheduler(1, 1, 10, queue_max), workers=workers, job_timeout=job_timeout)
+
+
+def requests_total() -> float:
+    return sum(
+        float(line.rsplit(" ", 1)[1])
+        for line in main.METRICS.render().splitlines()
+        if line.startswith("bot_requests_total{")
+    )
+
+
+def test_workers_run_submitted_jobs():
+    async def scenario():
+        jobs = pool(workers=1)
+        jobs.start()
+        await asyncio.sleep(0)  # воркер чекає на задачу
+        seen = []
+        positions = [jobs.submit(RecordingJob(user_id, seen, delay=0.05)) for user_id in range(3)]
+        await asyncio.sleep(0.4)
+        await jobs.stop()
+        return positions, [user_id for user_id, _ in seen]
+
+    positions, order = asyncio.run(scenario())
+    assert positions == [0, 1, 2]
+    assert order == [0, 1, 2]
+
+
+def test_job_over_timeout_is_cancelled_and_notified():
+    async def scenario():
+        jobs = pool(job_timeout=0.1)
+        jobs.start()
+        job = RecordingJob(1, [], delay=1.0)
+        jobs.submit(job)
+        await asyncio.sleep(0.3)
+        await jobs.stop()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.timed_out_called
+    assert job.seen == []
+
+
+def test_job_continues_handler_request_and_counts_it_once():
+    async def scenario():
+        jobs = pool()
+        jobs.start()
+        seen = []
+        before = requests_total()
+        with main.track_request("tiktok", "standard"):
+            handler_id = main.current_request_id()
+            jobs.submit(RecordingJob(1, seen, delay=0.05))
+        counted_before_job = requests_total() - before
+        await asyncio.sleep(0.2)
+        await jobs.stop()
+        return handler_id, seen, counted_before_job, requests_total() - before
+
+    handler_id, seen, counted_before_job, counted = asyncio.run(scenario())
+    assert seen == [(1, handler_id)]
+    assert counted_before_job == 0  # запит завершується разом із задачею
+    assert counted == 1
+
+
+def test_rejected_job_leaves_request_to_handler():
+    async def scenario():
+        jobs = pool(queue_max=0)
+        before = requests_total()
+        with main.track_request("tiktok", "standard"):
+            with pytest.raises(main.SchedulerBusy):
+                jobs.submit(RecordingJob(1, []))
+        return requests_total() - before
+
+    assert asyncio.run(scenario()) == 1
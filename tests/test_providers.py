@@ -0,0 +1,236 @@
+"""Circuit breaker і хеджування ланцюжка провайдерів проти fake_providers.py."""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+import fake_providers
+import main
+from conftest import free_port
+
+POST_URL = "https://www.tiktok.com/@fake/video/42"
+
+
+@asynccontextmanager
+async def providers_server(**providers):
+    """Фейкові TikWM/Cobalt на вільному порту; main ходить до них через HTTP."""
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    runner = web.AppRunner(fake_providers.build_app(providers, base_url))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    old_tikwm_url = main.TIKWM_API_URL
+    main.TIKWM_API_URL = f"{base_url}/api/"
+    await main.HTTP.start()
+    try:
+        yield base_url
+    finally:
+        main.TIKWM_API_URL = old_tikwm_url
+        await main.HTTP.close()
+        await runner.cleanup()
+
+
+def tikwm(breaker_failures: int = 2, reset: float = 60) -> main.TikWMProvider:
+    provider = main.TikWMProvider()
+    provider.breaker = main.CircuitBreaker(breaker_failures, reset)
+    return provider
+
+
+def cobalt(base_url: str, n: int, breaker_failures: int = 2, reset: float = 60) -> main.CobaltProvider:
+    provider = main.CobaltProvider(f"{base_url}/cobalt/{n}/api/json")
+    provider.breaker = main.CircuitBreaker(breaker_failures, reset)
+    return provider
+
+
+# ---------- CircuitBreaker ----------
+
+def test_breaker_opens_after_threshold_and_blocks():
+    breaker = main.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open"
+    assert breaker.opens == 1
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_lets_one_probe_through():
+    breaker = main.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # пробний запит уже летить
+
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_breaker_half_open_failure_reopens():
+    breaker = main.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert breaker.opens == 2
+    assert not breaker.allow()
+
+
+def test_breaker_release_frees_probe_without_closing():
+    breaker = main.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_failing_cobalt_opens_breaker_and_is_skipped():
+    async def scenario():
+        async with providers_server(cobalt1=fake_providers.FakeProvider(fail=1)) as base_url:
+            provider = cobalt(base_url, 1)
+            for _ in range(2):
+                try:
+                    await main._call_provider(provider, POST_URL)
+                except Exception:
+                    pass
+            assert provider.breaker.state == "open"
+            assert provider.counters["errors"] == 2
+            # відкритий breaker: hedged_fetch навіть не стартує провайдера
+            try:
+                await main.hedged_fetch([provider], POST_URL, hedge_delay=0.1)
+            except Exception as e:
+                assert "недоступні" in str(e)
+            else:
+                raise AssertionError("hedged_fetch must fail with every breaker open")
+            assert provider.counters["calls"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_tikwm_quota_does_not_open_breaker():
+    async def scenario():
+        async with providers_server(tikwm=fake_providers.FakeProvider(fail=1)):
+            provider = tikwm(breaker_failures=1)
+            for _ in range(3):
+                try:
+                    await main._call_provider(provider, POST_URL)
+                except main.ProviderQuota:
+                    pass
+            assert provider.breaker.state == "closed"
+            assert provider.counters["quota"] == 3
+            assert provider.counters["errors"] == 0
+
+    asyncio.run(scenario())
+
+
+# ---------- hedged_fetch ----------
+
+def test_fast_first_provider_needs_no_hedge():
+    async def scenario():
+        async with providers_server(tikwm=fake_providers.FakeProvider()) as base_url:
+            first, second = tikwm(), cobalt(base_url, 1)
+            hedges = main.HEDGE_STATS["hedges"]
+            data = await main.hedged_fetch([first, second], POST_URL, hedge_delay=1.0)
+            assert data["title"] == "Fake caption for post 42"
+            assert main.HEDGE_STATS["hedges"] == hedges
+            assert second.counters["calls"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_slow_first_provider_is_hedged_after_delay():
+    async def scenario():
+        fakes = {"tikwm": fake_providers.FakeProvider(delay=1.0), "cobalt1": fake_providers.FakeProvider()}
+        async with providers_server(**fakes) as base_url:
+            first, second = tikwm(), cobalt(base_url, 1)
+            hedges = main.HEDGE_STATS["hedges"]
+            started = time.monotonic()
+            data = await main.hedged_fetch([first, second], POST_URL, hedge_delay=0.2)
+            elapsed = time.monotonic() - started
+
+            assert "title" not in data  # відповів Cobalt
+            assert 0.2 <= elapsed < 0.8
+            assert main.HEDGE_STATS["hedges"] == hedges + 1
+            assert second.counters["wins"] == 1
+            await asyncio.sleep(0)  # даємо скасуванню програвшого дійти до _call_provider
+            assert first.counters["cancelled"] == 1
+            assert first.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_failed_provider_falls_through_without_waiting_for_hedge():
+    async def scenario():
+        fakes = {"tikwm": fake_providers.FakeProvider(fail=1), "cobalt1": fake_providers.FakeProvider()}
+        async with providers_server(**fakes) as base_url:
+            first, second = tikwm(), cobalt(base_url, 1)
+            hedges = main.HEDGE_STATS["hedges"]
+            started = time.monotonic()
+            data = await main.hedged_fetch([first, second], POST_URL, hedge_delay=2.0)
+
+            assert time.monotonic() - started < 1.0
+            assert data["hdplay"].endswith("/media/video.mp4")
+            assert main.HEDGE_STATS["hedges"] == hedges  # це заміна, а не хедж
+
+    asyncio.run(scenario())
+
+
+# ---------- «пост недоступний» — не збій провайдера ----------
+
+MISSING_URL = f"https://www.tiktok.com/@fake/video/{fake_providers.MISSING_POST_ID}"
+
+
+def test_missing_post_does_not_open_breakers():
+    async def scenario():
+        async with providers_server(tikwm=fake_providers.FakeProvider()) as base_url:
+            providers = [tikwm(breaker_failures=1), cobalt(base_url, 1, breaker_failures=1)]
+            for provider in providers:
+                for _ in range(3):
+                    try:
+                        await main._call_provider(provider, MISSING_URL)
+                    except main.PostUnavailable:
+                        pass
+                assert provider.breaker.state == "closed"
+                assert provider.counters["unavailable"] == 3
+                assert provider.counters["errors"] == 0
+            # після битих посилань нормальні працюють
+            data = await main.hedged_fetch(providers, POST_URL, hedge_delay=1.0)
+            assert data["title"] == "Fake caption for post 42"
+
+    asyncio.run(scenario())
+
+
+def test_missing_post_stops_hedging():
+    async def scenario():
+        async with providers_server(tikwm=fake_providers.FakeProvider()) as base_url:
+            first, second = tikwm(), cobalt(base_url, 1)
+            try:
+                await main.hedged_fetch([first, second], MISSING_URL, hedge_delay=1.0)
+            except main.PostUnavailable:
+                pass
+            else:
+                raise AssertionError("hedged_fetch must raise PostUnavailable")
+            assert second.counters["calls"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cobalt_5xx_counts_against_breaker():
+    async def scenario():
+        async with providers_server(cobalt1=fake_providers.FakeProvider(fail=1)) as base_url:
+            provider = cobalt(base_url, 1, breaker_failures=1)
+            try:
+                await main._call_provider(provider, POST_URL)
+            except main.ProviderDown:
+                pass
+            assert provider.breaker.state == "open"
+
+    asyncio.run(scenario())
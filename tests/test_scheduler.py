@@ -0,0 +1,109 @@
+"""FairScheduler: черги по колу між чатами, ліміти на користувача, відмови."""
+
+import asyncio
+
+import pytest
+
+import main
+
+
+class DummyJob(main.Job):
+    kind = "dummy"
+    __slots__ = ("name",)
+
+    def __init__(self, name: str, user_id: int, chat_id: int, priority: int = main.PRIORITY_NORMAL):
+        super().__init__(user_id, chat_id, priority, "tiktok", "standard")
+        self.name = name
+
+    async def run(self):
+        pass
+
+
+def scheduler(**limits) -> main.FairScheduler:
+    params = {"per_user": 1, "per_chat": 1, "user_queue": 10, "queue_max": 100}
+    params.update(limits)
+    return main.FairScheduler(**params)
+
+
+async def drain(sched: main.FairScheduler, count: int) -> list:
+    """Один воркер: бере задачі по черзі й одразу завершує."""
+    order = []
+    for _ in range(count):
+        job = await sched.next()
+        order.append(job.name)
+        sched.done(job)
+    return order
+
+
+def test_chats_are_served_round_robin():
+    async def scenario():
+        sched = scheduler()
+        for i in range(4):
+            sched.submit(DummyJob(f"a{i}", user_id=1, chat_id=1))
+        sched.submit(DummyJob("b0", user_id=2, chat_id=2))
+        sched.submit(DummyJob("c0", user_id=3, chat_id=3))
+        return await drain(sched, 6)
+
+    # 4 посилання від одного користувача не відсувають інших
+    assert asyncio.run(scenario()) == ["a0", "b0", "c0", "a1", "a2", "a3"]
+
+
+def test_button_presses_go_before_links():
+    async def scenario():
+        sched = scheduler()
+        sched.submit(DummyJob("link1", user_id=1, chat_id=1))
+        sched.submit(DummyJob("link2", user_id=2, chat_id=2))
+        sched.submit(DummyJob("button", user_id=3, chat_id=3, priority=main.PRIORITY_INTERACTIVE))
+        return await drain(sched, 3)
+
+    assert asyncio.run(scenario()) == ["button", "link1", "link2"]
+
+
+def test_busy_user_does_not_block_others_in_same_chat():
+    async def scenario():
+        sched = scheduler(per_user=1, per_chat=2)
+        sched.submit(DummyJob("a0", user_id=1, chat_id=1))
+        sched.submit(DummyJob("a1", user_id=1, chat_id=1))
+        sched.submit(DummyJob("b0", user_id=2, chat_id=1))
+        first = await sched.next()  # a0 виконується, user 1 вичерпав ліміт
+        second = await sched.next()
+        return first.name, second.name
+
+    assert asyncio.run(scenario()) == ("a0", "b0")
+
+
+def test_submit_reports_queue_position():
+    async def scenario():
+        sched = scheduler()
+        worker = asyncio.ensure_future(sched.next())
+        await asyncio.sleep(0)  # воркер чекає на задачу
+        taken = sched.submit(DummyJob("a0", user_id=1, chat_id=1))
+        queued = [sched.submit(DummyJob(f"b{i}", user_id=2, chat_id=2)) for i in range(2)]
+        await worker
+        return taken, queued
+
+    assert asyncio.run(scenario()) == (0, [1, 2])
+
+
+def test_rejects_user_over_queue_limit():
+    sched = scheduler(user_queue=2)
+    sched.submit(DummyJob("a0", user_id=1, chat_id=1))
+    sched.submit(DummyJob("a1", user_id=1, chat_id=1))
+    with pytest.raises(main.SchedulerBusy) as e:
+        sched.submit(DummyJob("a2", user_id=1, chat_id=1))
+    assert e.value.reason == "user"
+    # кнопки в ліміт посилань не рахуються, інші користувачі — теж
+    sched.submit(DummyJob("button", user_id=1, chat_id=1, priority=main.PRIORITY_INTERACTIVE))
+    sched.submit(DummyJob("b0", user_id=2, chat_id=2))
+    assert sched.counters["rejected_user"] == 1
+
+
+def test_rejects_when_global_queue_full():
+    sched = scheduler(queue_max=3)
+    for i in range(3):
+        sched.submit(DummyJob(f"u{i}", user_id=i, chat_id=i))
+    with pytest.raises(main.SchedulerBusy) as e:
+        sched.submit(DummyJob("late", user_id=99, chat_id=99, priority=main.PRIORITY_INTERACTIVE))
+    assert e.value.reason == "global"
+    assert sched.counters["rejected_global"] == 1
+    assert sched.waiting == 3
@@ -0,0 +1,66 @@
+"""Сховище даних кнопок: ліміти MediaStore і TTL у персистентних бекендах."""
+
+import asyncio
+
+import main
+
+
+def test_update_counts_as_access_and_survives_eviction():
+    store = main.MediaStore(max_bytes=10**9, max_entries=2, ttl=100)
+    store.put("a", {"x": 1})
+    store.put("b", {"x": 2})
+    assert store.update("a", x=3) == {"x": 3}
+    store.put("c", {"x": 4})  # витісняє найдавніший — тепер це b
+    assert "a" in store
+    assert "b" not in store
+
+
+def test_growing_update_evicts_others_not_itself():
+    store = main.MediaStore(max_bytes=500, max_entries=10, ttl=100)
+    store.put("a", {"x": b"1" * 100})
+    store.put("b", {"x": b"2" * 100})
+    assert store.update("a", y=b"3" * 150) is not None
+    assert "a" in store
+    assert "b" not in store
+    assert store.bytes_held <= store.max_bytes
+
+
+def test_update_refreshes_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    store = main.MediaStore(max_bytes=10**9, max_entries=10, ttl=10)
+    store.put("a", {"x": 1})
+    now[0] += 8
+    store.update("a", x=2)
+    now[0] += 8  # від put минуло 16 с, від update — 8
+    assert store.get("a") == {"x": 2}
+
+
+def test_update_of_expired_entry_returns_none(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    store = main.MediaStore(max_bytes=10**9, max_entries=10, ttl=10)
+    store.put("a", {"x": 1})
+    now[0] += 11
+    assert store.update("a", x=2) is None
+
+
+def test_sqlite_update_extends_blob_ttl(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+
+    async def scenario():
+        backend = main.SqliteStateBackend(str(tmp_path / "state.db"), ttl=10)
+        await backend.put("p1", {"author_name": "a", "photo_bytes": b"img", "gallery_data": [(b"g0", "photo")]})
+        now[0] += 8
+        await backend.update("p1", current_lang="trans")
+        now[0] += 8  # від put минуло 16 с, від update — 8
+        meta = await backend.get("p1")
+        blobs = await backend.get_blobs("p1", meta)
+        await backend.close()
+        return meta, blobs
+
+    meta, blobs = asyncio.run(scenario())
+    assert meta["current_lang"] == "trans"
+    assert blobs["photo_bytes"] == b"img"
+    assert blobs["gallery_data"] == [(b"g0", "photo")]
@@ -0,0 +1,183 @@
+"""WebhookFeeder проти fake_bot_api.py: секрет, некоректні апдейти, backlog, зупинка."""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+import fake_bot_api
+import main
+from conftest import free_port
+
+SECRET = "test-secret"
+TOKEN = "123456:TEST-token"
+
+
+async def serve(app: web.Application):
+    port = free_port()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+
+@asynccontextmanager
+async def webhook_env(concurrency: int = 4, backlog: int = 100, handler_gate: asyncio.Event = None):
+    """
+    Фейковий Bot API + веб-сервер з WebhookFeeder. Хендлер відповідає
+    на кожне повідомлення через Bot API і, якщо задано, чекає handler_gate.
+    """
+    api = fake_bot_api.FakeTelegram(TOKEN)
+    api_runner, api_url = await serve(fake_bot_api.build_app(api))
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+    dispatcher = Dispatcher()
+
+    @dispatcher.message()
+    async def echo(message: types.Message):
+        if handler_gate is not None:
+            await handler_gate.wait()
+        await message.answer(f"echo: {message.text}")
+
+    feeder = main.WebhookFeeder(dispatcher, bot, SECRET, concurrency, backlog)
+    app = web.Application()
+    app.router.add_post(main.WEBHOOK_PATH, feeder.handle)
+    hook_runner, hook_url = await serve(app)
+    api.webhook = {"url": hook_url + main.WEBHOOK_PATH, "secret_token": SECRET}
+    try:
+        yield api, feeder, hook_url + main.WEBHOOK_PATH
+    finally:
+        if handler_gate is not None:
+            handler_gate.set()
+        await feeder.drain(timeout=2)
+        await hook_runner.cleanup()
+        await bot.session.close()
+        await api_runner.cleanup()
+
+
+def message_update(api: fake_bot_api.FakeTelegram, text: str, update_id: int = 1) -> dict:
+    message = api.message(1000, text=text)
+    message["from"] = api.user(1000)
+    return {"update_id": update_id, "message": message}
+
+
+def test_update_with_secret_is_accepted_and_handled():
+    async def scenario():
+        async with webhook_env() as (api, feeder, _):
+            update = message_update(api, "hello")
+            del update["update_id"]  # push() видає свій
+            await api.push(update)
+            await feeder.drain(timeout=2)
+            return api.deliveries, [c.get("text") for c in api.sent if c["method"] == "sendMessage"]
+
+    deliveries, replies = asyncio.run(scenario())
+    assert deliveries["ok"] == 1
+    assert replies == ["echo: hello"]
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    async def scenario():
+        async with webhook_env() as (api, feeder, url):
+            update = message_update(api, "hello")
+            async with aiohttp.ClientSession() as http:
+                async with http.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "nope"}) as r:
+                    wrong = r.status
+                async with http.post(url, json=update) as r:
+                    missing = r.status
+            return wrong, missing, feeder.pending, api.calls.get("sendMessage", 0)
+
+    assert asyncio.run(scenario()) == (401, 401, 0, 0)
+
+
+def test_invalid_body_gets_400():
+    async def scenario():
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        async with webhook_env() as (api, feeder, url):
+            async with aiohttp.ClientSession() as http:
+                async with http.post(url, data=b"not json", headers=headers) as r:
+                    not_json = r.status
+                async with http.post(url, json={"update_id": "abc"}, headers=headers) as r:
+                    bad_update = r.status
+            return not_json, bad_update, feeder.pending
+
+    assert asyncio.run(scenario()) == (400, 400, 0)
+
+
+def test_full_backlog_answers_503_until_drained():
+    async def scenario():
+        gate = asyncio.Event()
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        async with webhook_env(concurrency=1, backlog=2, handler_gate=gate) as (api, feeder, url):
+            statuses = []
+            async with aiohttp.ClientSession() as http:
+                for i in range(3):
+                    async with http.post(url, json=message_update(api, f"m{i}", i + 1), headers=headers) as r:
+                        statuses.append((r.status, r.headers.get("Retry-After")))
+                gate.set()
+                await feeder.drain(timeout=2)
+                async with http.post(url, json=message_update(api, "after", 10), headers=headers) as r:
+                    statuses.append((r.status, None))
+            await feeder.drain(timeout=2)
+            return statuses, api.calls.get("sendMessage", 0)
+
+    statuses, replies = asyncio.run(scenario())
+    assert statuses == [(200, None), (200, None), (503, "5"), (200, None)]
+    assert replies == 3
+
+
+# ---------- зупинка ----------
+
+class SlowJob(main.Job):
+    kind = "slow"
+    __slots__ = ("finished",)
+
+    def __init__(self, user_id: int, finished: list):
+        super().__init__(user_id, user_id, main.PRIORITY_NORMAL, "tiktok", "standard")
+        self.finished = finished
+
+    async def run(self):
+        await asyncio.sleep(0.2)
+        self.finished.append(self.user_id)
+
+
+def test_shutdown_finishes_accepted_jobs_and_refuses_new():
+    async def scenario():
+        pool = main.JobPool(main.FairScheduler(1, 1, 10, 100), workers=2, job_timeout=5)
+        pool.start()
+        finished = []
+        for user_id in range(4):  # 2 у роботі, 2 у черзі
+            pool.submit(SlowJob(user_id, finished))
+        await asyncio.sleep(0)
+        drain = asyncio.ensure_future(pool.drain(timeout=2))
+        await asyncio.sleep(0)
+        try:
+            pool.submit(SlowJob(99, finished))
+        except main.SchedulerBusy as e:
+            refused = e.reason
+        await drain
+        await pool.stop()
+        return sorted(finished), refused
+
+    assert asyncio.run(scenario()) == ([0, 1, 2, 3], "shutdown")
+
+
+def test_shutdown_drain_gives_up_after_timeout():
+    async def scenario():
+        pool = main.JobPool(main.FairScheduler(1, 1, 10, 100), workers=1, job_timeout=5)
+        pool.start()
+        finished = []
+        for user_id in range(3):
+            pool.submit(SlowJob(user_id, finished))
+        await asyncio.sleep(0)
+        started = asyncio.get_running_loop().time()
+        await pool.drain(timeout=0.3)
+        elapsed = asyncio.get_running_loop().time() - started
+        await pool.stop()
+        return elapsed, len(finished)
+
+    elapsed, done = asyncio.run(scenario())
+    assert elapsed < 0.6
+    assert done < 3